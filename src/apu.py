@@ -1,53 +1,521 @@
 '''The emulator APU module'''
 import sys
-import instances
+import math
+import struct
+import numpy
+from state import StateFields
 
 # Preventing direct execution
 if __name__ == '__main__':
     print("This module cannot be executed. Please use main.py")
     sys.exit()
 
-class Apu:
-    '''The emulator APU module class
+# https://www.nesdev.org/wiki/APU
+
+CPU_FREQUENCY = 1789773 # NTSC
+SAMPLE_RATE = 44100
+CYCLES_PER_SAMPLE = CPU_FREQUENCY / SAMPLE_RATE
+
+LENGTH_TABLE = [
+    10, 254, 20,  2, 40,  4, 80,  6, 160,  8, 60, 10, 14, 12, 26, 14,
+    12,  16, 24, 18, 48, 20, 96, 22, 192, 24, 72, 26, 16, 28, 32, 30,
+]
+
+DUTY_TABLE = numpy.array([
+    [0, 1, 0, 0, 0, 0, 0, 0],
+    [0, 1, 1, 0, 0, 0, 0, 0],
+    [0, 1, 1, 1, 1, 0, 0, 0],
+    [1, 0, 0, 1, 1, 1, 1, 1],
+], dtype=numpy.int32)
+
+TRIANGLE_TABLE = numpy.array(list(range(15, -1, -1)) + list(range(16)), dtype=numpy.int32)
+
+NOISE_PERIOD_TABLE = [4, 8, 16, 32, 64, 96, 128, 160, 202, 254, 380, 508, 762, 1016, 2034, 4068]
+
+DMC_RATE_TABLE = [428, 380, 340, 320, 286, 254, 226, 214, 190, 160, 142, 128, 106, 84, 72, 54]
+
+# Frame counter steps, as (CPU cycle from sequence start, quarter frame, half frame, IRQ), and sequence length
+FRAME_COUNTER_STEPS = [
+    ([(7457, 1, 0, 0), (14913, 1, 1, 0), (22371, 1, 0, 0), (29829, 1, 1, 1)], 29830), # 4-step mode
+    ([(7457, 1, 0, 0), (14913, 1, 1, 0), (22371, 1, 0, 0), (37281, 1, 1, 0)], 37282), # 5-step mode
+]
+
+# Non linear mixer lookup tables, indexed by pulse1 + pulse2 and by 3 * triangle + 2 * noise + dmc
+PULSE_MIX_TABLE = numpy.array([0.0] + [95.52 / (8128.0 / n + 100) for n in range(1, 31)], dtype=numpy.float32)
+TND_MIX_TABLE = numpy.array([0.0] + [163.67 / (24329.0 / n + 100) for n in range(1, 203)], dtype=numpy.float32)
+
+def build_noise_sequence(mode_bit):
+    '''Return the output bits of the noise shift register, over a whole period starting from state 1'''
+    bits = []
+    shift_register = 1
+    while True:
+        bits.append(shift_register & 1)
+        feedback = (shift_register ^ (shift_register >> mode_bit)) & 1
+        shift_register = (shift_register >> 1) | (feedback << 14)
+        if shift_register == 1:
+            return numpy.array(bits, dtype=numpy.int32)
+
+# Noise output bits for mode 0 (32767 steps) and mode 1 (93 steps)
+NOISE_SEQUENCES = [build_noise_sequence(1), build_noise_sequence(6)]
+
+# Save states layouts
+ENVELOPE_FIELDS = (('envelope_start', 'B'), ('envelope_divider', 'B'), ('envelope_decay', 'B'))
+PULSE_STATE = StateFields(
+    ('enabled', 'B'), ('duty', 'B'), ('halt', 'B'), ('constant_volume', 'B'), ('volume', 'B'),
+    ('timer_period', 'H'), ('length_counter', 'B'), *ENVELOPE_FIELDS,
+    ('sweep_enabled', 'B'), ('sweep_period', 'B'), ('sweep_negate', 'B'), ('sweep_shift', 'B'),
+    ('sweep_reload', 'B'), ('sweep_divider', 'B'), ('phase', 'd'), ('sequencer_reset', 'B'),
+)
+TRIANGLE_STATE = StateFields(
+    ('enabled', 'B'), ('control', 'B'), ('linear_reload_value', 'B'), ('linear_counter', 'B'), ('linear_reload', 'B'),
+    ('timer_period', 'H'), ('length_counter', 'B'), ('phase', 'd'),
+)
+NOISE_STATE = StateFields(
+    ('enabled', 'B'), ('halt', 'B'), ('constant_volume', 'B'), ('volume', 'B'), ('mode', 'B'),
+    ('timer_period', 'H'), ('length_counter', 'B'), *ENVELOPE_FIELDS, ('phase', 'd'),
+)
+DMC_STATE = StateFields(
+    ('irq_enabled', 'B'), ('loop', 'B'), ('rate', 'H'), ('sample_address', 'H'), ('sample_length', 'H'),
+    ('current_address', 'H'), ('bytes_remaining', 'H'), ('shift_register', 'B'), ('bits_remaining', 'B'),
+    ('silence', 'B'), ('output_level', 'B'), ('interrupt', 'B'), ('pending_fetches', 'H'), ('next_clock', 'q'),
+)
+DMC_SAMPLE_BUFFER = struct.Struct('<h') # -1 when empty
+LEVEL_CHANGE_RECORD = struct.Struct('<qB')
+APU_STATE = StateFields(
+    ('frame_counter_mode', 'B'), ('frame_irq_inhibit', 'B'), ('frame_interrupt', 'B'), ('frame_counter_start', 'q'),
+    ('frame_step', 'B'), ('cycle', 'q'), ('sample_cycle', 'd'), ('frame_start_level', 'B'),
+)
+WRITE_RECORD = struct.Struct('<qHB')
+# Segment flattened as start, end, pulse1 and pulse2 (period, duty, volume, reset), triangle (period, running), noise (period, mode, volume)
+SEGMENT_RECORD = struct.Struct('<qqHBBBHBBBHBHBB')
+
+
+class Pulse:
+    '''Pulse channel: timer, duty sequencer, length counter, envelope and sweep units
 
     Args:
-        emulator (nes_emulator): A reference to the emulator used
-        to access memory or other components
+        is_first -- the first pulse channel uses one's complement negation in its sweep unit
+    '''
+    def __init__(self, is_first):
+        self.is_first = is_first
+        self.enabled = 0
+        self.duty = 0
+        self.halt = 0
+        self.constant_volume = 0
+        self.volume = 0
+        self.timer_period = 0
+        self.length_counter = 0
+
+        self.envelope_start = 0
+        self.envelope_divider = 0
+        self.envelope_decay = 0
+
+        self.sweep_enabled = 0
+        self.sweep_period = 0
+        self.sweep_negate = 0
+        self.sweep_shift = 0
+        self.sweep_reload = 0
+        self.sweep_divider = 0
+
+        # Position in the duty sequence, in sequencer steps. Only used by the synthesis
+        self.phase = 0.0
+        # Set when the sequencer is restarted, until the next segment is recorded
+        self.sequencer_reset = 0
+
+    def write(self, register, value):
+        '''Write one of the 4 channel registers'''
+        match register:
+            case 0:
+                self.duty = value >> 6
+                self.halt = (value >> 5) & 1
+                self.constant_volume = (value >> 4) & 1
+                self.volume = value & 0xf
+            case 1:
+                self.sweep_enabled = value >> 7
+                self.sweep_period = (value >> 4) & 0x7
+                self.sweep_negate = (value >> 3) & 1
+                self.sweep_shift = value & 0x7
+                self.sweep_reload = 1
+            case 2:
+                self.timer_period = (self.timer_period & 0x700) | value
+            case 3:
+                self.timer_period = (self.timer_period & 0xff) | ((value & 0x7) << 8)
+                if self.enabled:
+                    self.length_counter = LENGTH_TABLE[value >> 3]
+                self.envelope_start = 1
+                self.sequencer_reset = 1
+
+    def set_enabled(self, enabled):
+        '''Enable or disable the channel through 0x4015'''
+        self.enabled = enabled
+        if not enabled:
+            self.length_counter = 0
+
+    def sweep_target(self):
+        '''Return the period the sweep unit would set'''
+        change = self.timer_period >> self.sweep_shift
+        if self.sweep_negate:
+            return self.timer_period - change - self.is_first
+        return self.timer_period + change
+
+    def clock_quarter_frame(self):
+        '''Clock envelope'''
+        if self.envelope_start:
+            self.envelope_start = 0
+            self.envelope_decay = 15
+            self.envelope_divider = self.volume
+        elif self.envelope_divider == 0:
+            self.envelope_divider = self.volume
+            if self.envelope_decay:
+                self.envelope_decay -= 1
+            elif self.halt:
+                self.envelope_decay = 15
+        else:
+            self.envelope_divider -= 1
+
+    def clock_half_frame(self):
+        '''Clock length counter and sweep'''
+        if self.length_counter and not self.halt:
+            self.length_counter -= 1
+        target = self.sweep_target()
+        if self.sweep_divider == 0 and self.sweep_enabled and self.sweep_shift and self.timer_period >= 8 and target <= 0x7ff:
+            self.timer_period = max(target, 0)
+        if self.sweep_divider == 0 or self.sweep_reload:
+            self.sweep_divider = self.sweep_period
+            self.sweep_reload = 0
+        else:
+            self.sweep_divider -= 1
+
+    def get_segment(self):
+        '''Return (timer period, duty, output volume, sequencer reset) for the synthesis, volume being 0 when muted
+
+        The sequencer reset flag is cleared, as it only applies to the start of the segment being recorded.
+        '''
+        sequencer_reset = self.sequencer_reset
+        self.sequencer_reset = 0
+        if self.length_counter == 0 or self.timer_period < 8 or self.sweep_target() > 0x7ff:
+            return self.timer_period, self.duty, 0, sequencer_reset
+        return self.timer_period, self.duty, self.volume if self.constant_volume else self.envelope_decay, sequencer_reset
+
+    def save_state(self, writer):
+        '''Write the channel state to a save state'''
+        PULSE_STATE.save(writer, self)
+
+    def load_state(self, reader):
+        '''Restore the channel state from a save state'''
+        PULSE_STATE.load(reader, self)
+
+
+class Triangle:
+    '''Triangle channel: timer, 32 steps sequencer, length counter and linear counter'''
+    def __init__(self):
+        self.enabled = 0
+        self.control = 0
+        self.linear_reload_value = 0
+        self.linear_counter = 0
+        self.linear_reload = 0
+        self.timer_period = 0
+        self.length_counter = 0
+
+        # Position in the triangle sequence, in sequencer steps. Only used by the synthesis
+        self.phase = 0.0
+
+    def write(self, register, value):
+        '''Write one of the 4 channel registers'''
+        match register:
+            case 0:
+                self.control = value >> 7
+                self.linear_reload_value = value & 0x7f
+            case 2:
+                self.timer_period = (self.timer_period & 0x700) | value
+            case 3:
+                self.timer_period = (self.timer_period & 0xff) | ((value & 0x7) << 8)
+                if self.enabled:
+                    self.length_counter = LENGTH_TABLE[value >> 3]
+                self.linear_reload = 1
+
+    def set_enabled(self, enabled):
+        '''Enable or disable the channel through 0x4015'''
+        self.enabled = enabled
+        if not enabled:
+            self.length_counter = 0
+
+    def clock_quarter_frame(self):
+        '''Clock linear counter'''
+        if self.linear_reload:
+            self.linear_counter = self.linear_reload_value
+        elif self.linear_counter:
+            self.linear_counter -= 1
+        if not self.control:
+            self.linear_reload = 0
+
+    def clock_half_frame(self):
+        '''Clock length counter'''
+        if self.length_counter and not self.control:
+            self.length_counter -= 1
+
+    def get_segment(self):
+        '''Return (timer period, running) for the synthesis
+
+        The sequencer is halted when a counter is 0. Ultrasonic periods are halted as well
+        instead of being output, to avoid aliasing.
+        '''
+        return self.timer_period, self.length_counter > 0 and self.linear_counter > 0 and self.timer_period >= 2
+
+    def save_state(self, writer):
+        '''Write the channel state to a save state'''
+        TRIANGLE_STATE.save(writer, self)
+
+    def load_state(self, reader):
+        '''Restore the channel state from a save state'''
+        TRIANGLE_STATE.load(reader, self)
+
+
+class Noise:
+    '''Noise channel: timer, shift register, length counter and envelope'''
+    def __init__(self):
+        self.enabled = 0
+        self.halt = 0
+        self.constant_volume = 0
+        self.volume = 0
+        self.mode = 0
+        self.timer_period = NOISE_PERIOD_TABLE[0]
+        self.length_counter = 0
+
+        self.envelope_start = 0
+        self.envelope_divider = 0
+        self.envelope_decay = 0
+
+        # Position in the shift register output sequence. Only used by the synthesis
+        self.phase = 0.0
+
+    def write(self, register, value):
+        '''Write one of the 4 channel registers'''
+        match register:
+            case 0:
+                self.halt = (value >> 5) & 1
+                self.constant_volume = (value >> 4) & 1
+                self.volume = value & 0xf
+            case 2:
+                self.mode = value >> 7
+                self.timer_period = NOISE_PERIOD_TABLE[value & 0xf]
+            case 3:
+                if self.enabled:
+                    self.length_counter = LENGTH_TABLE[value >> 3]
+                self.envelope_start = 1
+
+    def set_enabled(self, enabled):
+        '''Enable or disable the channel through 0x4015'''
+        self.enabled = enabled
+        if not enabled:
+            self.length_counter = 0
+
+    # Envelope unit is the same as pulse channels'
+    clock_quarter_frame = Pulse.clock_quarter_frame
+
+    def clock_half_frame(self):
+        '''Clock length counter'''
+        if self.length_counter and not self.halt:
+            self.length_counter -= 1
+
+    def get_segment(self):
+        '''Return (timer period, mode, output volume) for the synthesis, volume being 0 when muted'''
+        if self.length_counter == 0:
+            return self.timer_period, self.mode, 0
+        return self.timer_period, self.mode, self.volume if self.constant_volume else self.envelope_decay
+
+    def save_state(self, writer):
+        '''Write the channel state to a save state'''
+        NOISE_STATE.save(writer, self)
+
+    def load_state(self, reader):
+        '''Restore the channel state from a save state'''
+        NOISE_STATE.load(reader, self)
 
-    Attributes:
-        emulator (emulator): A reference to the emulator used to
-        access memory or other components
+
+class Dmc:
+    '''Delta modulation channel: memory reader, output unit and IRQ
+
+    Unlike other channels, the DMC is simulated bit by bit since its output depends on
+    sample bytes read from memory. Output level changes are logged for the synthesis.
     '''
     def __init__(self):
-        self.registers = {
-            # Default values that silences all channels at start
-            0x4000 : 0x30,
-            0x4001 : 0x08,
-            0x4002 : 0x00,
-            0x4003 : 0x00,
-            0x4004 : 0x30,
-            0x4005 : 0x08,
-            0x4006 : 0x00,
-            0x4007 : 0x00,
-            0x4008 : 0x30,
-            0x4009 : 0x08,
-            0x400a : 0x00,
-            0x400b : 0x00,
-            0x400c : 0x30,
-            0x400d : 0x08,
-            0x400e : 0x00,
-            0x400f : 0x00,
-            0x4010 : 0x30,
-            0x4011 : 0x08,
-            0x4012 : 0x00,
-            0x4013 : 0x00,
-            0x4015 : 0x0f,
-            0x4017 : 0x40,
-        }
-
-    def next(self):
-        '''Execute next APU cycle'''
-        pass
+        self.irq_enabled = 0
+        self.loop = 0
+        self.rate = DMC_RATE_TABLE[0]
+        self.sample_address = 0xc000
+        self.sample_length = 1
+
+        self.current_address = 0xc000
+        self.bytes_remaining = 0
+        self.sample_buffer = None
+        self.shift_register = 0
+        self.bits_remaining = 8
+        self.silence = 1
+        self.output_level = 0
+        self.interrupt = 0
+        # Sample bytes fetched since the CPU was last stalled for them
+        self.pending_fetches = 0
+
+        # CPU cycle of the next output clock
+        self.next_clock = 0
+        # Output level changes since last synthesis, as (CPU cycle, level)
+        self.level_changes = []
+
+        # Peer components, set by connect
+        self.memory = None
+
+    def connect(self, console):
+        '''Keep direct references to the peer components of console'''
+        self.memory = console.memory
+
+    def write(self, register, value, cycle):
+        '''Write one of the 4 channel registers'''
+        match register:
+            case 0:
+                self.irq_enabled = value >> 7
+                self.loop = (value >> 6) & 1
+                self.rate = DMC_RATE_TABLE[value & 0xf]
+                if not self.irq_enabled:
+                    self.interrupt = 0
+            case 1:
+                self.output_level = value & 0x7f
+                self.level_changes.append((cycle, self.output_level))
+            case 2:
+                self.sample_address = 0xc000 + value * 64
+            case 3:
+                self.sample_length = value * 16 + 1
+
+    def set_enabled(self, enabled):
+        '''Start or stop sample playback through 0x4015'''
+        self.interrupt = 0
+        if not enabled:
+            self.bytes_remaining = 0
+        elif self.bytes_remaining == 0:
+            self.restart()
+            self.fill_buffer()
+
+    def restart(self):
+        '''Restart sample from the beginning'''
+        self.current_address = self.sample_address
+        self.bytes_remaining = self.sample_length
+
+    def fill_buffer(self):
+        '''Memory reader: fetch next sample byte if the buffer is empty'''
+        if self.sample_buffer is not None or self.bytes_remaining == 0:
+            return
+        self.sample_buffer = self.memory.read_rom(self.current_address)
+        self.pending_fetches += 1
+        self.current_address = 0x8000 if self.current_address == 0xffff else self.current_address + 1
+        self.bytes_remaining -= 1
+        if self.bytes_remaining == 0:
+            if self.loop:
+                self.restart()
+            elif self.irq_enabled:
+                self.interrupt = 1
+
+    def run_until(self, cycle):
+        '''Run output clocks until cycle'''
+        if self.next_clock >= cycle:
+            return
+        if self.silence and self.sample_buffer is None and self.bytes_remaining == 0:
+            # Nothing to play, only keep the output clock aligned
+            clocks = -(-(cycle - self.next_clock) // self.rate)
+            self.next_clock += clocks * self.rate
+            self.bits_remaining = (self.bits_remaining - clocks - 1) % 8 + 1
+            return
+        while self.next_clock < cycle:
+            if not self.silence:
+                if self.shift_register & 1:
+                    if self.output_level <= 125:
+                        self.output_level += 2
+                        self.level_changes.append((self.next_clock, self.output_level))
+                elif self.output_level >= 2:
+                    self.output_level -= 2
+                    self.level_changes.append((self.next_clock, self.output_level))
+                self.shift_register >>= 1
+            self.bits_remaining -= 1
+            if self.bits_remaining == 0:
+                self.bits_remaining = 8
+                if self.sample_buffer is None:
+                    self.silence = 1
+                else:
+                    self.silence = 0
+                    self.shift_register = self.sample_buffer
+                    self.sample_buffer = None
+                    self.fill_buffer()
+            self.next_clock += self.rate
+
+    def next_fetch_cycle(self):
+        '''Return the CPU cycle of the next sample byte fetch, math.inf if none is expected'''
+        if self.sample_buffer is None or self.bytes_remaining == 0:
+            return math.inf
+        # Buffer is emptied, and refilled, when the shift register is reloaded
+        return self.next_clock + (self.bits_remaining - 1) * self.rate
+
+    def next_irq_cycle(self):
+        '''Return an estimate, never late, of the CPU cycle of next DMC IRQ. math.inf if none is expected'''
+        if not self.irq_enabled or self.loop or self.bytes_remaining == 0:
+            return math.inf
+        # Last byte is fetched once the buffer is moved to the shift register, one byte every 8 output clocks
+        return self.next_clock + (self.bits_remaining - 1 + 8 * (self.bytes_remaining - 1)) * self.rate
+
+    def save_state(self, writer):
+        '''Write the channel state and its pending level changes to a save state'''
+        DMC_STATE.save(writer, self)
+        writer.write(DMC_SAMPLE_BUFFER.pack(-1 if self.sample_buffer is None else self.sample_buffer))
+        writer.write_records(LEVEL_CHANGE_RECORD, self.level_changes)
+
+    def load_state(self, reader):
+        '''Restore the channel state and its pending level changes from a save state'''
+        DMC_STATE.load(reader, self)
+        (sample_buffer,) = reader.unpack(DMC_SAMPLE_BUFFER)
+        self.sample_buffer = None if sample_buffer < 0 else sample_buffer
+        self.level_changes = reader.read_records(LEVEL_CHANGE_RECORD)
+
+
+class Apu:
+    '''The emulator APU module class
+
+    The APU is not stepped along with the CPU. Register writes are logged with their CPU cycle, then
+    applied in order along with the frame counter steps whenever the APU is run until a given cycle.
+    Channel parameters are constant between two such events: each of these segments is recorded and
+    samples for a whole frame are synthesized at once with numpy.
+    '''
+    def __init__(self):
+        self.pulse1 = Pulse(1)
+        self.pulse2 = Pulse(0)
+        self.triangle = Triangle()
+        self.noise = Noise()
+        self.dmc = Dmc()
+
+        self.frame_counter_mode = 0
+        self.frame_irq_inhibit = 0
+        self.frame_interrupt = 0
+        self.frame_counter_start = 0
+        self.frame_step = 0
+
+        # Pending register writes, as (CPU cycle, register, value)
+        self.writes = []
+        # Cycle up to which the APU has been run
+        self.cycle = 0
+        # Channel parameters segments since last synthesis, as (start, end, pulse1, pulse2, triangle, noise)
+        self.segments = []
+
+        # Synthesis state
+        self.sample_cycle = 0.0 # CPU cycle of next sample
+        self.frame_start_level = 0 # DMC output level at the start of the frame being synthesized
+        self.samples = numpy.zeros(0, dtype=numpy.float32) # Samples of the last synthesized frame
+
+        # Peer components, set by connect
+        self.cpu = None
+        self.nes = None
+
+    def connect(self, console):
+        '''Keep direct references to the peer components of console'''
+        self.cpu = console.cpu
+        self.nes = console.nes
+        self.dmc.connect(console)
 
     def read_register(self, register):
         '''Read the register given as argument
@@ -58,13 +526,240 @@ class Apu:
         Returns:
             The value of the register
         '''
-        return self.registers[register]
+        if register != 0x4015:
+            return 0x40 # Write only registers, open bus
+        self.run_until(self.cpu.total_cycles)
+        value = (self.pulse1.length_counter > 0) | ((self.pulse2.length_counter > 0) << 1) \
+            | ((self.triangle.length_counter > 0) << 2) | ((self.noise.length_counter > 0) << 3) \
+            | ((self.dmc.bytes_remaining > 0) << 4) | (self.frame_interrupt << 6) | (self.dmc.interrupt << 7)
+        self.frame_interrupt = 0
+        self.update_irq_line()
+        return value
 
     def write_register(self, register, value):
-        '''Write value in the given register
+        '''Log a write in the given register, to be applied when the APU runs past the current cycle
 
         Args:
             register -- the register address
             value  -- the value to set in the register
         '''
-        self.registers[register] = value
+        cycle = self.cpu.total_cycles
+        self.writes.append((cycle, register, value))
+        if register in (0x4010, 0x4015, 0x4017):
+            # Those writes change when the next IRQ happens
+            self.run_until(cycle)
+
+    def apply_write(self, register, value, cycle):
+        '''Apply a logged register write'''
+        match register:
+            case 0x4000 | 0x4001 | 0x4002 | 0x4003: self.pulse1.write(register & 3, value)
+            case 0x4004 | 0x4005 | 0x4006 | 0x4007: self.pulse2.write(register & 3, value)
+            case 0x4008 | 0x4009 | 0x400a | 0x400b: self.triangle.write(register & 3, value)
+            case 0x400c | 0x400d | 0x400e | 0x400f: self.noise.write(register & 3, value)
+            case 0x4010 | 0x4011 | 0x4012 | 0x4013: self.dmc.write(register & 3, value, cycle)
+            case 0x4015:
+                self.pulse1.set_enabled(value & 1)
+                self.pulse2.set_enabled((value >> 1) & 1)
+                self.triangle.set_enabled((value >> 2) & 1)
+                self.noise.set_enabled((value >> 3) & 1)
+                self.dmc.set_enabled((value >> 4) & 1)
+            case 0x4017:
+                self.frame_counter_mode = value >> 7
+                self.frame_irq_inhibit = (value >> 6) & 1
+                if self.frame_irq_inhibit:
+                    self.frame_interrupt = 0
+                # Sequencer restarts 3 or 4 cycles after the write, 5-step mode immediately clocks all units
+                self.frame_counter_start = cycle + 3
+                self.frame_step = 0
+                if self.frame_counter_mode:
+                    self.clock_quarter_frame()
+                    self.clock_half_frame()
+
+    def clock_quarter_frame(self):
+        '''Clock envelopes and triangle linear counter'''
+        self.pulse1.clock_quarter_frame()
+        self.pulse2.clock_quarter_frame()
+        self.triangle.clock_quarter_frame()
+        self.noise.clock_quarter_frame()
+
+    def clock_half_frame(self):
+        '''Clock length counters and sweeps'''
+        self.pulse1.clock_half_frame()
+        self.pulse2.clock_half_frame()
+        self.triangle.clock_half_frame()
+        self.noise.clock_half_frame()
+
+    def run_until(self, cycle):
+        '''Apply logged writes and frame counter steps in order, up to cycle, and record the segments between them'''
+        writes = self.writes
+        write_index = 0
+        while True:
+            steps, sequence_length = FRAME_COUNTER_STEPS[self.frame_counter_mode]
+            step_cycle, is_quarter, is_half, is_irq = steps[self.frame_step]
+            step_cycle += self.frame_counter_start
+            if write_index < len(writes) and writes[write_index][0] <= step_cycle:
+                event_cycle = max(writes[write_index][0], self.cycle)
+                if event_cycle > cycle:
+                    break
+                self.end_segment(event_cycle)
+                self.apply_write(writes[write_index][1], writes[write_index][2], event_cycle)
+                write_index += 1
+            else:
+                if step_cycle > cycle:
+                    break
+                self.end_segment(step_cycle)
+                if is_quarter:
+                    self.clock_quarter_frame()
+                if is_half:
+                    self.clock_half_frame()
+                if is_irq and not self.frame_irq_inhibit:
+                    self.frame_interrupt = 1
+                self.frame_step += 1
+                if self.frame_step == len(steps):
+                    self.frame_step = 0
+                    self.frame_counter_start += sequence_length
+        del writes[:write_index]
+        self.end_segment(cycle)
+        self.update_irq_line()
+        self.update_events()
+
+    def update_irq_line(self):
+        '''Drive the IRQ line from the frame counter and DMC interrupt flags
+
+        The line is asserted as long as one of them is set, and released once both are
+        acknowledged: by reading 0x4015, setting the frame IRQ inhibit flag, or disabling the DMC or its IRQ.
+        '''
+        self.nes.set_irq_line(self.frame_interrupt or self.dmc.interrupt)
+
+    def end_segment(self, cycle):
+        '''Record channel parameters from current cycle to the given one'''
+        if cycle <= self.cycle:
+            return
+        self.dmc.run_until(cycle)
+        self.segments.append((self.cycle, cycle, self.pulse1.get_segment(), self.pulse2.get_segment(), self.triangle.get_segment(), self.noise.get_segment()))
+        self.cycle = cycle
+
+    def update_events(self):
+        '''Schedule the emulator events running the APU just in time for its next IRQ and DMC fetch'''
+        next_irq_cycle = self.dmc.next_irq_cycle()
+        if self.frame_counter_mode == 0 and not self.frame_irq_inhibit:
+            steps, _ = FRAME_COUNTER_STEPS[0]
+            next_irq_cycle = min(next_irq_cycle, self.frame_counter_start + steps[-1][0])
+        if next_irq_cycle == math.inf:
+            self.nes.cancel_event('apu_irq')
+        else:
+            self.nes.schedule_event('apu_irq', next_irq_cycle, self.on_irq_event)
+
+        next_fetch_cycle = self.dmc.next_fetch_cycle()
+        if next_fetch_cycle == math.inf:
+            self.nes.cancel_event('dmc_dma')
+        else:
+            self.nes.schedule_event('dmc_dma', next_fetch_cycle, self.on_dmc_dma_event)
+
+    def on_irq_event(self, cycle):
+        '''Run the APU up to an expected IRQ'''
+        self.run_until(cycle + 1)
+
+    def on_dmc_dma_event(self, cycle):
+        '''Run the APU up to the next DMC fetch, and stall the CPU 4 cycles per byte fetched'''
+        self.run_until(cycle + 1)
+        self.nes.stall_cpu(4 * self.dmc.pending_fetches)
+        self.dmc.pending_fetches = 0
+
+    def save_state(self, writer):
+        '''Write channels, frame counter, pending writes and segments to a save state
+
+        Scheduled APU events are saved along with the emulator ones.
+        '''
+        for channel in (self.pulse1, self.pulse2, self.triangle, self.noise, self.dmc):
+            channel.save_state(writer)
+        APU_STATE.save(writer, self)
+        writer.write_records(WRITE_RECORD, self.writes)
+        writer.write_records(SEGMENT_RECORD, [(start, end, *pulse1, *pulse2, *triangle, *noise)
+                                              for start, end, pulse1, pulse2, triangle, noise in self.segments])
+
+    def load_state(self, reader):
+        '''Restore channels, frame counter, pending writes and segments from a save state'''
+        for channel in (self.pulse1, self.pulse2, self.triangle, self.noise, self.dmc):
+            channel.load_state(reader)
+        APU_STATE.load(reader, self)
+        self.writes = reader.read_records(WRITE_RECORD)
+        self.segments = [(segment[0], segment[1], segment[2:6], segment[6:10], segment[10:12], segment[12:15])
+                         for segment in reader.read_records(SEGMENT_RECORD)]
+
+    def end_frame(self, cycle):
+        '''Run the APU until cycle and synthesize the samples of the frame
+
+        Returns:
+            A float32 numpy array of the samples between previous call and cycle
+        '''
+        self.run_until(cycle)
+        sample_count = max(0, math.ceil((cycle - self.sample_cycle) / CYCLES_PER_SAMPLE))
+        times = self.sample_cycle + numpy.arange(sample_count) * CYCLES_PER_SAMPLE
+        self.sample_cycle += sample_count * CYCLES_PER_SAMPLE
+
+        pulse = numpy.zeros(sample_count, dtype=numpy.int32)
+        tnd = numpy.zeros(sample_count, dtype=numpy.int32)
+        for start, end, pulse1, pulse2, triangle, noise in self.segments:
+            if pulse1[3]:
+                self.pulse1.phase = 0.0
+            if pulse2[3]:
+                self.pulse2.phase = 0.0
+            first, last = numpy.searchsorted(times, (start, end))
+            if first == last:
+                self.advance_phases(start, end, pulse1, pulse2, triangle, noise)
+                continue
+            elapsed = times[first:last] - start
+            pulse[first:last] = self.synthesize_pulse(self.pulse1, pulse1, elapsed) + self.synthesize_pulse(self.pulse2, pulse2, elapsed)
+            tnd[first:last] = 3 * self.synthesize_triangle(triangle, elapsed) + 2 * self.synthesize_noise(noise, elapsed)
+            self.advance_phases(start, end, pulse1, pulse2, triangle, noise)
+        self.segments = []
+
+        tnd += self.synthesize_dmc(times)
+        self.samples = PULSE_MIX_TABLE[pulse] + TND_MIX_TABLE[tnd]
+        return self.samples
+
+    def synthesize_pulse(self, channel, segment, elapsed):
+        '''Pulse channel output (0 to 15) at elapsed cycles from segment start'''
+        timer_period, duty, volume, _ = segment
+        if volume == 0:
+            return 0
+        steps = (channel.phase + elapsed / (2 * (timer_period + 1))).astype(numpy.int32) & 7
+        return DUTY_TABLE[duty][steps] * volume
+
+    def synthesize_triangle(self, segment, elapsed):
+        '''Triangle channel output (0 to 15) at elapsed cycles from segment start'''
+        timer_period, running = segment
+        if not running:
+            return TRIANGLE_TABLE[int(self.triangle.phase) & 31]
+        steps = (self.triangle.phase + elapsed / (timer_period + 1)).astype(numpy.int32) & 31
+        return TRIANGLE_TABLE[steps]
+
+    def synthesize_noise(self, segment, elapsed):
+        '''Noise channel output (0 to 15) at elapsed cycles from segment start'''
+        timer_period, mode, volume = segment
+        if volume == 0:
+            return 0
+        sequence = NOISE_SEQUENCES[mode]
+        steps = (self.noise.phase + elapsed / timer_period).astype(numpy.int64) % len(sequence)
+        return (1 - sequence[steps]) * volume
+
+    def synthesize_dmc(self, times):
+        '''DMC output level (0 to 127) at each sample time, from the logged level changes'''
+        changes = self.dmc.level_changes
+        if not changes:
+            return self.frame_start_level
+        change_cycles = numpy.array([change[0] for change in changes], dtype=numpy.float64)
+        levels = numpy.array([self.frame_start_level] + [change[1] for change in changes], dtype=numpy.int32)
+        self.frame_start_level = changes[-1][1]
+        self.dmc.level_changes = []
+        return levels[numpy.searchsorted(change_cycles, times, side='right')]
+
+    def advance_phases(self, start, end, pulse1, pulse2, triangle, noise):
+        '''Move the sequencers phases to the end of a segment'''
+        elapsed = end - start
+        self.pulse1.phase = (self.pulse1.phase + elapsed / (2 * (pulse1[0] + 1))) % 8
+        self.pulse2.phase = (self.pulse2.phase + elapsed / (2 * (pulse2[0] + 1))) % 8
+        if triangle[1]:
+            self.triangle.phase = (self.triangle.phase + elapsed / (triangle[0] + 1)) % 32
+        self.noise.phase = (self.noise.phase + elapsed / noise[0]) % len(NOISE_SEQUENCES[0])
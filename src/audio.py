@@ -0,0 +1,183 @@
+'''Audio output sinks'''
+import sys
+import time
+import numpy
+from apu import SAMPLE_RATE
+
+# Preventing direct execution
+if __name__ == '__main__':
+    print("This module cannot be executed. Please use main.py")
+    sys.exit()
+
+# Buffered audio the emulation keeps ahead of playback, in samples
+TARGET_LATENCY = SAMPLE_RATE // 20
+RING_BUFFER_SIZE = 4 * TARGET_LATENCY
+# Maximum resampling ratio adjustment, small enough not to be heard as a pitch change
+MAX_RATE_DELTA = 0.005
+
+class RingBuffer:
+    '''Single producer, single consumer float32 ring buffer
+
+    The producer only updates write_count and the consumer only updates read_count, so that the
+    emulation thread and the audio callback thread never need a lock.
+    '''
+    def __init__(self, size):
+        self.buffer = numpy.zeros(size, dtype=numpy.float32)
+        self.size = size
+        self.write_count = 0
+        self.read_count = 0
+
+    def get_occupancy(self):
+        '''Return the number of samples waiting to be read'''
+        return self.write_count - self.read_count
+
+    def write(self, samples):
+        '''Write as many samples as there is room for. Returns the number of samples written'''
+        count = min(len(samples), self.size - self.get_occupancy())
+        start = self.write_count % self.size
+        first = min(count, self.size - start)
+        self.buffer[start:start + first] = samples[:first]
+        self.buffer[:count - first] = samples[first:count]
+        self.write_count += count
+        return count
+
+    def read(self, out):
+        '''Fill out with available samples, and silence once the buffer is empty. Returns the number of samples read'''
+        count = min(len(out), self.get_occupancy())
+        start = self.read_count % self.size
+        first = min(count, self.size - start)
+        out[:first] = self.buffer[start:start + first]
+        out[first:count] = self.buffer[:count - first]
+        out[count:] = 0
+        self.read_count += count
+        return count
+
+
+class AudioOutput:
+    '''Base audio sink: the emulation pushes each frame samples, played from a ring buffer
+
+    The resampling ratio is adjusted slightly on each push so that the buffer fill level stays around
+    TARGET_LATENCY. When throttled, pushing waits for playback to catch up, which paces the emulation
+    to real time.
+
+    Args:
+        throttle -- wait for the buffer to drain down to the target fill level after each push
+    '''
+    def __init__(self, throttle):
+        self.throttle = throttle
+        self.ring_buffer = RingBuffer(RING_BUFFER_SIZE)
+        self.ratio = 1.0
+        self.remainder = 0.0 # Fraction of output sample carried over from previous push
+        self.underruns = 0
+        self.overruns = 0
+
+    def get_pending(self):
+        '''Return the number of samples waiting to be played'''
+        return self.ring_buffer.get_occupancy()
+
+    def get_occupancy(self):
+        '''Return the buffer fill level, as a fraction of its size'''
+        return self.get_pending() / RING_BUFFER_SIZE
+
+    def push(self, samples):
+        '''Resample and queue samples for playback'''
+        occupancy = self.get_pending()
+        self.ratio = 1.0 + MAX_RATE_DELTA * max(-1.0, min(1.0, (TARGET_LATENCY - occupancy) / TARGET_LATENCY))
+        exact_count = len(samples) * self.ratio + self.remainder
+        count = int(exact_count)
+        self.remainder = exact_count - count
+        if count and len(samples):
+            positions = numpy.arange(count) * (len(samples) / count)
+            samples = numpy.interp(positions, numpy.arange(len(samples)), samples).astype(numpy.float32)
+        if self.ring_buffer.write(samples[:count]) < count:
+            self.overruns += 1
+        if self.throttle:
+            self.wait()
+
+    def wait(self):
+        '''Sleep until the buffer has drained down to the target fill level'''
+        while True:
+            excess = self.get_pending() - TARGET_LATENCY
+            if excess <= 0:
+                return
+            time.sleep(excess / SAMPLE_RATE)
+
+    def close(self):
+        '''Stop playback'''
+
+
+class NullAudio(AudioOutput):
+    '''Audio sink without device
+
+    Samples are consumed at the real time rate when throttled, so that the emulation is still paced.
+    Otherwise they are dropped as soon as they are pushed.
+    '''
+    def __init__(self, throttle):
+        super().__init__(throttle)
+        self.start_time = time.perf_counter()
+
+    def push(self, samples):
+        '''Queue samples, or drop them when not throttled'''
+        if not self.throttle:
+            return
+        super().push(samples)
+
+    def drain(self):
+        '''Consume the samples a device would have played since start'''
+        played = int((time.perf_counter() - self.start_time) * SAMPLE_RATE)
+        ring_buffer = self.ring_buffer
+        count = min(played - ring_buffer.read_count, ring_buffer.get_occupancy())
+        if count < played - ring_buffer.read_count:
+            # Buffer ran empty, playback would have stalled
+            self.underruns += 1
+            self.start_time = time.perf_counter() - (ring_buffer.read_count + count) / SAMPLE_RATE
+        ring_buffer.read_count += count
+
+    def get_pending(self):
+        '''Return the number of samples waiting to be played'''
+        self.drain()
+        return self.ring_buffer.get_occupancy()
+
+
+class SoundDeviceAudio(AudioOutput):
+    '''Audio sink playing through a sounddevice output stream callback
+
+    Args:
+        sounddevice -- the sounddevice module
+    '''
+    def __init__(self, sounddevice):
+        super().__init__(1)
+        self.stream = sounddevice.OutputStream(samplerate=SAMPLE_RATE, channels=1, dtype='float32', callback=self.callback)
+        self.stream.start()
+
+    def callback(self, outdata, frames, time_info, status):
+        '''Called from the audio thread to get the next frames to play'''
+        if self.ring_buffer.read(outdata[:, 0]) < frames:
+            self.underruns += 1
+
+    def close(self):
+        '''Stop playback'''
+        self.stream.stop()
+        self.stream.close()
+
+
+def create_audio_sink(headless):
+    '''Return the audio sink to use
+
+    Headless runs drop samples and are not paced. Otherwise, samples are played through sounddevice
+    when it is installed, and consumed in real time without sound when it is not.
+    '''
+    if headless:
+        return NullAudio(0)
+    try:
+        # Disabling import-outside-toplevel pylint control, sounddevice is an optional dependency
+        # pylint: disable=C0415
+        import sounddevice
+    except (ImportError, OSError):
+        # Not installed, or PortAudio library missing
+        return NullAudio(1)
+    try:
+        return SoundDeviceAudio(sounddevice)
+    except sounddevice.PortAudioError:
+        # No output device available
+        return NullAudio(1)
@@ -0,0 +1,157 @@
+'''Parallel headless batch runner'''
+import sys
+import json
+import time
+import hashlib
+import optparse
+import multiprocessing
+import concurrent.futures
+from console import Console
+from movie import Movie
+
+# Preventing direct execution
+if __name__ == '__main__':
+    print("This module cannot be executed. Please use main.py")
+    sys.exit()
+
+DEFAULT_FRAMES = 600
+DEFAULT_SCHEDULER = 'block'
+DEFAULT_RENDERER = 'scanline'
+
+def load_inputs(file_name):
+    '''Read an input file: two bytes per frame, the controller 1 and controller 2 status'''
+    with open(file_name, 'rb') as stream:
+        return stream.read()
+
+def run_job(job):
+    '''Run a job in a new headless console
+
+    Args:
+        job -- dictionary with the keys:
+            rom -- ROM file name
+            frames -- number of frames to run. Defaults to the input file length, or DEFAULT_FRAMES
+            inputs -- optional input file to replay, see load_inputs
+            movie -- optional movie file to replay, see movie.Movie. frames defaults to its length
+            scheduler, renderer -- emulation settings, DEFAULT_SCHEDULER and DEFAULT_RENDERER by default
+
+    Returns:
+        A dictionary with the ROM, frames and CPU cycles run, the time taken, frames per second
+        and the SHA1 of the final internal RAM and frame. When replaying a movie, movie_check
+        tells whether the final RAM matches the recording
+    '''
+    console = Console(1)
+    console.load_rom(job['rom'])
+    nes = console.nes
+    nes.set_scheduler_mode(job.get('scheduler', DEFAULT_SCHEDULER))
+    console.ppu.set_renderer(job.get('renderer', DEFAULT_RENDERER))
+
+    movie = Movie.load(job['movie']) if job.get('movie') else None
+    if movie:
+        nes.play_movie(movie)
+    inputs = load_inputs(job['inputs']) if job.get('inputs') else b''
+    frames = job.get('frames') or (movie and movie.get_frame_count()) or len(inputs) // 2 or DEFAULT_FRAMES
+    if inputs:
+        def apply_inputs():
+            '''Frame listener setting the controllers from the input file'''
+            offset = 2 * nes.frame_count
+            nes.ctrl1.status, nes.ctrl2.status = inputs[offset:offset + 2] if offset + 2 <= len(inputs) else (0, 0)
+        apply_inputs()
+        nes.frame_listeners.append(apply_inputs)
+
+    start = time.perf_counter()
+    nes.power_on()
+    first_frame = nes.frame_count
+    # A movie replay stops the emulation on its last frame
+    while nes.frame_count - first_frame < frames and nes.running:
+        nes.run_frame()
+    elapsed = time.perf_counter() - start
+    frames = nes.frame_count - first_frame
+
+    frame = nes.video.frame
+    result = {
+        'rom': job['rom'],
+        'frames': frames,
+        'cycles': console.cpu.total_cycles,
+        'seconds': round(elapsed, 3),
+        'fps': round(frames / elapsed, 1) if elapsed else None,
+        'ram_hash': hashlib.sha1(console.memory.internal_ram).hexdigest(),
+        'frame_hash': hashlib.sha1(frame).hexdigest() if frame is not None else None,
+    }
+    if movie:
+        result['movie_check'] = nes.movie.check()
+    return result
+
+def write_json_line(stream, record):
+    '''Write a record as a JSON line, flushed at once so that progress can be followed'''
+    stream.write(json.dumps(record) + '\n')
+    stream.flush()
+
+def run_batch(jobs, workers = None, progress = None):
+    '''Run jobs in a pool of worker processes, one console per job
+
+    Args:
+        jobs -- list of job dictionaries, see run_job
+        workers -- number of worker processes, the number of CPUs by default
+        progress -- optional text stream receiving a JSON line per completed job and a summary line
+
+    Returns:
+        The list of job results, in jobs order. A failed job result holds its ROM and an error message
+    '''
+    # Workers are forked where possible, so that main.py is not executed again in each of them
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    results = [None] * len(jobs)
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = {executor.submit(run_job, job): index for index, job in enumerate(jobs)}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            index = futures[future]
+            try:
+                result = future.result()
+            # Disabling broad-except pylint control, any error is reported in the job result
+            # pylint: disable=W0703
+            except Exception as exception:
+                result = {'rom': jobs[index].get('rom'), 'error': str(exception)}
+            results[index] = {'job': index, **result}
+            if progress:
+                write_json_line(progress, {'event': 'job', 'done': done, 'total': len(jobs), **results[index]})
+
+    if progress:
+        elapsed = time.perf_counter() - start
+        frames = sum(result.get('frames', 0) for result in results)
+        write_json_line(progress, {
+            'event': 'done',
+            'jobs': len(jobs),
+            'errors': sum('error' in result for result in results),
+            'frames': frames,
+            'seconds': round(elapsed, 3),
+            'fps': round(frames / elapsed, 1) if elapsed else None,
+        })
+    return results
+
+def main(arguments):
+    '''batch subcommand: run the same job on each ROM given, or the jobs of a JSON file
+
+    Returns:
+        The process exit status, 1 if a job failed
+    '''
+    parser = optparse.OptionParser(usage='usage: %prog batch [options] Rom_filename...')
+    parser.add_option('-f', '--frames', type="int", default=0, help=f'Frames to run per ROM, {DEFAULT_FRAMES} by default', action="store", dest="frames")
+    parser.add_option('-i', '--inputs', type="str", default=None, help='Input file to replay, two bytes per frame', action="store", dest="inputs")
+    parser.add_option('-m', '--movie', type="str", default=None, help='Movie file to replay', action="store", dest="movie")
+    parser.add_option('-j', '--jobs', type="str", default=None, help='JSON file holding a list of jobs, instead of ROM file names', action="store", dest="jobs")
+    parser.add_option('-w', '--workers', type="int", default=None, help='Number of worker processes, the number of CPUs by default', action="store", dest="workers")
+    parser.add_option('-s', '--scheduler', type="choice", choices=['cycle', 'instruction', 'block'], default=DEFAULT_SCHEDULER, help=f'Scheduler mode, {DEFAULT_SCHEDULER} by default', action="store", dest="scheduler")
+    parser.add_option('-r', '--renderer', type="choice", choices=['dot', 'scanline'], default=DEFAULT_RENDERER, help=f'PPU renderer, {DEFAULT_RENDERER} by default', action="store", dest="renderer")
+    (options, args) = parser.parse_args(arguments)
+
+    if options.jobs:
+        with open(options.jobs, 'r') as stream:
+            jobs = json.load(stream)
+    else:
+        jobs = [{'rom': rom, 'frames': options.frames, 'inputs': options.inputs, 'movie': options.movie,
+                 'scheduler': options.scheduler, 'renderer': options.renderer} for rom in args]
+    if not jobs:
+        parser.error("No ROM given")
+
+    results = run_batch(jobs, options.workers, sys.stdout)
+    return 1 if any('error' in result for result in results) else 0
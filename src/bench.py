@@ -0,0 +1,213 @@
+'''Benchmark suite: fixed headless workloads, timed with repeats and compared to a baseline'''
+import sys
+import os
+import json
+import time
+import datetime
+import optparse
+import statistics
+import multiprocessing
+import concurrent.futures
+from console import Console
+from movie import Movie
+
+try:
+    # Not available on Windows, where peak RSS is not reported
+    import resource
+except ImportError:
+    resource = None
+
+# Preventing direct execution
+if __name__ == '__main__':
+    print("This module cannot be executed. Please use main.py")
+    sys.exit()
+
+NESTEST_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests', 'nestest.log.txt')
+NESTEST_ENTRY_POINT = 0xC000 # Automated mode, no PPU needed
+DEFAULT_FRAMES = 300
+DEFAULT_REPEATS = 3
+DEFAULT_HISTORY = 'bench_history.json'
+DEFAULT_THRESHOLD = 10 # Percent of throughput lost before failing
+# Throughput metrics compared against the baseline
+METRICS = ('instructions_per_second', 'fps')
+
+def get_peak_rss():
+    '''Return the peak resident set size of the process in bytes, None when unknown'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def run_workload(workload):
+    '''Run a workload in a new headless console
+
+    Args:
+        workload -- dictionary with the keys:
+            kind -- 'nestest' to run instructions from the nestest automated mode entry point,
+            'frames' to run frames without input, 'movie' to replay a movie
+            rom -- ROM file name
+            instructions, frames, movie -- amount of work of the nestest, frames and movie kinds
+            scheduler, renderer -- emulation settings
+
+    Returns:
+        A dictionary with the instructions and frames run, the time taken and the peak RSS
+    '''
+    console = Console(1)
+    console.load_rom(workload['rom'])
+    nes = console.nes
+    cpu = console.cpu
+    nes.set_scheduler_mode(workload['scheduler'])
+    console.ppu.set_renderer(workload['renderer'])
+
+    if workload['kind'] == 'movie':
+        nes.play_movie(Movie.load(workload['movie']))
+
+    start = time.perf_counter()
+    # A movie may start from a save state, counters are taken after power on
+    nes.power_on(NESTEST_ENTRY_POINT if workload['kind'] == 'nestest' else None)
+    first_instruction = cpu.compteur
+    first_frame = nes.frame_count
+    match workload['kind']:
+        case 'nestest':
+            while cpu.compteur - first_instruction < workload['instructions']:
+                nes.run_until_deadline()
+                nes.run_events()
+        case 'frames':
+            for _ in range(workload['frames']):
+                nes.run_frame()
+        case 'movie':
+            while nes.running:
+                nes.run_frame()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'instructions': cpu.compteur - first_instruction,
+        'frames': nes.frame_count - first_frame,
+        'seconds': elapsed,
+        'peak_rss': get_peak_rss(),
+    }
+
+def summarize(values):
+    '''Return the median, min, max and standard deviation of values'''
+    return {
+        'median': statistics.median(values),
+        'min': min(values),
+        'max': max(values),
+        'stdev': statistics.stdev(values) if len(values) > 1 else 0.0,
+    }
+
+def run_repeats(workload, repeats):
+    '''Run a workload repeats times, each in a new worker process so that its peak RSS is its own
+
+    Returns:
+        Statistics over the repeats of instructions per second, and of frames per second for
+        workloads running frames, with the highest peak RSS
+    '''
+    # Workers are forked where possible, so that main.py is not executed again in each of them
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    runs = []
+    for _ in range(repeats):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            runs.append(executor.submit(run_workload, workload).result())
+
+    result = {'instructions_per_second': summarize([run['instructions'] / run['seconds'] for run in runs])}
+    if workload['kind'] != 'nestest':
+        result['fps'] = summarize([run['frames'] / run['seconds'] for run in runs])
+    peaks = [run['peak_rss'] for run in runs if run['peak_rss'] is not None]
+    result['peak_rss'] = max(peaks) if peaks else None
+    return result
+
+def load_json(file_name, default):
+    '''Return the content of a JSON file, or default if it does not exist'''
+    if not os.path.exists(file_name):
+        return default
+    with open(file_name, 'r') as stream:
+        return json.load(stream)
+
+def write_json(file_name, content):
+    '''Write content to a JSON file'''
+    with open(file_name, 'w') as stream:
+        json.dump(content, stream, indent=1)
+
+def find_regressions(results, baseline, threshold):
+    '''Return the (workload, metric, baseline median, median) of the throughputs which dropped
+    more than threshold percent below the baseline
+    '''
+    regressions = []
+    for name, result in results.items():
+        for metric in METRICS:
+            if metric not in result or metric not in baseline.get(name, {}):
+                continue
+            reference = baseline[name][metric]['median']
+            median = result[metric]['median']
+            if median < reference * (1 - threshold / 100):
+                regressions.append((name, metric, reference, median))
+    return regressions
+
+def main(arguments):
+    '''bench subcommand: run the workloads, print and record their results
+
+    Returns:
+        The process exit status, 1 if a throughput regressed past the threshold
+    '''
+    parser = optparse.OptionParser(usage='usage: %prog bench [options] [Rom_filename]')
+    parser.add_option('--nestest', type="str", default=None, help='nestest ROM, to run as many instructions as the nestest log has lines', action="store", dest="nestest", metavar="ROM")
+    parser.add_option('--log', type="str", default=NESTEST_LOG, help='nestest reference log, tests/nestest.log.txt by default', action="store", dest="log")
+    parser.add_option('-f', '--frames', type="int", default=DEFAULT_FRAMES, help=f'Frames to run on the ROM without input, {DEFAULT_FRAMES} by default. 0 to skip', action="store", dest="frames")
+    parser.add_option('-m', '--movie', type="str", default=None, help='Movie to replay on the ROM', action="store", dest="movie")
+    parser.add_option('-n', '--repeats', type="int", default=DEFAULT_REPEATS, help=f'Runs of each workload, {DEFAULT_REPEATS} by default', action="store", dest="repeats")
+    parser.add_option('-s', '--scheduler', type="choice", choices=['cycle', 'instruction', 'block'], default='block', help='Scheduler mode, block by default', action="store", dest="scheduler")
+    parser.add_option('-r', '--renderer', type="choice", choices=['dot', 'scanline'], default='scanline', help='PPU renderer, scanline by default', action="store", dest="renderer")
+    parser.add_option('--history', type="str", default=DEFAULT_HISTORY, help=f'JSON file results are appended to, {DEFAULT_HISTORY} by default', action="store", dest="history")
+    parser.add_option('--baseline', type="str", default=None, help='JSON file of the baseline results to compare to', action="store", dest="baseline")
+    parser.add_option('--update-baseline', default=False, help='Write the results as the new baseline', action="store_true", dest="update_baseline")
+    parser.add_option('--threshold', type="float", default=DEFAULT_THRESHOLD, help=f'Throughput drop from the baseline failing the run, in percent, {DEFAULT_THRESHOLD} by default', action="store", dest="threshold")
+    (options, args) = parser.parse_args(arguments)
+
+    settings = {'scheduler': options.scheduler, 'renderer': options.renderer}
+    workloads = {}
+    if options.nestest:
+        with open(options.log, 'r') as stream:
+            instructions = sum(1 for _ in stream)
+        workloads['nestest'] = {'kind': 'nestest', 'rom': options.nestest, 'instructions': instructions, **settings}
+    if args and options.frames:
+        workloads['frames'] = {'kind': 'frames', 'rom': args[0], 'frames': options.frames, **settings}
+    if args and options.movie:
+        workloads['movie'] = {'kind': 'movie', 'rom': args[0], 'movie': options.movie, **settings}
+    if not workloads:
+        parser.error("No workload: give a ROM, or a nestest ROM")
+    if options.update_baseline and not options.baseline:
+        parser.error("--update-baseline needs --baseline")
+
+    results = {}
+    for name, workload in workloads.items():
+        results[name] = result = run_repeats(workload, options.repeats)
+        line = f"{name:8} {result['instructions_per_second']['median']:12.0f} instr/s"
+        if 'fps' in result:
+            line += f" {result['fps']['median']:8.1f} FPS (stdev {result['fps']['stdev']:.1f})"
+        if result['peak_rss'] is not None:
+            line += f" peak RSS {result['peak_rss'] / (1024 * 1024):.1f} MB"
+        print(line)
+
+    history = load_json(options.history, [])
+    history.append({
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'repeats': options.repeats,
+        'workloads': workloads,
+        'results': results,
+    })
+    write_json(options.history, history)
+
+    status = 0
+    if options.baseline:
+        baseline = load_json(options.baseline, None)
+        if baseline is None:
+            print(f"No baseline in {options.baseline}")
+        else:
+            for name, metric, reference, median in find_regressions(results, baseline, options.threshold):
+                print(f"Regression: {name} {metric} {median:.1f} instead of {reference:.1f}, {100 * (1 - median / reference):.1f}% slower")
+                status = 1
+        if options.update_baseline:
+            write_json(options.baseline, results)
+    return status
@@ -0,0 +1,158 @@
+'''Basic block translation cache for code executed from PRG ROM'''
+import sys
+from cpu_opcodes import OPCODES
+from block_compiler import compile_instruction
+
+# Preventing direct execution
+if __name__ == '__main__':
+    print("This module cannot be executed. Please use main.py")
+    sys.exit()
+
+# Opcodes ending a block: branches, jumps, subroutine and interrupt calls and returns.
+# CLI and PLP also end a block so that a pending IRQ is serviced as soon as it is unmasked.
+BLOCK_ENDING_OPCODES = {
+    0x10, 0x30, 0x50, 0x70, 0x90, 0xb0, 0xd0, 0xf0, # Relative branches
+    0x4c, 0x6c, 0x20, 0x60, 0x40, 0x00,             # JMP, JMP (), JSR, RTS, RTI, BRK
+    0x58, 0x28,                                     # CLI, PLP
+}
+
+# Upper bound on the number of instructions in a single block
+MAX_BLOCK_LENGTH = 64
+
+# Relative branches
+BRANCH_OPCODES = {0x10, 0x30, 0x50, 0x70, 0x90, 0xb0, 0xd0, 0xf0}
+# BPL, looping while the PPUSTATUS vblank bit read by LDA or BIT is clear. A BMI poll is never
+# idle: reading PPUSTATUS clears the bit, so the loop exits on its own
+VBLANK_BRANCH_OPCODE = 0x10
+# Reads an idle loop body may be made of. Repeating them with the same memory content leaves
+# registers and flags as they are after the first iteration
+IDLE_LOOP_READ_OPCODES = {
+    0xa9, 0xa5, 0xad, 0xa2, 0xa6, 0xae, 0xa0, 0xa4, 0xac, # LDA, LDX, LDY
+    0xc9, 0xc5, 0xcd, 0xe0, 0xe4, 0xec, 0xc0, 0xc4, 0xcc, # CMP, CPX, CPY
+    0x29, 0x25, 0x2d, 0x09, 0x05, 0x0d,                   # AND, ORA
+    0x24, 0x2c,                                           # BIT
+}
+IMMEDIATE_OPCODES = {0xa9, 0xa2, 0xa0, 0xc9, 0xe0, 0xc0, 0x29, 0x09}
+VBLANK_READ_OPCODES = {0xad, 0x2c}                  # LDA abs, BIT abs
+
+# Per ROM overrides of the idle loop detection, keyed by ROM CRC32: start addresses of loops
+# the heuristic misses, to skip anyway, or None to disable the detection for the ROM
+IDLE_LOOP_OVERRIDES = {}
+
+class BlockCache:
+    '''Cache of decoded straight-line instruction runs from PRG ROM
+
+    A block is a tuple of compiled instructions, decoded once from the bytes at a given PC: see
+    block_compiler. Blocks are keyed by PC and current mapper PRG bank, so switching back to
+    a previously mapped bank reuses its blocks. Code located below 0x8000 (internal RAM,
+    PRG RAM) is never cached since it can be modified at any time.
+
+    Args:
+        cpu -- the CPU the blocks are compiled for
+    '''
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.blocks = {}
+        self.is_skipping_idle_loops = 1
+        # Bumped on each invalidation so that a running block can detect it must stop
+        self.generation = 0
+        # Peer components, set by connect
+        self.memory = None
+        self.cartridge = None
+
+    def connect(self, console):
+        '''Keep direct references to the peer components of console'''
+        self.memory = console.memory
+        self.cartridge = console.cartridge
+
+    def get(self, address):
+        '''Return the block starting at address, decoding it if not cached yet, and whether it is an idle loop'''
+        key = (address, self.cartridge.mapper.prg_bank)
+        entry = self.blocks.get(key)
+        if entry is None:
+            block = self.decode(address)
+            entry = self.blocks[key] = (block, self.is_idle_loop(address, block))
+        return entry
+
+    def decode(self, address):
+        '''Decode the straight-line run of instructions starting at address
+
+        The run stops after a block ending opcode, before an unknown opcode, when
+        the maximum block length is reached or when the next instruction leaves PRG ROM.
+        '''
+        block = []
+        cpu = self.cpu
+        while len(block) < MAX_BLOCK_LENGTH:
+            opcode = self.memory.read_rom(address)
+            if opcode not in OPCODES:
+                break
+            block.append(compile_instruction(cpu, address, opcode))
+            address += OPCODES[opcode][2]
+            if opcode in BLOCK_ENDING_OPCODES or address > 0xffff:
+                break
+        return tuple(block)
+
+    def is_idle_loop(self, address, block):
+        '''Return whether the block starting at address is an idle loop
+
+        An idle loop branches or jumps back to its own start, and only reads memory nothing but
+        an interrupt handler can change: internal RAM, PRG RAM and PRG ROM. It may also poll the
+        PPUSTATUS vblank flag with LDA or BIT followed by BPL, since the flag is only set by the
+        vblank event. Until the next event, every iteration then does the same thing.
+        Other PPU and APU registers change in between events, e.g. the sprite 0 hit flag.
+        '''
+        overrides = IDLE_LOOP_OVERRIDES.get(self.cartridge.rom_crc, ())
+        if not block or overrides is None or not self.is_skipping_idle_loops:
+            return False
+        if address in overrides:
+            return True
+
+        read_rom = self.memory.read_rom
+        instructions = []
+        program_counter = address
+        for _ in block:
+            opcode = read_rom(program_counter)
+            instructions.append((program_counter, opcode))
+            program_counter += OPCODES[opcode][2]
+
+        last_address, last_opcode = instructions[-1]
+        if last_opcode in BRANCH_OPCODES:
+            offset = read_rom(last_address + 1)
+            target = last_address + 2 + (offset - 256 if offset > 127 else offset)
+        elif last_opcode == 0x4c:
+            target = self.memory.read_rom_16(last_address + 1)
+        else:
+            return False
+        if target != address:
+            return False
+
+        reads = instructions[:-1]
+        for program_counter, opcode in reads:
+            if opcode not in IDLE_LOOP_READ_OPCODES:
+                return False
+            if opcode in IMMEDIATE_OPCODES:
+                continue
+            if OPCODES[opcode][2] == 2:
+                operand = read_rom(program_counter + 1)
+            else:
+                operand = self.memory.read_rom_16(program_counter + 1)
+            if operand < 0x2000 or operand >= 0x6000:
+                continue
+            if (operand & 0xe007 == 0x2002 and len(reads) == 1
+                    and opcode in VBLANK_READ_OPCODES and last_opcode == VBLANK_BRANCH_OPCODE):
+                continue
+            return False
+        return True
+
+    def invalidate(self):
+        '''Stop using blocks decoded for the previous PRG mapping
+
+        Blocks are keyed by bank so they do not need to be dropped, but the block being
+        executed must not run any further instruction from the old mapping.
+        '''
+        self.generation += 1
+
+    def clear(self):
+        '''Drop every cached block'''
+        self.blocks = {}
+        self.generation += 1
@@ -0,0 +1,1053 @@
+'''Compilation of PRG ROM instructions into specialised closures, for the block cache'''
+import sys
+from cpu_opcodes import OPCODES
+
+# Preventing direct execution
+if __name__ == '__main__':
+    print("This module cannot be executed. Please use main.py")
+    sys.exit()
+
+# A compiled instruction is a closure taking no argument. It executes the instruction with its
+# operand, address and cycle count bound at compile time, sets the CPU program counter to the
+# next instruction and returns the number of cycles taken, page crossings included.
+# Like opcode handlers, it runs while total_cycles still holds the cycle the instruction
+# started at, the caller adding the cycles returned. The program counter is only moved after
+# memory accesses, since NesEmulator.sync_bus decodes the instruction at it.
+#
+# Closures replicate their fn_0xNN handler exactly, so that block mode stays in step with the
+# other scheduler modes. Opcodes without a compiler below are wrapped around
+# their handler by compile_handler.
+
+def get_flags_nz(value):
+    '''Return the (negative, zero) flags set by loading value'''
+    return value >> 7, 1 if value == 0 else 0
+
+def get_signed(value):
+    '''Return the signed value of a relative branch offset'''
+    return value - 256 if value > 127 else value
+
+def compile_handler(cpu, opcode):
+    '''Wrap the opcode handler, which decodes its operand from the program counter on each run'''
+    handler = cpu.opcodes_table[opcode]
+    def execute():
+        step, cycles = handler()
+        cycles += cpu.additional_cycle
+        cpu.additional_cycle = 0
+        cpu.program_counter += step
+        return cycles
+    return execute
+
+# Compilers share the (cpu, address, operand) signature, implied instructions ignore operand
+# Disabling unused-argument pylint control
+# pylint: disable=W0613
+
+# Loads
+
+def compile_lda_immediate(cpu, address, operand):
+    '''LDA #$xx, flags computed at compile time'''
+    next_address = address + 2
+    negative, zero = get_flags_nz(operand)
+    def lda_immediate():
+        cpu.accumulator = operand
+        cpu.negative = negative
+        cpu.zero = zero
+        cpu.program_counter = next_address
+        return 2
+    return lda_immediate
+
+def compile_ldx_immediate(cpu, address, operand):
+    '''LDX #$xx, flags computed at compile time'''
+    next_address = address + 2
+    negative, zero = get_flags_nz(operand)
+    def ldx_immediate():
+        cpu.x_register = operand
+        cpu.negative = negative
+        cpu.zero = zero
+        cpu.program_counter = next_address
+        return 2
+    return ldx_immediate
+
+def compile_ldy_immediate(cpu, address, operand):
+    '''LDY #$xx, flags computed at compile time'''
+    next_address = address + 2
+    negative, zero = get_flags_nz(operand)
+    def ldy_immediate():
+        cpu.y_register = operand
+        cpu.negative = negative
+        cpu.zero = zero
+        cpu.program_counter = next_address
+        return 2
+    return ldy_immediate
+
+def compile_lda_zero_page(cpu, address, operand):
+    '''LDA $xx'''
+    next_address = address + 2
+    ram = cpu.memory.internal_ram
+    def lda_zero_page():
+        value = cpu.accumulator = ram[operand]
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 3
+    return lda_zero_page
+
+def compile_ldx_zero_page(cpu, address, operand):
+    '''LDX $xx'''
+    next_address = address + 2
+    ram = cpu.memory.internal_ram
+    def ldx_zero_page():
+        value = cpu.x_register = ram[operand]
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 3
+    return ldx_zero_page
+
+def compile_ldy_zero_page(cpu, address, operand):
+    '''LDY $xx'''
+    next_address = address + 2
+    ram = cpu.memory.internal_ram
+    def ldy_zero_page():
+        value = cpu.y_register = ram[operand]
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 3
+    return ldy_zero_page
+
+def compile_lda_zero_page_x(cpu, address, operand):
+    '''LDA $xx, X'''
+    next_address = address + 2
+    ram = cpu.memory.internal_ram
+    def lda_zero_page_x():
+        value = cpu.accumulator = ram[(operand + cpu.x_register) & 255]
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 4
+    return lda_zero_page_x
+
+def compile_lda_absolute(cpu, address, operand):
+    '''LDA $xxxx'''
+    next_address = address + 3
+    read_pages = cpu.memory.read_pages
+    read_handlers = cpu.memory.read_handlers
+    high = operand >> 8
+    low = operand & 0xff
+    def lda_absolute():
+        page = read_pages[high]
+        value = cpu.accumulator = page[low] if page is not None else read_handlers[high](operand)
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 4
+    return lda_absolute
+
+def compile_ldx_absolute(cpu, address, operand):
+    '''LDX $xxxx'''
+    next_address = address + 3
+    read_pages = cpu.memory.read_pages
+    read_handlers = cpu.memory.read_handlers
+    high = operand >> 8
+    low = operand & 0xff
+    def ldx_absolute():
+        page = read_pages[high]
+        value = cpu.x_register = page[low] if page is not None else read_handlers[high](operand)
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 4
+    return ldx_absolute
+
+def compile_ldy_absolute(cpu, address, operand):
+    '''LDY $xxxx'''
+    next_address = address + 3
+    read_pages = cpu.memory.read_pages
+    read_handlers = cpu.memory.read_handlers
+    high = operand >> 8
+    low = operand & 0xff
+    def ldy_absolute():
+        page = read_pages[high]
+        value = cpu.y_register = page[low] if page is not None else read_handlers[high](operand)
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 4
+    return ldy_absolute
+
+def compile_lda_absolute_x(cpu, address, operand):
+    '''LDA $xxxx, X. One more cycle when crossing a page'''
+    next_address = address + 3
+    read_pages = cpu.memory.read_pages
+    read_handlers = cpu.memory.read_handlers
+    operand_page = operand & 0xff00
+    def lda_absolute_x():
+        target = (operand + cpu.x_register) & 0xffff
+        page = read_pages[target >> 8]
+        value = cpu.accumulator = page[target & 0xff] if page is not None else read_handlers[target >> 8](target)
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 4 if target & 0xff00 == operand_page else 5
+    return lda_absolute_x
+
+def compile_lda_absolute_y(cpu, address, operand):
+    '''LDA $xxxx, Y. One more cycle when crossing a page'''
+    next_address = address + 3
+    read_pages = cpu.memory.read_pages
+    read_handlers = cpu.memory.read_handlers
+    operand_page = operand & 0xff00
+    def lda_absolute_y():
+        target = (operand + cpu.y_register) & 0xffff
+        page = read_pages[target >> 8]
+        value = cpu.accumulator = page[target & 0xff] if page is not None else read_handlers[target >> 8](target)
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 4 if target & 0xff00 == operand_page else 5
+    return lda_absolute_y
+
+def compile_lda_indirect_y(cpu, address, operand):
+    '''LDA ($xx), Y. The pointer does not cross the zero page. One more cycle when crossing a page'''
+    next_address = address + 2
+    ram = cpu.memory.internal_ram
+    read_pages = cpu.memory.read_pages
+    read_handlers = cpu.memory.read_handlers
+    pointer_high = (operand + 1) & 0xff
+    def lda_indirect_y():
+        base = ram[operand] + (ram[pointer_high] << 8)
+        target = (base + cpu.y_register) & 0xffff
+        page = read_pages[target >> 8]
+        value = cpu.accumulator = page[target & 0xff] if page is not None else read_handlers[target >> 8](target)
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 5 if target & 0xff00 == base & 0xff00 else 6
+    return lda_indirect_y
+
+# Stores
+
+def compile_sta_zero_page(cpu, address, operand):
+    '''STA $xx'''
+    next_address = address + 2
+    memory = cpu.memory
+    write_pages = memory.write_pages
+    def sta_zero_page():
+        page = write_pages[0]
+        if page is not None:
+            page[operand] = cpu.accumulator
+            extra_cycles = 0
+        else:
+            extra_cycles = memory.write_handlers[0](operand, cpu.accumulator)
+        cpu.program_counter = next_address
+        return 3 + extra_cycles
+    return sta_zero_page
+
+def compile_stx_zero_page(cpu, address, operand):
+    '''STX $xx'''
+    next_address = address + 2
+    memory = cpu.memory
+    write_pages = memory.write_pages
+    def stx_zero_page():
+        page = write_pages[0]
+        if page is not None:
+            page[operand] = cpu.x_register
+        else:
+            memory.write_handlers[0](operand, cpu.x_register)
+        cpu.program_counter = next_address
+        return 3
+    return stx_zero_page
+
+def compile_sty_zero_page(cpu, address, operand):
+    '''STY $xx'''
+    next_address = address + 2
+    memory = cpu.memory
+    write_pages = memory.write_pages
+    def sty_zero_page():
+        page = write_pages[0]
+        if page is not None:
+            page[operand] = cpu.y_register
+        else:
+            memory.write_handlers[0](operand, cpu.y_register)
+        cpu.program_counter = next_address
+        return 3
+    return sty_zero_page
+
+def compile_sta_zero_page_x(cpu, address, operand):
+    '''STA $xx, X'''
+    next_address = address + 2
+    memory = cpu.memory
+    write_pages = memory.write_pages
+    def sta_zero_page_x():
+        target = (operand + cpu.x_register) & 255
+        page = write_pages[0]
+        if page is not None:
+            page[target] = cpu.accumulator
+            extra_cycles = 0
+        else:
+            extra_cycles = memory.write_handlers[0](target, cpu.accumulator)
+        cpu.program_counter = next_address
+        return 4 + extra_cycles
+    return sta_zero_page_x
+
+def compile_sta_absolute(cpu, address, operand):
+    '''STA $xxxx'''
+    next_address = address + 3
+    memory = cpu.memory
+    write_pages = memory.write_pages
+    high = operand >> 8
+    low = operand & 0xff
+    def sta_absolute():
+        page = write_pages[high]
+        if page is not None:
+            page[low] = cpu.accumulator
+            extra_cycles = 0
+        else:
+            extra_cycles = memory.write_handlers[high](operand, cpu.accumulator)
+        cpu.program_counter = next_address
+        return 4 + extra_cycles
+    return sta_absolute
+
+def compile_stx_absolute(cpu, address, operand):
+    '''STX $xxxx'''
+    next_address = address + 3
+    memory = cpu.memory
+    write_pages = memory.write_pages
+    high = operand >> 8
+    low = operand & 0xff
+    def stx_absolute():
+        page = write_pages[high]
+        if page is not None:
+            page[low] = cpu.x_register
+        else:
+            memory.write_handlers[high](operand, cpu.x_register)
+        cpu.program_counter = next_address
+        return 4
+    return stx_absolute
+
+def compile_sty_absolute(cpu, address, operand):
+    '''STY $xxxx'''
+    next_address = address + 3
+    memory = cpu.memory
+    write_pages = memory.write_pages
+    high = operand >> 8
+    low = operand & 0xff
+    def sty_absolute():
+        page = write_pages[high]
+        if page is not None:
+            page[low] = cpu.y_register
+        else:
+            memory.write_handlers[high](operand, cpu.y_register)
+        cpu.program_counter = next_address
+        return 4
+    return sty_absolute
+
+def compile_sta_absolute_x(cpu, address, operand):
+    '''STA $xxxx, X. Stores always take 5 cycles'''
+    next_address = address + 3
+    memory = cpu.memory
+    write_pages = memory.write_pages
+    def sta_absolute_x():
+        target = (operand + cpu.x_register) & 0xffff
+        page = write_pages[target >> 8]
+        if page is not None:
+            page[target & 0xff] = cpu.accumulator
+            extra_cycles = 0
+        else:
+            extra_cycles = memory.write_handlers[target >> 8](target, cpu.accumulator)
+        cpu.program_counter = next_address
+        return 5 + extra_cycles
+    return sta_absolute_x
+
+def compile_sta_absolute_y(cpu, address, operand):
+    '''STA $xxxx, Y. Stores always take 5 cycles'''
+    next_address = address + 3
+    memory = cpu.memory
+    write_pages = memory.write_pages
+    def sta_absolute_y():
+        target = (operand + cpu.y_register) & 0xffff
+        page = write_pages[target >> 8]
+        if page is not None:
+            page[target & 0xff] = cpu.accumulator
+            extra_cycles = 0
+        else:
+            extra_cycles = memory.write_handlers[target >> 8](target, cpu.accumulator)
+        cpu.program_counter = next_address
+        return 5 + extra_cycles
+    return sta_absolute_y
+
+def compile_sta_indirect_y(cpu, address, operand):
+    '''STA ($xx), Y. The pointer does not cross the zero page. Stores always take 6 cycles'''
+    next_address = address + 2
+    memory = cpu.memory
+    ram = memory.internal_ram
+    write_pages = memory.write_pages
+    pointer_high = (operand + 1) & 0xff
+    def sta_indirect_y():
+        target = (ram[operand] + (ram[pointer_high] << 8) + cpu.y_register) & 0xffff
+        page = write_pages[target >> 8]
+        if page is not None:
+            page[target & 0xff] = cpu.accumulator
+            extra_cycles = 0
+        else:
+            extra_cycles = memory.write_handlers[target >> 8](target, cpu.accumulator)
+        cpu.program_counter = next_address
+        return 6 + extra_cycles
+    return sta_indirect_y
+
+# Arithmetic, logic and comparisons
+
+def compile_and_immediate(cpu, address, operand):
+    '''AND #$xx'''
+    next_address = address + 2
+    def and_immediate():
+        value = cpu.accumulator = cpu.accumulator & operand
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 2
+    return and_immediate
+
+def compile_ora_immediate(cpu, address, operand):
+    '''ORA #$xx'''
+    next_address = address + 2
+    def ora_immediate():
+        value = cpu.accumulator = cpu.accumulator | operand
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 2
+    return ora_immediate
+
+def compile_eor_immediate(cpu, address, operand):
+    '''EOR #$xx'''
+    next_address = address + 2
+    def eor_immediate():
+        value = cpu.accumulator = cpu.accumulator ^ operand
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 2
+    return eor_immediate
+
+def compile_adc_immediate(cpu, address, operand):
+    '''ADC #$xx'''
+    next_address = address + 2
+    adc = cpu.adc
+    def adc_immediate():
+        adc(operand)
+        cpu.program_counter = next_address
+        return 2
+    return adc_immediate
+
+def compile_sbc_immediate(cpu, address, operand):
+    '''SBC #$xx, as ADC of the complemented operand'''
+    next_address = address + 2
+    adc = cpu.adc
+    complement = 255 - operand
+    def sbc_immediate():
+        adc(complement)
+        cpu.program_counter = next_address
+        return 2
+    return sbc_immediate
+
+def compile_adc_zero_page(cpu, address, operand):
+    '''ADC $xx'''
+    next_address = address + 2
+    adc = cpu.adc
+    ram = cpu.memory.internal_ram
+    def adc_zero_page():
+        adc(ram[operand])
+        cpu.program_counter = next_address
+        return 3
+    return adc_zero_page
+
+def compile_cmp_immediate(cpu, address, operand):
+    '''CMP #$xx'''
+    next_address = address + 2
+    cmp = cpu.cmp
+    def cmp_immediate():
+        cmp(cpu.accumulator, operand)
+        cpu.program_counter = next_address
+        return 2
+    return cmp_immediate
+
+def compile_cpx_immediate(cpu, address, operand):
+    '''CPX #$xx'''
+    next_address = address + 2
+    cmp = cpu.cmp
+    def cpx_immediate():
+        cmp(cpu.x_register, operand)
+        cpu.program_counter = next_address
+        return 2
+    return cpx_immediate
+
+def compile_cpy_immediate(cpu, address, operand):
+    '''CPY #$xx'''
+    next_address = address + 2
+    cmp = cpu.cmp
+    def cpy_immediate():
+        cmp(cpu.y_register, operand)
+        cpu.program_counter = next_address
+        return 2
+    return cpy_immediate
+
+def compile_cmp_zero_page(cpu, address, operand):
+    '''CMP $xx'''
+    next_address = address + 2
+    cmp = cpu.cmp
+    ram = cpu.memory.internal_ram
+    def cmp_zero_page():
+        cmp(cpu.accumulator, ram[operand])
+        cpu.program_counter = next_address
+        return 3
+    return cmp_zero_page
+
+def compile_cpx_zero_page(cpu, address, operand):
+    '''CPX $xx'''
+    next_address = address + 2
+    cmp = cpu.cmp
+    ram = cpu.memory.internal_ram
+    def cpx_zero_page():
+        cmp(cpu.x_register, ram[operand])
+        cpu.program_counter = next_address
+        return 3
+    return cpx_zero_page
+
+def compile_cpy_zero_page(cpu, address, operand):
+    '''CPY $xx'''
+    next_address = address + 2
+    cmp = cpu.cmp
+    ram = cpu.memory.internal_ram
+    def cpy_zero_page():
+        cmp(cpu.y_register, ram[operand])
+        cpu.program_counter = next_address
+        return 3
+    return cpy_zero_page
+
+def compile_cmp_absolute(cpu, address, operand):
+    '''CMP $xxxx'''
+    next_address = address + 3
+    cmp = cpu.cmp
+    read_pages = cpu.memory.read_pages
+    read_handlers = cpu.memory.read_handlers
+    high = operand >> 8
+    low = operand & 0xff
+    def cmp_absolute():
+        page = read_pages[high]
+        cmp(cpu.accumulator, page[low] if page is not None else read_handlers[high](operand))
+        cpu.program_counter = next_address
+        return 4
+    return cmp_absolute
+
+def compile_bit_zero_page(cpu, address, operand):
+    '''BIT $xx'''
+    next_address = address + 2
+    ram = cpu.memory.internal_ram
+    def bit_zero_page():
+        value = ram[operand]
+        cpu.zero = 1 if value & cpu.accumulator == 0 else 0
+        cpu.negative = (value >> 7) & 1
+        cpu.overflow = (value >> 6) & 1
+        cpu.program_counter = next_address
+        return 3
+    return bit_zero_page
+
+def compile_bit_absolute(cpu, address, operand):
+    '''BIT $xxxx'''
+    next_address = address + 3
+    read_pages = cpu.memory.read_pages
+    read_handlers = cpu.memory.read_handlers
+    high = operand >> 8
+    low = operand & 0xff
+    def bit_absolute():
+        page = read_pages[high]
+        value = page[low] if page is not None else read_handlers[high](operand)
+        cpu.zero = 1 if value & cpu.accumulator == 0 else 0
+        cpu.negative = (value >> 7) & 1
+        cpu.overflow = (value >> 6) & 1
+        cpu.program_counter = next_address
+        return 4
+    return bit_absolute
+
+# Read-modify-write
+
+def compile_inc_zero_page(cpu, address, operand):
+    '''INC $xx'''
+    next_address = address + 2
+    memory = cpu.memory
+    ram = memory.internal_ram
+    write_pages = memory.write_pages
+    def inc_zero_page():
+        value = ram[operand]
+        value = 0 if value == 255 else value + 1
+        page = write_pages[0]
+        if page is not None:
+            page[operand] = value
+        else:
+            memory.write_handlers[0](operand, value)
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 5
+    return inc_zero_page
+
+def compile_dec_zero_page(cpu, address, operand):
+    '''DEC $xx'''
+    next_address = address + 2
+    memory = cpu.memory
+    ram = memory.internal_ram
+    write_pages = memory.write_pages
+    def dec_zero_page():
+        value = ram[operand]
+        value = 255 if value == 0 else value - 1
+        page = write_pages[0]
+        if page is not None:
+            page[operand] = value
+        else:
+            memory.write_handlers[0](operand, value)
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 5
+    return dec_zero_page
+
+def compile_inc_absolute(cpu, address, operand):
+    '''INC $xxxx'''
+    next_address = address + 3
+    memory = cpu.memory
+    read_rom = memory.read_rom
+    write_rom = memory.write_rom
+    def inc_absolute():
+        value = read_rom(operand)
+        value = 0 if value == 255 else value + 1
+        write_rom(operand, value)
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 6
+    return inc_absolute
+
+def compile_dec_absolute(cpu, address, operand):
+    '''DEC $xxxx'''
+    next_address = address + 3
+    memory = cpu.memory
+    read_rom = memory.read_rom
+    write_rom = memory.write_rom
+    def dec_absolute():
+        value = read_rom(operand)
+        value = 255 if value == 0 else value - 1
+        write_rom(operand, value)
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 6
+    return dec_absolute
+
+def compile_asl_accumulator(cpu, address, operand):
+    '''ASL A'''
+    next_address = address + 1
+    def asl_accumulator():
+        value = cpu.accumulator
+        cpu.carry = value >> 7
+        value = cpu.accumulator = (value << 1) & 0xff
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 2
+    return asl_accumulator
+
+def compile_lsr_accumulator(cpu, address, operand):
+    '''LSR A'''
+    next_address = address + 1
+    def lsr_accumulator():
+        value = cpu.accumulator
+        cpu.carry = value & 1
+        value = cpu.accumulator = value >> 1
+        cpu.negative = 0
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 2
+    return lsr_accumulator
+
+def compile_rol_accumulator(cpu, address, operand):
+    '''ROL A'''
+    next_address = address + 1
+    def rol_accumulator():
+        value = (cpu.accumulator << 1) | cpu.carry
+        cpu.carry = value >> 8
+        value = cpu.accumulator = value & 0xff
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 2
+    return rol_accumulator
+
+def compile_ror_accumulator(cpu, address, operand):
+    '''ROR A'''
+    next_address = address + 1
+    def ror_accumulator():
+        value = cpu.accumulator
+        carry = value & 1
+        value = cpu.accumulator = (value >> 1) | (cpu.carry << 7)
+        cpu.carry = carry
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 2
+    return ror_accumulator
+
+def compile_asl_zero_page(cpu, address, operand):
+    '''ASL $xx'''
+    next_address = address + 2
+    memory = cpu.memory
+    ram = memory.internal_ram
+    write_pages = memory.write_pages
+    def asl_zero_page():
+        value = ram[operand]
+        cpu.carry = value >> 7
+        value = (value << 1) & 0xff
+        page = write_pages[0]
+        if page is not None:
+            page[operand] = value
+        else:
+            memory.write_handlers[0](operand, value)
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 5
+    return asl_zero_page
+
+def compile_lsr_zero_page(cpu, address, operand):
+    '''LSR $xx'''
+    next_address = address + 2
+    memory = cpu.memory
+    ram = memory.internal_ram
+    write_pages = memory.write_pages
+    def lsr_zero_page():
+        value = ram[operand]
+        cpu.carry = value & 1
+        value >>= 1
+        page = write_pages[0]
+        if page is not None:
+            page[operand] = value
+        else:
+            memory.write_handlers[0](operand, value)
+        cpu.negative = 0
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 5
+    return lsr_zero_page
+
+def compile_rol_zero_page(cpu, address, operand):
+    '''ROL $xx'''
+    next_address = address + 2
+    memory = cpu.memory
+    ram = memory.internal_ram
+    write_pages = memory.write_pages
+    def rol_zero_page():
+        value = (ram[operand] << 1) | cpu.carry
+        cpu.carry = value >> 8
+        value &= 0xff
+        page = write_pages[0]
+        if page is not None:
+            page[operand] = value
+        else:
+            memory.write_handlers[0](operand, value)
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 5
+    return rol_zero_page
+
+def compile_ror_zero_page(cpu, address, operand):
+    '''ROR $xx'''
+    next_address = address + 2
+    memory = cpu.memory
+    ram = memory.internal_ram
+    write_pages = memory.write_pages
+    def ror_zero_page():
+        value = ram[operand]
+        carry = value & 1
+        value = (value >> 1) | (cpu.carry << 7)
+        cpu.carry = carry
+        page = write_pages[0]
+        if page is not None:
+            page[operand] = value
+        else:
+            memory.write_handlers[0](operand, value)
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 5
+    return ror_zero_page
+
+# Registers and flags
+
+def compile_inx(cpu, address, operand):
+    '''INX'''
+    next_address = address + 1
+    def inx():
+        value = cpu.x_register = cpu.x_register + 1 if cpu.x_register < 255 else 0
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 2
+    return inx
+
+def compile_iny(cpu, address, operand):
+    '''INY'''
+    next_address = address + 1
+    def iny():
+        value = cpu.y_register = cpu.y_register + 1 if cpu.y_register < 255 else 0
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 2
+    return iny
+
+def compile_dex(cpu, address, operand):
+    '''DEX'''
+    next_address = address + 1
+    def dex():
+        value = cpu.x_register = cpu.x_register - 1 if cpu.x_register > 0 else 255
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 2
+    return dex
+
+def compile_dey(cpu, address, operand):
+    '''DEY'''
+    next_address = address + 1
+    def dey():
+        value = cpu.y_register = cpu.y_register - 1 if cpu.y_register > 0 else 255
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 2
+    return dey
+
+def compile_tax(cpu, address, operand):
+    '''TAX'''
+    next_address = address + 1
+    def tax():
+        value = cpu.x_register = cpu.accumulator
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 2
+    return tax
+
+def compile_tay(cpu, address, operand):
+    '''TAY'''
+    next_address = address + 1
+    def tay():
+        value = cpu.y_register = cpu.accumulator
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 2
+    return tay
+
+def compile_txa(cpu, address, operand):
+    '''TXA'''
+    next_address = address + 1
+    def txa():
+        value = cpu.accumulator = cpu.x_register
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 2
+    return txa
+
+def compile_tya(cpu, address, operand):
+    '''TYA'''
+    next_address = address + 1
+    def tya():
+        value = cpu.accumulator = cpu.y_register
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 2
+    return tya
+
+def compile_clc(cpu, address, operand):
+    '''CLC'''
+    next_address = address + 1
+    def clc():
+        cpu.carry = 0
+        cpu.program_counter = next_address
+        return 2
+    return clc
+
+def compile_sec(cpu, address, operand):
+    '''SEC'''
+    next_address = address + 1
+    def sec():
+        cpu.carry = 1
+        cpu.program_counter = next_address
+        return 2
+    return sec
+
+def compile_nop(cpu, address, operand):
+    '''NOP'''
+    next_address = address + 1
+    def nop():
+        cpu.program_counter = next_address
+        return 2
+    return nop
+
+# Stack
+
+def compile_pha(cpu, address, operand):
+    '''PHA'''
+    next_address = address + 1
+    push = cpu.push
+    def pha():
+        push(cpu.accumulator)
+        cpu.program_counter = next_address
+        return 3
+    return pha
+
+def compile_pla(cpu, address, operand):
+    '''PLA'''
+    next_address = address + 1
+    pop = cpu.pop
+    def pla():
+        value = cpu.accumulator = pop()
+        cpu.negative = value >> 7
+        cpu.zero = 1 if value == 0 else 0
+        cpu.program_counter = next_address
+        return 4
+    return pla
+
+# Branches and jumps, which end blocks
+
+def compile_branch(branch_factory, expected):
+    '''Return the compiler of a branch taken when the flag tested by branch_factory closures equals expected
+
+    A taken branch takes one more cycle, and another one when the target is on another page
+    than the next instruction.
+    '''
+    def compile_relative(cpu, address, operand):
+        next_address = address + 2
+        target = next_address + get_signed(operand)
+        taken_cycles = 4 if target & 0xff00 != next_address & 0xff00 else 3
+        return branch_factory(cpu, expected, next_address, target, taken_cycles)
+    return compile_relative
+
+def branch_on_negative(cpu, expected, next_address, target, taken_cycles):
+    '''BPL, BMI'''
+    def branch():
+        if cpu.negative == expected:
+            cpu.program_counter = target
+            return taken_cycles
+        cpu.program_counter = next_address
+        return 2
+    return branch
+
+def branch_on_overflow(cpu, expected, next_address, target, taken_cycles):
+    '''BVC, BVS'''
+    def branch():
+        if cpu.overflow == expected:
+            cpu.program_counter = target
+            return taken_cycles
+        cpu.program_counter = next_address
+        return 2
+    return branch
+
+def branch_on_carry(cpu, expected, next_address, target, taken_cycles):
+    '''BCC, BCS'''
+    def branch():
+        if cpu.carry == expected:
+            cpu.program_counter = target
+            return taken_cycles
+        cpu.program_counter = next_address
+        return 2
+    return branch
+
+def branch_on_zero(cpu, expected, next_address, target, taken_cycles):
+    '''BNE, BEQ'''
+    def branch():
+        if cpu.zero == expected:
+            cpu.program_counter = target
+            return taken_cycles
+        cpu.program_counter = next_address
+        return 2
+    return branch
+
+def compile_jmp_absolute(cpu, address, operand):
+    '''JMP $xxxx'''
+    def jmp_absolute():
+        cpu.program_counter = operand
+        return 3
+    return jmp_absolute
+
+def compile_jsr(cpu, address, operand):
+    '''JSR $xxxx. The address of its last byte is pushed'''
+    push = cpu.push
+    return_high = (address + 2) >> 8
+    return_low = (address + 2) & 255
+    def jsr():
+        push(return_high)
+        push(return_low)
+        cpu.program_counter = operand
+        return 6
+    return jsr
+
+def compile_rts(cpu, address, operand):
+    '''RTS'''
+    pop = cpu.pop
+    def rts():
+        low = pop()
+        high = pop()
+        cpu.program_counter = (high << 8) + low + 1
+        return 6
+    return rts
+
+COMPILERS = {
+    0xa9: compile_lda_immediate, 0xa2: compile_ldx_immediate, 0xa0: compile_ldy_immediate,
+    0xa5: compile_lda_zero_page, 0xa6: compile_ldx_zero_page, 0xa4: compile_ldy_zero_page,
+    0xb5: compile_lda_zero_page_x,
+    0xad: compile_lda_absolute, 0xae: compile_ldx_absolute, 0xac: compile_ldy_absolute,
+    0xbd: compile_lda_absolute_x, 0xb9: compile_lda_absolute_y, 0xb1: compile_lda_indirect_y,
+    0x85: compile_sta_zero_page, 0x86: compile_stx_zero_page, 0x84: compile_sty_zero_page,
+    0x95: compile_sta_zero_page_x,
+    0x8d: compile_sta_absolute, 0x8e: compile_stx_absolute, 0x8c: compile_sty_absolute,
+    0x9d: compile_sta_absolute_x, 0x99: compile_sta_absolute_y, 0x91: compile_sta_indirect_y,
+    0x29: compile_and_immediate, 0x09: compile_ora_immediate, 0x49: compile_eor_immediate,
+    0x69: compile_adc_immediate, 0xe9: compile_sbc_immediate, 0x65: compile_adc_zero_page,
+    0xc9: compile_cmp_immediate, 0xe0: compile_cpx_immediate, 0xc0: compile_cpy_immediate,
+    0xc5: compile_cmp_zero_page, 0xe4: compile_cpx_zero_page, 0xc4: compile_cpy_zero_page,
+    0xcd: compile_cmp_absolute,
+    0x24: compile_bit_zero_page, 0x2c: compile_bit_absolute,
+    0xe6: compile_inc_zero_page, 0xc6: compile_dec_zero_page,
+    0xee: compile_inc_absolute, 0xce: compile_dec_absolute,
+    0x0a: compile_asl_accumulator, 0x4a: compile_lsr_accumulator,
+    0x2a: compile_rol_accumulator, 0x6a: compile_ror_accumulator,
+    0x06: compile_asl_zero_page, 0x46: compile_lsr_zero_page, 0x26: compile_rol_zero_page, 0x66: compile_ror_zero_page,
+    0xe8: compile_inx, 0xc8: compile_iny, 0xca: compile_dex, 0x88: compile_dey,
+    0xaa: compile_tax, 0xa8: compile_tay, 0x8a: compile_txa, 0x98: compile_tya,
+    0x18: compile_clc, 0x38: compile_sec, 0xea: compile_nop,
+    0x48: compile_pha, 0x68: compile_pla,
+    0x10: compile_branch(branch_on_negative, 0), 0x30: compile_branch(branch_on_negative, 1),
+    0x50: compile_branch(branch_on_overflow, 0), 0x70: compile_branch(branch_on_overflow, 1),
+    0x90: compile_branch(branch_on_carry, 0), 0xb0: compile_branch(branch_on_carry, 1),
+    0xd0: compile_branch(branch_on_zero, 0), 0xf0: compile_branch(branch_on_zero, 1),
+    0x4c: compile_jmp_absolute, 0x20: compile_jsr, 0x60: compile_rts,
+}
+
+def compile_instruction(cpu, address, opcode):
+    '''Return the closure executing the instruction with the given opcode at address
+
+    Operands are read once, from PRG ROM. The caller makes sure opcode is known.
+    '''
+    compiler = COMPILERS.get(opcode)
+    if compiler is None:
+        return compile_handler(cpu, opcode)
+    match OPCODES[opcode][2]:
+        case 1: operand = None
+        case 2: operand = cpu.memory.read_rom(address + 1)
+        case _: operand = cpu.memory.read_rom_16(address + 1)
+    return compiler(cpu, address, operand)
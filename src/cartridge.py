@@ -1,6 +1,8 @@
 '''Cartridge module'''
 import sys
-import instances
+import zlib
+import debug
+from tile_cache import TileCache
 
 # Preventing direct execution
 if __name__ == '__main__':
@@ -24,6 +26,8 @@ class Cartridge:
         self.f10 = b''
         self.mapper = 0
         self.mapper_id = 0
+        # CRC32 of the header, trainer, PRG ROM and CHR ROM. Identifies the game in save states
+        self.rom_crc = 0
 
         #TRAINER
         self.is_trainer = False
@@ -34,6 +38,7 @@ class Cartridge:
 
         #CHR_ROM
         self.chr_rom = b''
+        self.tile_cache = TileCache(self)
 
         #PLAY_CHOISE_10
         self.is_playchoice = False
@@ -42,6 +47,15 @@ class Cartridge:
         #TITLE
         self.header = b''
 
+        # Peer components, set by connect
+        self.memory = None
+        self.cpu = None
+
+    def connect(self, console):
+        '''Keep direct references to the peer components of console'''
+        self.memory = console.memory
+        self.cpu = console.cpu
+
     def read_prg_rom(self, address):
         '''Read ROM from cartridge. Task will be delegated to mapper'''
         return self.mapper.read_prg_rom(address)
@@ -50,12 +64,22 @@ class Cartridge:
         '''Write ROM from cartridge. Usefull for some mappers. Task will be delegated to mapper'''
         return self.mapper.write_prg_rom(address, value)
 
+    def on_prg_bank_switch(self):
+        '''To be called by mappers once their PRG ROM mapping (and prg_bank) changed'''
+        self.memory.map_cartridge()
+        self.cpu.block_cache.invalidate()
+
+    def on_chr_bank_switch(self):
+        '''To be called by mappers once their CHR mapping changed'''
+        self.tile_cache.clear()
+
     def read_chr_rom(self, address):
         '''Read CHR ROM from cartridge. Task will be delegated to mapper'''
         return self.mapper.read_chr_rom(address)
 
     def write_chr_rom(self, address, value):
         '''Write CHR ROM from cartridge. Usefull for some mappers. Task will be delegated to mapper'''
+        self.tile_cache.invalidate(address)
         return self.mapper.write_chr_rom(address, value)
 
     def read_ram(self, address):
@@ -66,9 +90,18 @@ class Cartridge:
         '''Read ROM from cartridge. Task will be delegated to mapper'''
         self.mapper.write_ram(address, value)
 
+    def save_state(self, writer):
+        '''Write the mapper state to a save state'''
+        self.mapper.save_state(writer)
+
+    def load_state(self, reader):
+        '''Restore the mapper state from a save state, and remap the PRG banks it selects'''
+        self.mapper.load_state(reader)
+        self.on_prg_bank_switch()
+
     def get_tile(self, bank, tile):
         '''Get Tile data from CHR Rom'''
-        if instances.debug : print(f"{len(self.chr_rom):x} - {tile} - {bank + 16 * tile:x}:{bank + 16 * tile + 16:x}")
+        if debug.enabled : print(f"{len(self.chr_rom):x} - {tile} - {bank + 16 * tile:x}:{bank + 16 * tile + 16:x}")
         tile =  self.chr_rom[bank + 16 * tile:bank + 16 * tile + 16]
         return tile
 
@@ -90,19 +123,21 @@ class Cartridge:
         self.title = stream.read()
 
         stream.close()
+        self.rom_crc = zlib.crc32(self.header + self.trainer + self.prg_rom + self.chr_rom)
 
         try:
             module = __import__("mappers")
             class_ = getattr(module, f"Mapper{self.mapper_id}")
-            self.mapper = class_()
+            self.mapper = class_(self)
         except Exception as exception:
             raise Exception(f"Unreconized mapper {self.mapper_id}") from exception
+        self.tile_cache.clear()
+        self.memory.map_cartridge()
 
     def parse_header(self):
         '''Parse the rom header'''
         h = self.header
         self.magic = h[0:4]
-        print(h[5])
         self.prg_rom_size = h[4] * 16 * 1024
         self.chr_rom_size = h[5] * 8 * 1024
         self.f6 = h[6]
@@ -0,0 +1,36 @@
+'''A whole console: its components, wired to each other'''
+import sys
+from nes_emulator import NesEmulator
+from ppu import Ppu
+from cpu import Cpu
+from apu import Apu
+from memory import Memory
+from cartridge import Cartridge
+
+# Preventing direct execution
+if __name__ == '__main__':
+    print("This module cannot be executed. Please use main.py")
+    sys.exit()
+
+class Console:
+    '''Owns the components of one emulated NES
+
+    Components keep direct references to the peers they need, so that several independent
+    consoles can run in the same process.
+
+    Args:
+        headless -- see NesEmulator
+    '''
+    def __init__(self, headless = 0):
+        self.memory = Memory()
+        self.ppu = Ppu()
+        self.cpu = Cpu()
+        self.apu = Apu()
+        self.cartridge = Cartridge()
+        self.nes = NesEmulator(headless)
+        for component in (self.memory, self.ppu, self.cpu, self.apu, self.cartridge, self.nes):
+            component.connect(self)
+
+    def load_rom(self, file_name):
+        '''Insert the cartridge read from the ROM file'''
+        self.cartridge.parse_rom(file_name)
@@ -1,9 +1,12 @@
 '''Emulator CPU Modules'''
 import sys
 import re
-import instances
+import math
+import debug
 from utils import format_hex_data
 from cpu_opcodes import OPCODES
+from block_cache import BlockCache
+from state import StateFields
 
 # Preventing direct execution
 if __name__ == '__main__':
@@ -19,11 +22,17 @@ if __name__ == '__main__':
 
 # https://www.gladir.com/CODER/ASM6502/referenceopcode.htm
 
+# Registers, flags and counters saved in save states
+CPU_STATE = StateFields(
+    ('accumulator', 'B'), ('x_register', 'B'), ('y_register', 'B'), ('program_counter', 'H'), ('stack_pointer', 'B'),
+    ('negative', 'B'), ('overflow', 'B'), ('break_flag', 'B'), ('decimal', 'B'), ('interrupt', 'B'), ('zero', 'B'), ('carry', 'B'),
+    ('total_cycles', 'q'), ('remaining_cycles', 'i'), ('additional_cycle', 'B'), ('compteur', 'q'),
+)
+
 class Cpu:
     '''CPU component'''
     def __init__(self):
         self.test_mode = 0
-        instances.debug = 0
         self.compteur = 0
         self.total_cycles = 0
         self.remaining_cycles = 0
@@ -50,6 +59,25 @@ class Cpu:
         self.zero = 0
         self.carry = 0
 
+        # Opcode dispatch table, built once. Unknown opcodes fall to a sentinel handler
+        self.opcodes_table = [self.fn_unknown] * 256
+        for opcode in OPCODES:
+            self.opcodes_table[opcode] = getattr(self, f"fn_0x{opcode:02x}")
+
+        self.block_cache = BlockCache(self)
+
+        # Peer components, set by connect
+        self.memory = None
+        self.ppu = None
+        self.nes = None
+
+    def connect(self, console):
+        '''Keep direct references to the peer components of console'''
+        self.memory = console.memory
+        self.ppu = console.ppu
+        self.nes = console.nes
+        self.block_cache.connect(console)
+
     # initialise PC
     def start(self, entry_point = None):
         '''Execute 6502 Start sequence'''
@@ -63,8 +91,8 @@ class Cpu:
             self.program_counter = entry_point
         else:
         # Equivalent to JMP ($FFFC)
-            self.program_counter = instances.memory.read_rom_16(0xfffc)
-        if instances.debug : print(f"Entry point : 0x{format_hex_data(self.program_counter)}")
+            self.program_counter = self.memory.read_rom_16(0xfffc)
+        if debug.enabled : print(f"Entry point : 0x{format_hex_data(self.program_counter)}")
         self.total_cycles = 7 # Cout de match'init
         self.remaining_cycles = 7 - 1 # On évite de compter deux fois le cycle en cours
 
@@ -72,12 +100,12 @@ class Cpu:
 
     def nmi(self):
         ''' Raises an NMI interruption'''
-        if instances.debug : print("NMI interruption detected")
+        if debug.enabled : print("NMI interruption detected")
         self.general_interrupt(0xFFFA)
 
     def irq(self):
         ''' Raises an IRQ interruption'''
-        if instances.debug : print("IRQ interruption detected")
+        if debug.enabled : print("IRQ interruption detected")
         self.general_interrupt(0xFFFE)
 
     def general_interrupt(self, address):
@@ -89,9 +117,9 @@ class Cpu:
         self.push(self.program_counter & 255)
         self.push(self.get_status_register() & 0b11101111) # NIM and IRQ set break flag to 0
 
-        self.interrupt = 0
+        self.interrupt = 1 # IRQs are masked during the interrupt handler
 
-        self.program_counter = instances.memory.read_rom_16(address)
+        self.program_counter = self.memory.read_rom_16(address)
         self.remaining_cycles = 7 - 1 # do not count current cycle twice
         self.total_cycles += 7
 
@@ -108,22 +136,96 @@ class Cpu:
             self.remaining_cycles -= 1
             return
 
-        opcode = instances.memory.read_rom(self.program_counter)
-        try:
-            if instances.debug > 0:
-                self.print_status_summary()
-
-            cpu_instruction = getattr(self, f"fn_0x{opcode:02x}")
-            step, self.remaining_cycles = cpu_instruction()
-            self.remaining_cycles += self.additional_cycle
-            self.total_cycles += self.remaining_cycles
-            self.remaining_cycles -= 1 # Do not count current cycle twice
-            self.additional_cycle = 0
-            self.program_counter += step
-            self.compteur += 1
+        self.remaining_cycles = self.step() - 1 # Do not count current cycle twice
+
+    def step(self):
+        ''' Execute the whole next opcode at once.
+
+        total_cycles still holds the cycle at which the instruction started while the
+        opcode handler runs, so that I/O accesses can be synchronised on it.
+
+        Returns:
+            The number of CPU cycles taken by the instruction
+
+        Raises:
+            Exception when opcode is unknown
+        '''
+        opcode = self.memory.read_rom(self.program_counter)
+        if debug.enabled > 0:
+            self.print_status_summary()
+
+        step, cycles = self.opcodes_table[opcode]()
+        cycles += self.additional_cycle
+        self.total_cycles += cycles
+        self.additional_cycle = 0
+        self.program_counter += step
+        self.compteur += 1
+        return cycles
+
+    def run_block(self, scheduler):
+        ''' Execute the cached block of instructions starting at PC.
+
+        Code outside PRG ROM, and any code while debugging, is executed one instruction at a time.
+        The block is left early if the cache gets invalidated, e.g. by a mapper bank switch, or
+        once the scheduler next event deadline is reached. Idle loops are fast forwarded up to
+        the deadline, see BlockCache.is_idle_loop.
+
+        Returns:
+            The number of CPU cycles taken by the executed instructions
+        '''
+        if self.program_counter < 0x8000 or debug.enabled > 0:
+            return self.step()
+
+        block_cache = self.block_cache
+        address = self.program_counter
+        block, is_idle_loop = block_cache.get(address)
+        if not block:
+            return self.step() # Unknown opcode, let step raise the error
+
+        generation = block_cache.generation
+        start_cycles = self.total_cycles
+        executed = 0
+        for execute in block:
+            cycles = execute()
+            self.total_cycles += cycles
+            executed += 1
+            if block_cache.generation != generation or self.total_cycles >= scheduler.cpu_deadline:
+                self.compteur += executed
+                break
+        else:
+            self.compteur += executed
+            if is_idle_loop and self.program_counter == address:
+                self.skip_idle_loop(scheduler, self.total_cycles - start_cycles, len(block))
+        return self.total_cycles - start_cycles
+
+    def skip_idle_loop(self, scheduler, cycles, instructions):
+        '''Fast forward an idle loop which has just run one more iteration, up to the next event
+
+        Every iteration until the next event does the same thing, so the iterations which end
+        before the deadline are credited to the cycles and instructions counters without being
+        run. The last one is run normally, so the deadline is crossed on the same instruction
+        as without skipping.
+
+        Args:
+            scheduler -- the scheduler, which cpu_deadline is the next event
+            cycles -- CPU cycles of one iteration
+            instructions -- instructions of one iteration
+        '''
+        if scheduler.cpu_deadline == math.inf:
             return
-        except KeyError as exception:
-            raise Exception(f"Unknow opcode 0x{opcode:02x} at {' '.join(a+b for a,b in zip(f'{self.program_counter:x}'[::2], f'{self.program_counter:x}'[1::2]))}") from exception
+        iterations = (scheduler.cpu_deadline - 1 - self.total_cycles) // cycles
+        if iterations > 0:
+            self.total_cycles += iterations * cycles
+            self.compteur += iterations * instructions
+
+    def fn_unknown(self):
+        '''Sentinel handler for opcodes missing from the dispatch table
+
+        Raises:
+            Exception always, with the opcode and its address
+        '''
+        opcode = self.memory.read_rom(self.program_counter)
+        raise Exception(f"Unknow opcode 0x{opcode:02x} at {format_hex_data(self.program_counter)}")
 
     def get_cpu_status(self):
         ''' Return a dictionnary containing the current CPU Status. Usefull for debugging'''
@@ -135,10 +237,18 @@ class Cpu:
         status["Y"] = self.y_register
         status["P"] = self.get_status_register()
         status["CYC"] = self.total_cycles
-        status["PPU_LINE"] = instances.ppu.line
-        status["PPU_COL"] = instances.ppu.col
+        status["PPU_LINE"] = self.ppu.line
+        status["PPU_COL"] = self.ppu.col
         return status
 
+    def save_state(self, writer):
+        '''Write registers, flags and cycle counters to a save state'''
+        CPU_STATE.save(writer, self)
+
+    def load_state(self, reader):
+        '''Restore registers, flags and cycle counters from a save state'''
+        CPU_STATE.load(reader, self)
+
     def get_status_register(self):
         '''Returns the P register which contains the flag status.
 
@@ -161,6 +271,8 @@ class Cpu:
         self.carry = status_register & 1
         self.zero = (status_register >> 1) & 1
         self.interrupt = (status_register >> 2) & 1
+        if not self.interrupt:
+            self.nes.on_irq_unmasked()
         self.decimal = (status_register >> 3) & 1
         #self.flagB = (status_register >> 4) & 1
         self.overflow = (status_register >> 6) & 1
@@ -168,21 +280,21 @@ class Cpu:
 
     def push(self, val):
         '''Push value into stack'''
-        instances.memory.write_rom(0x0100 | self.stack_pointer, val)
+        self.memory.write_rom(0x0100 | self.stack_pointer, val)
         self.stack_pointer = 255 if self.stack_pointer == 0 else self.stack_pointer - 1
 
     def pop(self):
         '''Pop value from stack'''
         self.stack_pointer = 0 if self.stack_pointer == 255 else self.stack_pointer + 1
-        return instances.memory.read_rom(0x0100 | self.stack_pointer)
+        return self.memory.read_rom(0x0100 | self.stack_pointer)
 
     def get_immediate(self):
         '''Get 8 bit immediate value on PC + 1'''
-        return instances.memory.read_rom(self.program_counter+1)
+        return self.memory.read_rom(self.program_counter+1)
 
     def set_zero_page(self, val):
         '''Write val into Zero Page memory. Address is given as opcode 1-byte argument'''
-        instances.memory.write_rom(self.get_zero_page_address(), val)
+        self.memory.write_rom(self.get_zero_page_address(), val)
 
     def get_zero_page_address(self):
         '''Get ZeroPage address to be used for current opcode. Alias to get_immediate'''
@@ -191,54 +303,54 @@ class Cpu:
     def get_zero_page_value(self):
         '''Get val from Zero Page memory. Address is given as opcode 1-byte argument'''
         address= self.get_immediate()
-        return instances.memory.read_rom(address)
+        return self.memory.read_rom(address)
 
     def set_zero_page_x(self, val):
         '''Write val into Zero Page memory. Address is given as opcode 1-byte argument and X register'''
-        instances.memory.write_rom(self.get_zero_page_x_address(), val)
+        self.memory.write_rom(self.get_zero_page_x_address(), val)
 
     def get_zero_page_x_address(self):
         '''Get ZeroPage address to be used for current opcode and X register'''
-        return (instances.memory.read_rom(self.program_counter+1) + self.x_register) & 255
+        return (self.memory.read_rom(self.program_counter+1) + self.x_register) & 255
 
     def get_zero_page_x_value(self):
         '''Get value at ZeroPage address to be used for current opcode and X register'''
         address = self.get_zero_page_x_address()
-        return instances.memory.read_rom(address)
+        return self.memory.read_rom(address)
 
     def set_zero_page_y(self, val):
         '''Write val into Zero Page memory. Address is given as opcode 1-byte argument and Y register'''
-        instances.memory.write_rom(self.get_zero_page_y_address(), val)
+        self.memory.write_rom(self.get_zero_page_y_address(), val)
 
     def get_zero_page_y_address(self):
         '''Get ZeroPage address to be used for current opcode and Y register'''
-        return  (instances.memory.read_rom(self.program_counter+1) + self.y_register) & 255
+        return  (self.memory.read_rom(self.program_counter+1) + self.y_register) & 255
 
     def get_zero_page_y_value(self):
         '''Get value at ZeroPage address to be used for current opcode and Y register'''
         address = self.get_zero_page_y_address()
-        return instances.memory.read_rom(address)
+        return self.memory.read_rom(address)
 
     def set_absolute(self, val):
         '''Write val into memory. Address is given as opcode 2-byte argument'''
-        instances.memory.write_rom(self.get_absolute_address(), val)
+        self.memory.write_rom(self.get_absolute_address(), val)
 
     def get_absolute_address(self):
         '''Get address given as opcode 2-byte argument'''
-        return instances.memory.read_rom_16(self.program_counter+1)
+        return self.memory.read_rom_16(self.program_counter+1)
 
     def get_absolute_value(self):
         '''Get val from memory. Address is given as opcode 2-byte argument'''
         address = self.get_absolute_address()
-        return instances.memory.read_rom(address)
+        return self.memory.read_rom(address)
 
     def set_absolute_x(self, val, is_additionnal = True):
         '''Write val into memory. Address is given as opcode 2-byte argument and X register'''
-        instances.memory.write_rom(self.get_absolute_x_address(is_additionnal), val)
+        self.memory.write_rom(self.get_absolute_x_address(is_additionnal), val)
 
     def get_absolute_x_address(self, is_additionnal = True):
         '''Get address given as opcode 2-byte argument and X register'''
-        address = instances.memory.read_rom_16(self.program_counter+1)
+        address = self.memory.read_rom_16(self.program_counter+1)
         target_address = (address + self.x_register) & 0xFFFF
         if  is_additionnal and address & 0xFF00 != target_address & 0xFF00:
             self.additional_cycle += 1
@@ -247,15 +359,15 @@ class Cpu:
     def get_absolute_x_value(self, is_additionnal = True):
         '''Get val from memory. Address is given as opcode 2-byte argument and X register'''
         address = self.get_absolute_x_address(is_additionnal)
-        return instances.memory.read_rom(address)
+        return self.memory.read_rom(address)
 
     def set_absolute_y(self, val, is_additionnal = True):
         '''Write val into memory. Address is given as opcode 2-byte argument and Y register'''
-        instances.memory.write_rom(self.get_absolute_y_address(is_additionnal), val)
+        self.memory.write_rom(self.get_absolute_y_address(is_additionnal), val)
 
     def get_absolute_y_address(self, is_additionnal = True):
         '''Get address given as opcode 2-byte argument and Y register'''
-        address = instances.memory.read_rom_16(self.program_counter+1)
+        address = self.memory.read_rom_16(self.program_counter+1)
         target_address = (address + self.y_register) & 0xFFFF
         if is_additionnal and address & 0xFF00 != target_address & 0xFF00:
             self.additional_cycle += 1
@@ -264,26 +376,26 @@ class Cpu:
     def get_absolute_y_value(self, is_additionnal = True):
         '''Get val from memory. Address is given as opcode 2-byte argument and Y register'''
         address = self.get_absolute_y_address(is_additionnal)
-        return instances.memory.read_rom(address)
+        return self.memory.read_rom(address)
 
     def get_indirect_x_address(self):
         '''Get indirect address given as opcode 2-byte argument and X register'''
         address = self.get_zero_page_x_address()
-        return instances.memory.read_rom_16_no_crossing_page(address)
+        return self.memory.read_rom_16_no_crossing_page(address)
 
     def get_indirect_x_value(self):
         '''Get val from memory. Indirect address is given as opcode 2-byte argument and X register'''
         address = self.get_indirect_x_address()
-        return instances.memory.read_rom(address)
+        return self.memory.read_rom(address)
 
     def set_indirect_x(self, val):
         '''Write val into memory. Indirect address is given as opcode 2-byte argument and X register'''
-        instances.memory.write_rom(self.get_indirect_x_address(), val)
+        self.memory.write_rom(self.get_indirect_x_address(), val)
 
     def get_indirect_y_address(self, is_additionnal = True):
         '''Get indirect address given as opcode 2-byte argument and Y register'''
         address = self.get_zero_page_address()
-        address = instances.memory.read_rom_16_no_crossing_page(address )
+        address = self.memory.read_rom_16_no_crossing_page(address )
         target_address = 0xFFFF & (address + self.y_register)
         if is_additionnal and address & 0xFF00 != target_address & 0xFF00:
             self.additional_cycle += 1
@@ -292,11 +404,11 @@ class Cpu:
     def get_indirect_y_value(self, is_additionnal = True):
         '''Get val from memory. Indirect address is given as opcode 2-byte argument and Y register'''
         address = self.get_indirect_y_address(is_additionnal)
-        return instances.memory.read_rom(address)
+        return self.memory.read_rom(address)
 
     def set_indirect_y(self, val, is_additionnal = True):
         '''Write val into memory. Indirect address is given as opcode 2-byte argument and Y register'''
-        instances.memory.write_rom(self.get_indirect_y_address(is_additionnal), val)
+        self.memory.write_rom(self.get_indirect_y_address(is_additionnal), val)
 
     def set_flags_nz(self, val):
         '''Sets flags N and Z according to value'''
@@ -483,7 +595,7 @@ class Cpu:
         if self.negative == 0:
             self.program_counter += signed
             self.additional_cycle += 1
-            if self.program_counter & 0xFF00 != old_pc & 0xFF00:
+            if (self.program_counter + 2) & 0xFF00 != old_pc & 0xFF00:
                 self.additional_cycle += 1
         return (2, 2)
 
@@ -495,7 +607,7 @@ class Cpu:
         if self.negative == 1:
             self.program_counter += signed
             self.additional_cycle += 1
-            if self.program_counter & 0xFF00 != old_pc & 0xFF00:
+            if (self.program_counter + 2) & 0xFF00 != old_pc & 0xFF00:
                 self.additional_cycle += 1
         return (2, 2)
 
@@ -503,11 +615,14 @@ class Cpu:
     # Relative
     def fn_0x50(self) :
         '''Function call for BVC #$xx. Relative'''
+        old_pc = self.program_counter + 2
         unsigned = self.get_immediate()
         signed = unsigned - 256 if unsigned > 127 else unsigned
         if self.overflow == 0:
             self.program_counter += signed
             self.additional_cycle += 1
+            if (self.program_counter + 2) & 0xFF00 != old_pc & 0xFF00:
+                self.additional_cycle += 1
         return (2, 2)
 
     def fn_0x70(self) :
@@ -518,7 +633,7 @@ class Cpu:
         if self.overflow == 1:
             self.program_counter += signed
             self.additional_cycle += 1
-            if self.program_counter & 0xFF00 != old_pc & 0xFF00:
+            if (self.program_counter + 2) & 0xFF00 != old_pc & 0xFF00:
                 self.additional_cycle += 1
         return (2, 2)
 
@@ -530,7 +645,7 @@ class Cpu:
         if self.carry == 0:
             self.program_counter += signed
             self.additional_cycle += 1
-            if self.program_counter & 0xFF00 != old_pc & 0xFF00:
+            if (self.program_counter + 2) & 0xFF00 != old_pc & 0xFF00:
                 self.additional_cycle += 1
         return (2, 2)
 
@@ -542,7 +657,7 @@ class Cpu:
         if self.carry == 1:
             self.program_counter += signed
             self.additional_cycle += 1
-            if self.program_counter & 0xFF00 != old_pc & 0xFF00:
+            if (self.program_counter + 2) & 0xFF00 != old_pc & 0xFF00:
                 self.additional_cycle += 1
         return (2, 2)
 
@@ -554,7 +669,7 @@ class Cpu:
         if self.zero == 0:
             self.program_counter += signed
             self.additional_cycle += 1
-            if self.program_counter & 0xFF00 != old_pc & 0xFF00:
+            if (self.program_counter + 2) & 0xFF00 != old_pc & 0xFF00:
                 self.additional_cycle += 1
         return (2, 2)
 
@@ -577,7 +692,7 @@ class Cpu:
         self.push(self.program_counter >> 8)
         self.push(self.program_counter & 255)
         self.push(self.get_status_register() | (1 << 4)) # BRK sets Break flag to 1
-        self.program_counter = instances.memory.read_rom_16(0xFFFE)
+        self.program_counter = self.memory.read_rom_16(0xFFFE)
         return (0, 7)
 
     def cmp(self, op1, op2) :
@@ -894,6 +1009,7 @@ class Cpu:
         Clear interrupt flag
         '''
         self.interrupt = 0
+        self.nes.on_irq_unmasked()
         return (1, 2)
 
     def fn_0x78(self) :
@@ -970,10 +1086,10 @@ class Cpu:
         address = self.get_absolute_address()
         if address & 0xFF == 0xFF: # Strange behaviour in nestest.nes where direct jump to re-aligned address where address at end of page
             address += 1
-            if instances.debug :  print(f"JMP address : {address:4x}")
+            if debug.enabled :  print(f"JMP address : {address:4x}")
         else:
-            address = instances.memory.read_rom_16(address)
-        if instances.debug : print(f"JMP address : {address:4x}")
+            address = self.memory.read_rom_16(address)
+        if debug.enabled : print(f"JMP address : {address:4x}")
         self.program_counter = address
         return (0, 5)
 
@@ -1074,7 +1190,7 @@ class Cpu:
     def fn_0xa4(self) :
         '''Function call for LDY $xx. Zero Page'''
         self.y_register = self.get_zero_page_value()
-        self.set_flags_nz(self.x_register)
+        self.set_flags_nz(self.y_register)
         return (2, 3)
 
     def fn_0xb4(self) :
@@ -1916,43 +2032,43 @@ class Cpu:
     def fn_0x85(self) :
         '''Function call for STA $xx. Zero Page'''
         address = self.get_zero_page_address()
-        extra_cycles = instances.memory.write_rom(address, self.accumulator)
+        extra_cycles = self.memory.write_rom(address, self.accumulator)
         return (2, 3 + extra_cycles)
 
     def fn_0x95(self) :
         '''Function call for STA $xx, X. Zero Page, X'''
         address = self.get_zero_page_x_address()
-        extra_cycles = instances.memory.write_rom(address, self.accumulator)
+        extra_cycles = self.memory.write_rom(address, self.accumulator)
         return (2, 4 + extra_cycles)
 
     def fn_0x8d(self) :
         '''Function call for STA $xxxx. Absolute'''
         address = self.get_absolute_address()
-        extra_cycles = instances.memory.write_rom(address, self.accumulator)
+        extra_cycles = self.memory.write_rom(address, self.accumulator)
         return (3, 4 + extra_cycles)
 
     def fn_0x9d(self) :
         '''Function call for STA $xxxx, X. Absolute, X'''
         address = self.get_absolute_x_address(False) # No additionnal cycles on STA
-        extra_cycles = instances.memory.write_rom(address, self.accumulator)
+        extra_cycles = self.memory.write_rom(address, self.accumulator)
         return (3, 5 + extra_cycles)
 
     def fn_0x99(self) :
         '''Function call for STA $xxxx, Y. Absolute, Y'''
         address = self.get_absolute_y_address(False) # No additionnal cycles on STA
-        extra_cycles = instances.memory.write_rom(address, self.accumulator)
+        extra_cycles = self.memory.write_rom(address, self.accumulator)
         return (3, 5 + extra_cycles)
 
     def fn_0x81(self) :
         '''Function call for STA ($xx, X). Indirect, X'''
         address = self.get_indirect_x_address()
-        extra_cycles = instances.memory.write_rom(address, self.accumulator)
+        extra_cycles = self.memory.write_rom(address, self.accumulator)
         return (2, 6 + extra_cycles)
 
     def fn_0x91(self) :
         '''Function call for STA ($xx), Y. Indirect, Y'''
         address = self.get_indirect_y_address(False) # No additionnal cycles on STA
-        extra_cycles = instances.memory.write_rom(address, self.accumulator)
+        extra_cycles = self.memory.write_rom(address, self.accumulator)
         return (2, 6 + extra_cycles)
 
     def fn_0x9a(self) :
@@ -1993,37 +2109,37 @@ class Cpu:
     def fn_0x86(self) :
         '''Function call for STX $xx. Zero Page'''
         address = self.get_zero_page_address()
-        instances.memory.write_rom(address, self.x_register)
+        self.memory.write_rom(address, self.x_register)
         return (2, 3)
 
     def fn_0x96(self) :
         '''Function call for STX $xx, Y. Zero Page, Y'''
         address = self.get_zero_page_y_address()
-        instances.memory.write_rom(address, self.x_register)
+        self.memory.write_rom(address, self.x_register)
         return (2, 4)
 
     def fn_0x8e(self) :
         '''Function call for STX $xxxx. Absolute'''
         address = self.get_absolute_address()
-        instances.memory.write_rom(address, self.x_register)
+        self.memory.write_rom(address, self.x_register)
         return (3, 4)
 
     def fn_0x84(self) :
         '''Function call for STY $xx. Zero Page'''
         address = self.get_zero_page_address()
-        instances.memory.write_rom(address, self.y_register)
+        self.memory.write_rom(address, self.y_register)
         return (2, 3)
 
     def fn_0x94(self) :
         '''Function call for STY $xx, X. Zero Page, X'''
         address = self.get_zero_page_x_address()
-        instances.memory.write_rom(address, self.y_register)
+        self.memory.write_rom(address, self.y_register)
         return (2, 4)
 
     def fn_0x8c(self) :
         '''Function call for STY $xxxx. Absolute'''
         address = self.get_absolute_address()
-        instances.memory.write_rom(address, self.y_register)
+        self.memory.write_rom(address, self.y_register)
         return (3, 4)
 
     def fn_0xa7(self) :
@@ -2107,7 +2223,7 @@ class Cpu:
 
     def print_status_summary(self) :
         '''Debug print of status'''
-        opcode = instances.memory.read_rom(self.program_counter)
+        opcode = self.memory.read_rom(self.program_counter)
         label = OPCODES[opcode][1]
         match = re.search(r'[0-9]+', label)
         if match:
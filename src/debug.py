@@ -1,29 +1,38 @@
 '''Debugging tools'''
 from doctest import debug_script
-import pygame
-import instances
+import numpy
 from ppu import PALETTE
+from tile_cache import TILE_COUNT
 
 ERROR = 1
 WARN = 2
 DEBUG = 4
 
+# Disabling invalid-name pylint control since this is a setting, not a constant
+# pylint: disable=C0103
+# Set to print debug messages and CPU traces, for every console of the process
+enabled = 0
+
 def log(class_name, level, message):
     '''Print a log message depending on given parameters'''
-    if instances.debug :
+    if enabled :
         print(message)
 
-def dump_chr():
-    """ Display the tiles in CHR Memory. Useful for debugging."""
-    scale = instances.ppu.scale
-    print(len(instances.cartridge.chr_rom)/16)
+def dump_chr(console):
+    """ Display the tiles in CHR Memory of console, in its window. Useful for debugging."""
+    # Disabling import-outside-toplevel pylint control, pygame must not be required to log
+    # pylint: disable=C0415
+    import pygame
+    scale = console.ppu.scale
+    cartridge = console.cartridge
+    print(len(cartridge.chr_rom)/16)
     x_pos = 2
     y_pos = 2
-    for counter in range(len(instances.cartridge.chr_rom)//16):
+    for counter in range(min(len(cartridge.chr_rom)//16, TILE_COUNT)):
 
-        tile = create_tile(instances.cartridge.get_tile(0, counter))
+        tile = create_tile(cartridge.tile_cache.get_tile(counter))
         tile = pygame.transform.scale(tile, (int(8 * scale), int(8 * scale)))
-        instances.nes.display.blit(tile, (x_pos, y_pos))
+        console.nes.video.display.blit(tile, (x_pos, y_pos))
         if (x_pos +  10 * scale)  > 256 * scale:
             x_pos = 2
             y_pos += 10 * scale
@@ -33,28 +42,17 @@ def dump_chr():
     pygame.display.update()
     pygame.display.flip()
 
-def create_tile(array_of_byte):
-    """ Create a tile pygame surface from tile array of bytes and palette address
+def create_tile(rows):
+    """ Create a tile pygame surface from decoded tile rows, with a default palette
 
     Arguments:
-    array_of_byte -- The 8 bytes to make a surface from
-    palette_address -- The palette to use, from 0 to 4. -1 is used for default palette
-    is_sprite -- Allows to select between background and sprite palettes
+    rows -- The 8 rows of 8 color codes to make a surface from, as returned by the tile cache
     """
+    # pylint: disable=C0415
+    import pygame
+
+    palette = numpy.array([(0, 0, 0, 0)] + [(*PALETTE[index], 255) for index in (0x23, 0x27, 0x30)], dtype=numpy.uint8)
+    color_codes = numpy.frombuffer(b''.join(rows), dtype=numpy.uint8).reshape(8, 8)
 
-    surface = pygame.Surface((8, 8), pygame.SRCALPHA)
-    palette = []
-    palette.append((0, 0, 0, 0))
-    palette.append(PALETTE[0x23])
-    palette.append(PALETTE[0x27])
-    palette.append(PALETTE[0x30])
-
-    for i in range(8):
-        for j in range(8):
-            bit1 = (array_of_byte[i] >> (7-j)) & 1
-            bit2 = (array_of_byte[8 + i] >> (7-j)) & 1
-            color_code = bit1 | (bit2 << 1)
-            surface.set_at((j, i), palette[color_code])
-
-    return surface
+    return pygame.image.frombuffer(palette[color_codes].tobytes(), (8, 8), 'RGBA').copy()
 
@@ -6,20 +6,33 @@ __version__ = '0.0.0'
 __date__ = '2022/01/19'
 
 import sys
+import time
 import optparse
-from nes_emulator import NesEmulator
-from ppu import Ppu
-from cpu import Cpu
-from apu import Apu
-from memory import Memory
-from cartridge import Cartridge
-import instances
-import debug
+from console import Console
+from movie import Movie
+import batch
+import bench
 
 arguments = sys.argv[1:]
 
-oParser = optparse.OptionParser(usage='usage: %prog [options] Rom_filename\n' + __description__, version='%prog ' + __version__)
+# Batch workers are forked, this check keeps a re-imported main module from running anything
+if arguments[:1] == ['batch'] and __name__ == '__main__':
+    sys.exit(batch.main(arguments[1:]))
+if arguments[:1] == ['bench'] and __name__ == '__main__':
+    sys.exit(bench.main(arguments[1:]))
+
+oParser = optparse.OptionParser(usage='usage: %prog [options] Rom_filename\n       %prog batch [options] Rom_filename...\n       %prog bench [options] [Rom_filename]\n' + __description__, version='%prog ' + __version__)
 oParser.add_option('-t', '--test_log', type="str", default=None, help='Activate test mode and set est log file', action="store", dest="test_file")
+oParser.add_option('-s', '--scheduler', type="choice", choices=['cycle', 'instruction', 'block'], default='cycle', help='Scheduler mode: cycle (default), instruction or block', action="store", dest="scheduler")
+oParser.add_option('--headless', default=False, help='Run without window, frames are only kept in memory', action="store_true", dest="headless")
+oParser.add_option('--rewind', type="int", default=0, help='Keep the last SECONDS of play to rewind them with backspace', action="store", dest="rewind", metavar="SECONDS")
+oParser.add_option('--run-ahead', type="int", default=0, help='Emulate FRAMES ahead on each frame to hide input latency', action="store", dest="run_ahead", metavar="FRAMES")
+oParser.add_option('--record', type="str", default=None, help='Record the inputs of the run into a movie file, written on quit', action="store", dest="record", metavar="FILE")
+oParser.add_option('--play', type="str", default=None, help='Replay the inputs of a movie file, then quit', action="store", dest="play", metavar="FILE")
+oParser.add_option('--turbo', default=False, help='Run as fast as possible instead of real time, without sound. Tab toggles it', action="store_true", dest="turbo")
+oParser.add_option('--telemetry', type="str", default=None, help='Write per frame performance records to FILE on quit, as CSV if it ends with .csv, JSON otherwise', action="store", dest="telemetry", metavar="FILE")
+oParser.add_option('--no-idle-skip', default=True, help='Run idle loops in full instead of skipping them to the next event in block mode', action="store_false", dest="idle_skip")
+oParser.add_option('-r', '--renderer', type="choice", choices=['dot', 'scanline'], default='dot', help='PPU renderer: dot (default) or scanline', action="store", dest="renderer")
 
 (options, args) = oParser.parse_args(arguments)
 
@@ -32,20 +45,40 @@ parser.add_argument('-t test_file', type=argparse.FileType('r'), required = Fals
 args = parser.parse_args()
 '''
 
-instances.init()
-instances.memory = Memory()
-instances.ppu = Ppu()
-instances.cpu = Cpu()
-instances.apu = Apu()
-instances.cartridge = Cartridge()
-instances.nes = NesEmulator()
-instances.cartridge.parse_rom(args[0])
+console = Console(options.headless)
+console.load_rom(args[0])
+console.nes.set_scheduler_mode(options.scheduler)
+console.ppu.set_renderer(options.renderer)
+console.nes.set_run_ahead(options.run_ahead)
+console.nes.set_turbo(options.turbo)
+console.nes.set_idle_loop_skipping(options.idle_skip)
+if options.rewind:
+    console.nes.enable_rewind(options.rewind)
+if options.record:
+    console.nes.record_movie()
+if options.play:
+    console.nes.play_movie(Movie.load(options.play))
 
-debug.dump_chr()
+if not options.headless:
+    # debug drawing functions rely on pygame, only imported along with the window
+    import debug
+    debug.dump_chr(console)
 
 if options.test_file:
-    instances.nes.set_test_mode(open(options.test_file, 'r'))
-    #instances.nes.start(0xC000)
-    instances.nes.start()
+    console.nes.set_test_mode(options.test_file)
+    #console.nes.start(0xC000)
+    console.nes.start()
 else:
-    instances.nes.start()
+    start = time.perf_counter()
+    console.nes.start()
+    if options.record:
+        console.nes.movie.stop().save(options.record)
+    if options.telemetry:
+        console.nes.telemetry.dump(options.telemetry)
+    if options.play:
+        player = console.nes.movie
+        elapsed = time.perf_counter() - start
+        frames = console.nes.frame_count - player.first_frame
+        print(f"Movie {'replayed' if player.is_finished else 'interrupted'}: {frames} frames in {elapsed:.3f} s, {frames / elapsed:.1f} FPS")
+        if player.is_finished:
+            print(f"Final RAM {'matches' if player.check() else 'differs from'} the recording")
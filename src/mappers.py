@@ -1,28 +1,36 @@
 '''Cartridge mappers' implementations'''
 import sys
-import instances
+from state import StateFields
 
 # Preventing direct execution
 if __name__ == '__main__':
     print("This module cannot be executed. Please use main.py")
     sys.exit()
 
+# Bank registers saved in save states, PRG RAM is saved as a buffer
+MAPPER0_STATE = StateFields(('prg_bank', 'B'),)
+
 # Disabling no-self-use pylint control
 # pylint: disable=R0201
 class Mapper0:
     '''Class to handle mapper type 0'''
 
-    def __init__(self):
+    def __init__(self, cartridge):
+        self.cartridge = cartridge
+        # Identifies the current PRG ROM mapping. Mapper 0 never switches banks
+        self.prg_bank = 0
+        self.prg_ram = bytearray(b'\0' * 0x2000)
+
         # If mapper = 0 and only 16kB of data, bank loaded twice
-        if instances.cartridge.prg_rom_size == 16 * 1024:
-            instances.cartridge.prg_rom.extend(instances.cartridge.prg_rom)
+        if self.cartridge.prg_rom_size == 16 * 1024:
+            self.cartridge.prg_rom.extend(self.cartridge.prg_rom)
 
-        if instances.cartridge.prg_rom_size == 0x1000:
-            instances.cartridge.chr_rom.extend(instances.cartridge.chr_rom)
+        if self.cartridge.prg_rom_size == 0x1000:
+            self.cartridge.chr_rom.extend(self.cartridge.chr_rom)
 
     def read_prg_rom(self, address):
         '''Read PRG ROM from cartridge'''
-        return instances.cartridge.prg_rom[address]
+        return self.cartridge.prg_rom[address]
 
     def write_prg_rom(self, address, value):
         '''Write PRG ROM from cartridge. Not implemented in mapper 0'''
@@ -30,19 +38,37 @@ class Mapper0:
 
     def read_chr_rom(self, address):
         '''Read ROM from cartridge.'''
-        return instances.cartridge.chr_rom[address]
+        return self.cartridge.chr_rom[address]
 
     def write_chr_rom(self, address, value):
         '''Write CHR ROM from cartridge. Not implemented in mapper 0'''
         raise Exception("Mapper 0 doesn't allow to write on CHR ROM")
 
     def read_ram(self, address):
-        '''Read ROM from cartridge. Task will be delegate to mapper'''
-        return instances.cartridge.chr_rom[address]
+        '''Read PRG RAM from cartridge.'''
+        return self.prg_ram[address]
 
     def write_ram(self, address, value):
-        '''Read ROM from cartridge. Task will be delegate to mapper'''
-        instances.cartridge.chr_rom[address] = value
+        '''Write PRG RAM from cartridge.'''
+        self.prg_ram[address] = value
+
+    def get_prg_rom_page(self, address):
+        '''Return the 256 bytes PRG ROM page mapped at address, as a memoryview'''
+        return memoryview(self.cartridge.prg_rom)[address:address + 0x100]
+
+    def get_prg_ram_page(self, address):
+        '''Return the 256 bytes PRG RAM page mapped at address, as a memoryview'''
+        return memoryview(self.prg_ram)[address:address + 0x100]
+
+    def save_state(self, writer):
+        '''Write bank registers and PRG RAM to a save state'''
+        MAPPER0_STATE.save(writer, self)
+        writer.write_buffer(self.prg_ram)
+
+    def load_state(self, reader):
+        '''Restore bank registers and PRG RAM from a save state. PRG RAM is updated in place, being mapped by memoryviews'''
+        MAPPER0_STATE.load(reader, self)
+        reader.read_buffer(self.prg_ram)
 
 
 class Mapper1:
@@ -50,4 +76,4 @@ class Mapper1:
     cartridge = 0
 
     def __init__(self, cartridge):
-        instances.cartridge = cartridge
+        self.cartridge = cartridge
@@ -1,68 +1,95 @@
 '''Memory manager and routing module'''
 import sys
-import instances
 import utils
 import debug
+from state import StateFields
 
 # Preventing direct execution
 if __name__ == '__main__':
     print("This module cannot be executed. Please use main.py")
     sys.exit()
 
+# Controllers shift registers saved in save states, internal ram is saved as a buffer
+MEMORY_STATE = StateFields(('ctrl1_status', 'B'), ('ctrl2_status', 'B'))
+
 class Memory:
     '''Handles all memory operations and serves as bus between components'''
 
     def __init__(self):
-        instances.debug = 0
 
         self.internal_ram =  bytearray(b'\0' * 0x800)
+        # XOR of all the bytes of the zero page, maintained on each write once
+        # enable_zero_page_checksum has been called
+        self.zero_page_checksum = 0
+        self.is_zero_page_checksum_enabled = 0
 
         self.ctrl1_status = 0
         self.ctrl2_status = 0
 
-    def read_rom(self, address):
-        '''Lecture de la mémoire, à restucturer comme suit:
-            0x0000 to 0x1fff : internal ram
+        # Page tables, one entry per 256 bytes page of the CPU address space.
+        # A page either has a backing buffer (a 256 bytes memoryview) or goes through a handler
+        self.read_pages = [None] * 0x100
+        self.write_pages = [None] * 0x100
+        self.read_handlers = [self.read_open_bus] * 0x100
+        self.write_handlers = [self.write_ignored] * 0x100
+        self.map_internal_pages()
+
+        # Peer components, set by connect
+        self.ppu = None
+        self.apu = None
+        self.cartridge = None
+        self.nes = None
+
+    def connect(self, console):
+        '''Keep direct references to the peer components of console'''
+        self.ppu = console.ppu
+        self.apu = console.apu
+        self.cartridge = console.cartridge
+        self.nes = console.nes
+
+    def map_internal_pages(self):
+        '''Fill the page tables for the console side of the memory map:
+            0x0000 to 0x1fff : internal ram, mirrored every 0x800 bytes
             0x2000 to 0x3fff : PPU registers
-            0x4000 to 0x4017 : APU and I/O registers
-            0x4018 to 0x401f : APU and I/O funcitonality normally disabled
-            0x4020 to 0x5fff : Cartridge space but for what ??
+            0x4000 to 0x401f : APU and I/O registers
+        '''
+        internal_ram = memoryview(self.internal_ram)
+        for page in range(0x00, 0x20):
+            offset = (page & 0x7) << 8
+            self.read_pages[page] = internal_ram[offset:offset + 0x100]
+            self.write_pages[page] = internal_ram[offset:offset + 0x100]
+        for page in range(0x20, 0x40):
+            self.read_handlers[page] = self.read_ppu_register
+            self.write_handlers[page] = self.write_ppu_register
+        self.read_handlers[0x40] = self.read_io_register
+        self.write_handlers[0x40] = self.write_io_register
+
+    def map_cartridge(self):
+        '''Fill the page tables for the cartridge side of the memory map:
+            0x4020 to 0x5fff : Cartridge space, left unmapped
             0x6000 to 0x7fff : Cartridge ram
             0x8000 to 0xffff : Cartridge prg_rom
+
+        Must be called again whenever the mapper switches banks.
         '''
-        if address < 0x2000:
-            return self.internal_ram[address % 0x800]
-        if address < 0x4000:
-            address = 0x2000 + (address % 8)
-            match address:
-                #case 0x2000: Write only
-                #case 0x2001: Write only
-                case 0x2002: return instances.ppu.read_0x2002()
-                #case 0x2003: Write only
-                case 0x2004: return instances.ppu.read_0x2004()
-                #case 0x2005: Write only
-                #case 0x2006: Write only
-                case 0x2007: return instances.ppu.read_0x2007()
-        if address < 0x4018:
-            if address == 0x4016: # Handling joystick
-                debug.log(self.__class__, debug.DEBUG, f"Joystick 1 read {self.ctrl1_status:b}")
-                value = self.ctrl1_status & 1
-                self.ctrl1_status = self.ctrl1_status >> 1
-                return value
-            if address == 0x4017: # Handling joystick
-                debug.log(self.__class__, debug.DEBUG, f"Joystick 2 read {self.ctrl1_status:b}")
-                value = self.ctrl2_status & 1
-                self.ctrl2_status = self.ctrl2_status >> 1
-                return value
-            #APU registers
-            return instances.apu.read_register(address)
-        #if address < 0x4020:
-        #    '''Normally disabled'''
-        #if address < 0x6000:
-        #    '''Cartrige sapce, but what ?'''
-        if address > 0x6000 and address < 0x8000:
-            return instances.cartridge.read_ram(address - 0x6000)
-        return instances.cartridge.read_prg_rom(address - 0x8000)
+        mapper = self.cartridge.mapper
+        for page in range(0x60, 0x80):
+            ram_page = mapper.get_prg_ram_page((page << 8) - 0x6000)
+            self.read_pages[page] = ram_page
+            self.write_pages[page] = ram_page
+            self.read_handlers[page] = self.read_prg_ram
+            self.write_handlers[page] = self.write_prg_ram
+        for page in range(0x80, 0x100):
+            self.read_pages[page] = mapper.get_prg_rom_page((page << 8) - 0x8000)
+            self.read_handlers[page] = self.read_prg_rom
+            self.write_handlers[page] = self.write_prg_rom
+
+    def read_rom(self, address):
+        '''Read a byte on the CPU bus. See map_internal_pages and map_cartridge for the memory map'''
+        page = self.read_pages[address >> 8]
+        if page is not None:
+            return page[address & 0xff]
+        return self.read_handlers[address >> 8](address)
 
     # NES is Little Endian
     def read_rom_16_no_crossing_page(self, address):
@@ -70,76 +97,150 @@ class Memory:
         high_address = (address & 0xFF00) + ((address + 1) & 0xFF)
 
         debug.log(self.__class__, debug.DEBUG, f"High address : {high_address:04x}, Low address : {address:04x}")
-        high, low = 0, 0
-        if address > 0x7FFF:
-            low = instances.cartridge.read_prg_rom(address - 0x8000)
-            high = instances.cartridge.read_prg_rom(high_address - 0x8000) # So that reading never cross pages
-
-        else:
-            low = self.internal_ram[address]
-            high = self.internal_ram[high_address] # So that reading never cross pages
-        return low + (high <<8)
+        return self.read_rom(address) + (self.read_rom(high_address) << 8) # So that reading never cross pages
 
     def read_rom_16(self, address):
         '''Read 16 bits values allowing crossing pages'''
-        high, low = 0, 0
-        if address > 0x7FFF:
-            low = instances.cartridge.mapper.read_prg_rom(address - 0x8000)
-            high = instances.cartridge.mapper.read_prg_rom(address + 1 - 0x8000)
-        else:
-            low = self.internal_ram[address]
-            high = self.internal_ram[address + 1] # So that reading never cross pages
-        return low + (high <<8)
-
+        return self.read_rom(address) + (self.read_rom(address + 1) << 8)
 
     def write_rom(self, address, value):
-        '''Lecture de la mémoire, à restucturer comme suit:
-            0x0000 to 0x1fff : internal ram
-            0x2000 to 0x3fff : PPU registers
-            0x4000 to 0x4017 : APU and I/O registers
-            0x4018 to 0x401f : APU and I/O funcitonality normally disabled
-            0x4020 to 0x5fff : Cartridge space but for what ??
-            0x6000 to 0x7fff : Cartridge ram
-            0x8000 to 0xffff : Cartridge prg_rom
+        '''Write a byte on the CPU bus. See map_internal_pages and map_cartridge for the memory map
+
+        Returns:
+            0. DMA stalls are scheduled as events
+        '''
+        page = self.write_pages[address >> 8]
+        if page is not None:
+            page[address & 0xff] = value
+            return 0
+        return self.write_handlers[address >> 8](address, value)
+
+    def read_open_bus(self, address):
+        '''Read handler for unmapped pages'''
+        return 0
+
+    def write_ignored(self, address, value):
+        '''Write handler for unmapped pages'''
+        return 0
+
+    def read_ppu_register(self, address):
+        '''Read handler for 0x2000 to 0x3fff, PPU registers mirrored every 8 bytes'''
+        self.nes.sync_bus()
+        match address & 0x7:
+            #case 0: Write only
+            #case 1: Write only
+            case 2: return self.ppu.read_0x2002()
+            #case 3: Write only
+            case 4: return self.ppu.read_0x2004()
+            #case 5: Write only
+            #case 6: Write only
+            case 7: return self.ppu.read_0x2007()
+        return 0
+
+    def write_zero_page(self, address, value):
+        '''Write handler for the zero page and its mirrors: update the checksum, then write'''
+        offset = address & 0xff
+        internal_ram = self.internal_ram
+        self.zero_page_checksum ^= internal_ram[offset] ^ value
+        internal_ram[offset] = value
+        return 0
+
+    def enable_zero_page_checksum(self):
+        '''Maintain the zero page checksum on each write
+
+        Writes to the zero page and its mirrors then go through write_zero_page instead of the
+        page buffers, so this is only enabled by test mode.
         '''
-        if address < 0x2000:
-            self.internal_ram[address % 0x800] = value
-        elif address < 0x4000:
-            address = 0x2000 + (address % 8)
-            match address:
-                case 0x2000: instances.ppu.write_0x2000(value)
-                case 0x2001: instances.ppu.write_0x2001(value)
-                #case' 0x2002: Read only
-                case 0x2003: instances.ppu.write_0x2003(value)
-                case 0x2004: instances.ppu.write_0x2004(value)
-                case 0x2005: instances.ppu.write_0x2005(value)
-                case 0x2006: instances.ppu.write_0x2006(value)
-                case 0x2007: instances.ppu.write_0x2007(value)
-
-        elif address < 0x4018:
-            if address == 0x4014 : # OAMDMA
-                value = value << 8
-                instances.ppu.write_oamdma(bytearray(self.internal_ram[value:value + 0x100]))
-                return 514
-            if address == 0x4016: # Handling joystick
-                debug.log(self.__class__, debug.DEBUG, f"Joystick write {value:b}")
-                if value & 1 == 0:
-                    debug.log(self.__class__, debug.DEBUG, f"Saved {instances.nes.ctrl1.status:b}")
-                    # store joypad value
-                    self.ctrl1_status = instances.nes.ctrl1.status
-                    self.ctrl2_status = instances.nes.ctrl2.status
-            else: #APU registers
-                instances.apu.write_register(address, value)
-        elif address < 0x4020:
-            '''Normally disabled'''
-        elif address < 0x6000:
-            '''Cartridge space, but what ??'''
-        elif address < 0x8000:
-            instances.cartridge.write_ram(address - 0x6000, value)
-        else:
-            instances.cartridge.write_prg_rom(address - 0x8000, value)
+        self.is_zero_page_checksum_enabled = 1
+        self.zero_page_checksum = utils.xor_checksum(self.internal_ram[:0x100])
+        for page in range(0x00, 0x20, 0x8):
+            self.write_pages[page] = None
+            self.write_handlers[page] = self.write_zero_page
+
+    def write_ppu_register(self, address, value):
+        '''Write handler for 0x2000 to 0x3fff, PPU registers mirrored every 8 bytes'''
+        self.nes.sync_bus()
+        self.ppu.write_register(address & 0x7, value)
+        return 0
+
+    def read_io_register(self, address):
+        '''Read handler for 0x4000 to 0x40ff. APU and I/O registers stop at 0x4017'''
+        if address > 0x4017:
+            return 0 # Normally disabled, then cartridge space
+        self.nes.sync_bus()
+        if address == 0x4016: # Handling joystick
+            debug.log(self.__class__, debug.DEBUG, f"Joystick 1 read {self.ctrl1_status:b}")
+            value = self.ctrl1_status & 1
+            self.ctrl1_status = self.ctrl1_status >> 1
+            return value
+        if address == 0x4017: # Handling joystick
+            debug.log(self.__class__, debug.DEBUG, f"Joystick 2 read {self.ctrl1_status:b}")
+            value = self.ctrl2_status & 1
+            self.ctrl2_status = self.ctrl2_status >> 1
+            return value
+        #APU registers
+        return self.apu.read_register(address)
+
+    def write_io_register(self, address, value):
+        '''Write handler for 0x4000 to 0x40ff. APU and I/O registers stop at 0x4017'''
+        if address > 0x4017:
+            return 0 # Normally disabled, then cartridge space
+        self.nes.sync_bus()
+        if address == 0x4014 : # OAMDMA
+            self.ppu.write_oamdma(self.read_page(value))
+            self.nes.schedule_oam_dma()
+            return 0
+        if address == 0x4016: # Handling joystick
+            debug.log(self.__class__, debug.DEBUG, f"Joystick write {value:b}")
+            if value & 1 == 0:
+                debug.log(self.__class__, debug.DEBUG, f"Saved {self.nes.ctrl1.status:b}")
+                if self.nes.movie:
+                    self.nes.movie.on_strobe()
+                # store joypad value
+                self.ctrl1_status = self.nes.ctrl1.status
+                self.ctrl2_status = self.nes.ctrl2.status
+        else: #APU registers
+            self.apu.write_register(address, value)
+        return 0
+
+    def read_prg_ram(self, address):
+        '''Read handler for cartridge ram pages without a backing buffer'''
+        return self.cartridge.mapper.read_ram(address - 0x6000)
+
+    def write_prg_ram(self, address, value):
+        '''Write handler for cartridge ram pages without a backing buffer'''
+        self.cartridge.mapper.write_ram(address - 0x6000, value)
+        return 0
+
+    def read_prg_rom(self, address):
+        '''Read handler for prg_rom pages without a backing buffer'''
+        return self.cartridge.mapper.read_prg_rom(address - 0x8000)
+
+    def write_prg_rom(self, address, value):
+        '''Write handler for prg_rom pages. Usually mapper registers'''
+        self.cartridge.mapper.write_prg_rom(address - 0x8000, value)
         return 0
 
+    def read_page(self, page):
+        '''Return a copy of the 256 bytes of the given page, as seen from the CPU'''
+        if self.read_pages[page] is not None:
+            return bytearray(self.read_pages[page])
+        return bytearray(self.read_rom((page << 8) + i) for i in range(0x100))
+
+    def save_state(self, writer):
+        '''Write internal ram and controllers shift registers to a save state'''
+        MEMORY_STATE.save(writer, self)
+        writer.write_buffer(self.internal_ram)
+
+    def load_state(self, reader):
+        '''Restore internal ram and controllers shift registers from a save state
+
+        internal_ram is updated in place, since the page tables hold views on it.
+        '''
+        MEMORY_STATE.load(reader, self)
+        reader.read_buffer(self.internal_ram)
+        self.zero_page_checksum = utils.xor_checksum(self.internal_ram[:0x100])
+
     def print_status(self):
         '''Print the status of Memory component'''
         print("Memory status")
@@ -153,7 +254,12 @@ class Memory:
         utils.print_memory_page(self.internal_ram, 0x3)
 
     def xor_zero_page(self):
-        xor = 0
-        for i in range(0, 256):
-            xor ^= self.internal_ram[i]
-        return xor
+        '''Return the XOR of all the bytes of the zero page
+
+        The maintained checksum is returned in test mode, where it is read after every instruction.
+        Otherwise the page is scanned: only debug output asks for it, which does not justify
+        taking zero page writes off their page buffers.
+        '''
+        if self.is_zero_page_checksum_enabled:
+            return self.zero_page_checksum
+        return utils.xor_checksum(self.internal_ram[:0x100])
@@ -0,0 +1,157 @@
+'''Input movies: controllers status recorded frame by frame, to replay a run exactly'''
+import sys
+import zlib
+import struct
+
+# Preventing direct execution
+if __name__ == '__main__':
+    print("This module cannot be executed. Please use main.py")
+    sys.exit()
+
+MOVIE_MAGIC = b'YNMV'
+MOVIE_VERSION = 1
+# Magic, version, ROM CRC32, frame count, CRC32 of the internal RAM at the end, starting state length
+MOVIE_HEADER = struct.Struct('<4sHIIII')
+
+class Movie:
+    '''Controllers status of each frame of a run, on a given ROM
+
+    File layout: MOVIE_HEADER, the optional starting save state, then the controller 1 and
+    controller 2 status bytes of each frame. Runs are only reproduced exactly with the
+    scheduler mode they were recorded with.
+
+    Args:
+        rom_crc -- CRC32 of the ROM the movie was recorded on
+        inputs -- two bytes per frame, controller 1 then controller 2 status
+        state -- save state the movie starts from, None to start from power on
+        ram_crc -- CRC32 of the internal RAM after the last frame, to check replays against
+    '''
+    def __init__(self, rom_crc, inputs = b'', state = None, ram_crc = 0):
+        self.rom_crc = rom_crc
+        self.inputs = bytearray(inputs)
+        self.state = state
+        self.ram_crc = ram_crc
+
+    def get_frame_count(self):
+        '''Return the number of frames of the movie'''
+        return len(self.inputs) // 2
+
+    def save(self, file_name):
+        '''Write the movie to a file'''
+        state = self.state or b''
+        with open(file_name, 'wb') as stream:
+            stream.write(MOVIE_HEADER.pack(MOVIE_MAGIC, MOVIE_VERSION, self.rom_crc, self.get_frame_count(), self.ram_crc, len(state)))
+            stream.write(state)
+            stream.write(self.inputs)
+
+    @staticmethod
+    def load(file_name):
+        '''Read a movie from a file'''
+        with open(file_name, 'rb') as stream:
+            data = stream.read()
+        magic, version, rom_crc, frame_count, ram_crc, state_length = MOVIE_HEADER.unpack_from(data)
+        if magic != MOVIE_MAGIC:
+            raise Exception(f"{file_name} is not a movie")
+        if version != MOVIE_VERSION:
+            raise Exception(f"Movie version {version} is not supported, expected {MOVIE_VERSION}")
+        offset = MOVIE_HEADER.size
+        state = data[offset:offset + state_length] if state_length else None
+        offset += state_length
+        inputs = data[offset:offset + 2 * frame_count]
+        if len(inputs) != 2 * frame_count:
+            raise Exception(f"Movie {file_name} is truncated")
+        return Movie(rom_crc, inputs, state, ram_crc)
+
+
+class MovieRecorder:
+    '''Records the controllers status latched by each strobe of $4016, frame by frame
+
+    Frames are counted from the start of the recording. Frames without strobe keep the
+    controllers status at their start. When frames are emulated again after a rewind, the
+    recording is cut back to them.
+
+    Args:
+        nes -- the emulator
+        state -- save state to start the recording from, None to start from power on
+    '''
+    def __init__(self, nes, state = None):
+        self.nes = nes
+        self.state = state
+        self.first_frame = 0
+        self.inputs = bytearray()
+
+    def start(self):
+        '''Begin the recording, after power on'''
+        nes = self.nes
+        if self.state:
+            nes.load_state(self.state)
+        self.first_frame = nes.frame_count
+        self.inputs = bytearray((nes.ctrl1.status, nes.ctrl2.status))
+
+    def on_frame(self):
+        '''Frame listener: start the inputs of the new frame'''
+        nes = self.nes
+        offset = 2 * (nes.frame_count - self.first_frame)
+        del self.inputs[offset:]
+        self.inputs += bytes((nes.ctrl1.status, nes.ctrl2.status))
+
+    def on_strobe(self):
+        '''Record the controllers status about to be latched. Frames run ahead are discarded'''
+        nes = self.nes
+        if nes.is_running_ahead:
+            return
+        offset = 2 * (nes.frame_count - self.first_frame)
+        self.inputs[offset:offset + 2] = bytes((nes.ctrl1.status, nes.ctrl2.status))
+
+    def stop(self):
+        '''End the recording
+
+        Returns:
+            The Movie of the frames completed so far
+        '''
+        nes = self.nes
+        del self.inputs[2 * (nes.frame_count - self.first_frame):]
+        return Movie(nes.cartridge.rom_crc, self.inputs, self.state, zlib.crc32(nes.memory.internal_ram))
+
+
+class MoviePlayer:
+    '''Feeds the controllers status of a movie to each strobe of $4016, instead of live inputs
+
+    The emulator stops once every frame of the movie has been run.
+
+    Args:
+        nes -- the emulator
+        movie -- the Movie to replay
+    '''
+    def __init__(self, nes, movie):
+        self.nes = nes
+        self.movie = movie
+        self.first_frame = 0
+        self.is_finished = 0
+
+    def start(self):
+        '''Begin the replay, after power on'''
+        nes = self.nes
+        if self.movie.rom_crc != nes.cartridge.rom_crc:
+            raise Exception(f"Movie recorded on another ROM, CRC32 {self.movie.rom_crc:08x} instead of {nes.cartridge.rom_crc:08x}")
+        if self.movie.state:
+            nes.load_state(self.movie.state)
+        self.first_frame = nes.frame_count
+        self.is_finished = 0
+
+    def on_frame(self):
+        '''Frame listener: stop the emulation after the last frame of the movie'''
+        if self.nes.frame_count - self.first_frame >= self.movie.get_frame_count():
+            self.is_finished = 1
+            self.nes.running = 0
+
+    def on_strobe(self):
+        '''Set the controllers status of the current frame, about to be latched'''
+        nes = self.nes
+        offset = 2 * (nes.frame_count - self.first_frame)
+        if offset < len(self.movie.inputs):
+            nes.ctrl1.status, nes.ctrl2.status = self.movie.inputs[offset:offset + 2]
+
+    def check(self):
+        '''Return whether the internal RAM matches the end of the recorded run'''
+        return zlib.crc32(self.nes.memory.internal_ram) == self.movie.ram_crc
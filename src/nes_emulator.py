@@ -4,123 +4,473 @@
 import sys
 import time
 import traceback
-import re
-import pygame
-import instances
+import struct
 import inputs
 import utils
 from cpu_opcodes import OPCODES
+from video import create_video_sink
+from audio import create_audio_sink
+from apu import CPU_FREQUENCY
+from scheduler import Scheduler, MASTER_CLOCK_PER_CPU_CYCLE, MASTER_CLOCK_PER_PPU_DOT
+from rewind import Rewind
+from reference_trace import ReferenceTrace
+from movie import MovieRecorder, MoviePlayer
+from telemetry import Telemetry, PPU, APU, VIDEO, AUDIO, STATE
+from state import StateFields, StateReader, StateWriter, STATE_HEADER, STATE_MAGIC, STATE_VERSION
 
 # Preventing direct execution
 if __name__ == '__main__':
     print("This module cannot be executed. Please use main.py")
     sys.exit()
 
+# CPU cycles between two polls of the video sink events while paused, about a frame
+INPUT_POLL_INTERVAL = 29781
+# Frames gone back on each rewind request
+REWIND_STEP = 60
+
+# Names of the events that can be pending when a state is saved. Saved as their index in this tuple
+EVENT_NAMES = ('vblank_start', 'vblank_end', 'nmi', 'irq', 'oam_dma', 'apu_irq', 'dmc_dma')
+EVENT_RECORD = struct.Struct('<Bq') # Name index, master clock timestamp
+NES_STATE = StateFields(('is_nmi', 'B'), ('is_irq', 'B'), ('synced_cycles', 'q'), ('frame_count', 'q'))
+CONTROLLER_STATE = StateFields(('status', 'B'),)
+
 class NesEmulator:
     '''Main class handling the whole emulator execution
 
     Arg:
-        entry_point -- optional ROM entry point for debugging
+        headless -- use a video sink keeping frames in memory instead of a pygame window, and
+        drop audio samples instead of playing them and pacing the emulation
     '''
 
-    def __init__(self):
+    def __init__(self, headless = 0):
         self.is_nmi = 0
         self.is_irq = 0
         self.pause = 0
-        self.test_file = 0
+        self.reference = None # Reference log of the test mode
+        self.test_index = 0
+        self.test_getters = []
         self.test_mode = 0
-
-        pygame.init()
-        self.scale = 2
-
-        self.display = pygame.display.set_mode( (int(256 * self.scale), int(240 * self.scale)))
-        self.display.fill((0, 0, 0))
+        self.running = 1
+        # Frames are sent to the sinks and inputs polled. Cleared while frames are emulated again
+        self.is_presenting = 1
+        # Callbacks run at the start of each frame, once inputs have been polled. Not run on
+        # frames emulated ahead, which are discarded
+        self.frame_listeners = []
+        self.rewinder = None
+        self.rewind_request = 0
+        # Movie recorder or player, started on power on
+        self.movie = None
+        # Frames emulated ahead of the actual one on each frame, to hide input latency
+        self.run_ahead = 0
+        self.is_running_ahead = 0
+        # Samples are not pushed to the audio sink, which then does not pace the emulation
+        self.turbo = 0
+        self.telemetry = Telemetry()
+
+        # 'cycle' steps the CPU one cycle at a time along with the PPU, 'instruction' runs whole
+        # instructions and catches the PPU up when needed, 'block' does the same with cached runs
+        # of PRG ROM instructions
+        self.scheduler_mode = 'cycle'
+        # CPU cycle the PPU has been run until
+        self.synced_cycles = 0
+        self.frame_count = 0
+
+        # Timed events: vblank, interrupts, APU, DMA stalls...
+        self.scheduler = Scheduler()
+
+        self.video = create_video_sink(headless)
+        self.audio = create_audio_sink(headless)
 
         self.ctrl1 = inputs.NesController()
         self.ctrl2 = inputs.NesController()
 
-        self.clock = pygame.time.Clock()
+        # Peer components, set by connect
+        self.cpu = None
+        self.ppu = None
+        self.apu = None
+        self.memory = None
+        self.cartridge = None
+
+    def connect(self, console):
+        '''Keep direct references to the peer components of console'''
+        self.cpu = console.cpu
+        self.ppu = console.ppu
+        self.apu = console.apu
+        self.memory = console.memory
+        self.cartridge = console.cartridge
+
+    def power_on(self, entry_point = None):
+        '''Run the CPU start sequence and schedule the initial events'''
+        self.cpu.start(entry_point)
+        self.scheduler.clear()
+        if self.scheduler_mode != 'cycle':
+            self.synced_cycles = 0
+            self.catch_up(self.cpu.total_cycles)
+            if self.test_mode == 1:
+                self.check_test()
+        else:
+            self.ppu.next()
+            self.ppu.next()
+            self.ppu.next()
+            self.synced_cycles = 1
+        self.schedule_ppu_event('vblank_start', 241, 1, self.on_vblank_start)
+        self.schedule_ppu_event('vblank_end', 261, 1, self.on_vblank_end)
+        self.apu.update_events()
+        self.telemetry.set_counters(self.cpu.compteur, self.cpu.total_cycles)
+        if self.movie:
+            self.movie.start()
+
+    def start(self, entry_point = None):
+        '''Starts the Emulator execution'''
+        self.power_on(entry_point)
+
+        while self.running:
+            if self.rewind_request:
+                self.rewinder.rewind(self.rewind_request)
+                self.rewind_request = 0
+            if self.pause:
+                self.running = self.handle_events()
+                time.sleep(INPUT_POLL_INTERVAL / CPU_FREQUENCY)
+                continue
+            try:
+                if self.run_ahead:
+                    self.run_ahead_frame()
+                else:
+                    self.run_until_deadline()
+                    self.run_events()
+            except Exception as exception:
+                print(exception)
+                self.print_status()
+                print(traceback.format_exc())
+                sys.exit()
+        self.audio.close()
+        if self.rewinder:
+            self.rewinder.close()
+
+    def run_frame(self):
+        '''Run the emulation until the next frame has been completed'''
+        frame_count = self.frame_count
+        while self.frame_count == frame_count and self.running:
+            self.run_until_deadline()
+            self.run_events()
+
+    def run_ahead_frame(self):
+        '''Run a frame, then show the frame run_ahead frames later with current inputs
+
+        The actual frame is run without being presented and its state saved. The next frames
+        are emulated ahead, only the last one being presented with its samples, and inputs are
+        polled at its end. The state is then restored, keeping the new inputs, so that the
+        effect of inputs is shown run_ahead frames earlier. State saving and loading are charged
+        to the 'state' telemetry subsystem, and the time of the frames run ahead is recorded as
+        the run_ahead_time of the next telemetry record.
+        '''
+        self.is_presenting = 0
+        self.run_frame()
+        self.telemetry.enter(STATE)
+        state = self.save_state()
+        self.telemetry.leave()
+        self.is_running_ahead = 1
+        run_ahead_start = time.perf_counter()
+        try:
+            for frame in range(self.run_ahead):
+                self.is_presenting = frame == self.run_ahead - 1
+                self.run_frame()
+        finally:
+            self.is_running_ahead = 0
+            self.is_presenting = 1
+        self.telemetry.add_run_ahead_time(time.perf_counter() - run_ahead_start)
+        polled_inputs = (self.ctrl1.status, self.ctrl2.status)
+        self.telemetry.enter(STATE)
+        self.load_state(state)
+        self.telemetry.leave()
+        self.ctrl1.status, self.ctrl2.status = polled_inputs
+
+    def set_run_ahead(self, frames):
+        '''Set the number of frames emulated ahead on each frame, 0 to disable run-ahead'''
+        if frames < 0:
+            raise Exception(f"Invalid run-ahead frame count {frames}")
+        self.run_ahead = frames
+
+    def run_until_deadline(self):
+        '''Run the CPU straight to the next event deadline
+
+        In block mode, the deadline is checked after each instruction of the block.
+        '''
+        scheduler = self.scheduler
+        cpu = self.cpu
+        if self.scheduler_mode == 'cycle':
+            while self.synced_cycles < scheduler.cpu_deadline:
+                self.next_cycle()
+        elif self.scheduler_mode == 'block' and self.test_mode == 0:
+            while cpu.total_cycles < scheduler.cpu_deadline:
+                cpu.run_block(scheduler)
+        else:
+            while cpu.total_cycles < scheduler.cpu_deadline:
+                cpu.step()
+                if self.test_mode == 1:
+                    self.catch_up(cpu.total_cycles)
+                    self.check_test()
+
+    def run_events(self):
+        '''Run the events that are due'''
+        self.scheduler.run_due(self.get_cycle() * MASTER_CLOCK_PER_CPU_CYCLE)
+
+    def next_cycle(self):
+        '''Run one CPU cycle, then the matching 3 PPU dots'''
+        self.cpu.next()
+        # 3 PPU dots per CPU cycles
+        self.ppu.next()
+        self.ppu.next()
+        self.ppu.next()
+        self.synced_cycles += 1
+
+        if self.test_mode == 1 and self.cpu.remaining_cycles == 0:
+            self.check_test()
+
+    def get_cycle(self):
+        '''Return the current CPU cycle
+
+        In cycle mode, this is the cycle the CPU and PPU are at. Otherwise it is the cycle the
+        instruction being executed started at, the PPU possibly lagging behind.
+        '''
+        if self.scheduler_mode == 'cycle':
+            return self.synced_cycles
+        return self.cpu.total_cycles
 
-        self.apu_toggler = 0
+    def schedule_event(self, name, cycle, callback):
+        '''Schedule callback(cycle) at the given CPU cycle, replacing any pending event with the same name'''
+        self.scheduler.schedule(name, cycle * MASTER_CLOCK_PER_CPU_CYCLE, lambda timestamp: callback(cycle))
 
-        pygame.display.update()
-        pygame.display.flip()
+    def cancel_event(self, name):
+        '''Cancel a pending event'''
+        self.scheduler.cancel(name)
 
+    def schedule_ppu_event(self, name, line, col, callback):
+        '''Schedule callback(cycle) on the CPU cycle by which the PPU has processed dot (line, col)
 
-    def start(self, entry_point = None):
-        '''Starts the Emulator execution'''
-        instances.cpu.start(entry_point)
-        instances.ppu.next()
-        instances.ppu.next()
-        instances.ppu.next()
-        continuer = 1
-        frame_count = 0
-
-        while continuer:
-            if not self.pause:
-                #Check for NMI
-                if self.is_nmi:
-                    self.is_nmi = False
-                    instances.cpu.nmi()
-                if not instances.cpu.interrupt and self.is_irq: # Interrupt flag is ON
-                    self.is_irq = False
-                    instances.cpu.irq()
-                #Check for IRQ
-                try:
-                    #Execute next CPU instruction
-                    instances.cpu.next()
-                    # Execute next APU instruction
-                    if self.apu_toggler : instances.apu.next()
-                    self.apu_toggler = 1 - self.apu_toggler
-                    # 3 PPU dots per CPU cycles
-                    is_frame = 0
-                    is_frame |= instances.ppu.next()
-                    is_frame |= instances.ppu.next()
-                    is_frame |= instances.ppu.next()
-                except Exception as exception:
-                    print(exception)
-                    self.print_status()
-                    print(traceback.format_exc())
-                    sys.exit()
-
-                if self.test_mode == 1 and instances.cpu.remaining_cycles == 0:
-                    self.check_test(instances.cpu.get_cpu_status())
-
-                if is_frame :
-                    frame_count += 1
-                    self.clock.tick(60)
-                    print(f"FPS = {self.clock.get_fps()}")
-
-                #time.sleep(0.01)
-
-            # http://www.pygame.org/docs/ref/key.html
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    continuer = 0
-                elif event.type == pygame.KEYDOWN:
-                    match event.key:
-                        case pygame.K_UP: 		self.ctrl1.set_up()
-                        case pygame.K_DOWN: 	self.ctrl1.set_down()
-                        case pygame.K_LEFT: 	self.ctrl1.set_left()
-                        case pygame.K_RIGHT: 	self.ctrl1.set_right()
-                        case pygame.K_RETURN:   self.ctrl1.set_start()
-                        case pygame.K_ESCAPE:   self.ctrl1.set_select()
-                        case pygame.K_LCTRL: 	self.ctrl1.set_a()
-                        case pygame.K_LALT: 	self.ctrl1.set_b()
-                        case pygame.K_q: 		continuer = 0
-                        case pygame.K_p: 		self.toggle_pause()
-                        case pygame.K_s:        self.print_status()
-
-                elif event.type == pygame.KEYUP:
-                    match event.key:
-                        case pygame.K_UP: 		self.ctrl1.clear_up()
-                        case pygame.K_DOWN: 	self.ctrl1.clear_down()
-                        case pygame.K_LEFT:	    self.ctrl1.clear_left()
-                        case pygame.K_RIGHT: 	self.ctrl1.clear_right()
-                        case pygame.K_RETURN:   self.ctrl1.clear_start()
-                        case pygame.K_ESCAPE:   self.ctrl1.clear_select()
-                        case pygame.K_LCTRL: 	self.ctrl1.clear_a()
-                        case pygame.K_LALT: 	self.ctrl1.clear_b()
+        The next occurrence of the dot is used, from the current PPU position. Usable by mappers
+        needing scanline timed events.
+        '''
+        ppu = self.ppu
+        current = ppu.line * 341 + ppu.col
+        target = line * 341 + col
+        dots = target - current
+        if dots < 0:
+            dots += 262 * 341
+            if ppu.frame_parity > 0:
+                dots -= 1 # Dot (0, 0) is skipped on odd frames
+        timestamp = self.synced_cycles * MASTER_CLOCK_PER_CPU_CYCLE + (dots + 1) * MASTER_CLOCK_PER_PPU_DOT
+        cycle = -(-timestamp // MASTER_CLOCK_PER_CPU_CYCLE)
+        self.scheduler.schedule(name, timestamp, lambda _: callback(cycle))
+
+    def on_vblank_start(self, cycle):
+        '''Dot (241, 1): the PPU completes the frame, sets vblank and raises NMI
+
+        Inputs are polled on each presented frame start, then frame listeners are run. The
+        telemetry record of the frame is written, unless it was run ahead.
+        '''
+        self.catch_up(cycle)
+        self.frame_count += 1
+        self.schedule_ppu_event('vblank_start', 241, 1, self.on_vblank_start)
+        if self.is_presenting:
+            self.telemetry.enter(VIDEO)
+            self.video.end_frame()
+            self.running = self.handle_events()
+            self.telemetry.leave()
+        if not self.is_running_ahead:
+            self.telemetry.end_frame(self.frame_count, self.cpu.compteur, self.cpu.total_cycles)
+            for listener in self.frame_listeners:
+                listener()
+
+    def on_vblank_end(self, cycle):
+        '''Dot (261, 1): the PPU clears vblank'''
+        self.catch_up(cycle)
+        self.schedule_ppu_event('vblank_end', 261, 1, self.on_vblank_end)
+
+    def service_nmi(self, cycle):
+        '''Run the NMI sequence, once the current instruction is completed'''
+        if self.scheduler_mode == 'cycle' and self.cpu.remaining_cycles > 0:
+            self.schedule_event('nmi', self.synced_cycles + self.cpu.remaining_cycles, self.service_nmi)
+            return
+        self.is_nmi = 0
+        self.cpu.nmi()
+
+    def service_irq(self, cycle):
+        '''Run the IRQ sequence, once the current instruction is completed, unless IRQs are masked
+
+        A masked IRQ stays pending until the CPU clears its interrupt flag, see on_irq_unmasked,
+        as long as the IRQ line is asserted. See set_irq_line.
+        '''
+        if not self.is_irq or self.cpu.interrupt:
+            return
+        if self.scheduler_mode == 'cycle' and self.cpu.remaining_cycles > 0:
+            self.schedule_event('irq', self.synced_cycles + self.cpu.remaining_cycles, self.service_irq)
+            return
+        self.cpu.irq()
+
+    def on_irq_unmasked(self):
+        '''To be called by the CPU when it clears its interrupt flag'''
+        if self.is_irq:
+            self.schedule_event('irq', self.get_cycle(), self.service_irq)
+
+    def stall_cpu(self, cycles):
+        '''Stall the CPU for the given number of cycles, for DMA transfers'''
+        cpu = self.cpu
+        cpu.total_cycles += cycles
+        if self.scheduler_mode == 'cycle':
+            cpu.remaining_cycles += cycles
+
+    def schedule_oam_dma(self):
+        '''Schedule the CPU stall of an OAM DMA, after the current instruction'''
+        self.schedule_event('oam_dma', self.get_cycle(), self.on_oam_dma)
+
+    def on_oam_dma(self, cycle):
+        '''OAM DMA stalls the CPU for 513 cycles, plus one when it starts on an odd cycle'''
+        self.stall_cpu(513 + (cycle & 1))
+
+    def catch_up(self, cpu_cycle):
+        '''Advance PPU by 3 dots per CPU cycle until cpu_cycle is reached'''
+        cycles = cpu_cycle - self.synced_cycles
+        if cycles <= 0:
+            return
+        self.telemetry.enter(PPU)
+        self.ppu.run_dots(3 * cycles)
+        self.telemetry.leave()
+        self.synced_cycles = cpu_cycle
+
+    def sync_bus(self):
+        '''Catch PPU up before the CPU touches one of its registers
+
+        In instruction and block modes, the access is assumed to happen on the last base cycle of
+        the instruction being executed. Does nothing in cycle mode where components run in lockstep.
+        '''
+        if self.scheduler_mode != 'cycle':
+            cpu = self.cpu
+            opcode = self.memory.read_rom(cpu.program_counter)
+            self.catch_up(cpu.total_cycles + OPCODES[opcode][3] - 1)
+
+    def get_event_handlers(self):
+        '''Return the callbacks of the events listed in EVENT_NAMES, by name'''
+        return {
+            'vblank_start': self.on_vblank_start,
+            'vblank_end': self.on_vblank_end,
+            'nmi': self.service_nmi,
+            'irq': self.service_irq,
+            'oam_dma': self.on_oam_dma,
+            'apu_irq': self.apu.on_irq_event,
+            'dmc_dma': self.apu.on_dmc_dma_event,
+        }
+
+    def save_state(self):
+        '''Save the whole machine state, to be restored with load_state
+
+        To be called between frames or events, not while an instruction is executed. Settings
+        (scheduler mode, renderer, sinks) are not part of the state.
+
+        Returns:
+            The state as a versioned binary blob
+        '''
+        writer = StateWriter()
+        writer.write(STATE_HEADER.pack(STATE_MAGIC, STATE_VERSION, self.cartridge.rom_crc))
+        self.cpu.save_state(writer)
+        self.memory.save_state(writer)
+        self.ppu.save_state(writer)
+        self.apu.save_state(writer)
+        self.cartridge.save_state(writer)
+        NES_STATE.save(writer, self)
+        CONTROLLER_STATE.save(writer, self.ctrl1)
+        CONTROLLER_STATE.save(writer, self.ctrl2)
+        events = []
+        for name, timestamp in self.scheduler.get_pending():
+            if name not in EVENT_NAMES:
+                raise Exception(f"Event {name} cannot be saved")
+            events.append((EVENT_NAMES.index(name), timestamp))
+        writer.write_records(EVENT_RECORD, events)
+        return writer.get_bytes()
+
+    def load_state(self, state):
+        '''Restore the machine state from a blob returned by save_state, for the same ROM
+
+        Pending events are replaced by the saved ones.
+        '''
+        reader = StateReader(state)
+        magic, version, rom_crc = reader.unpack(STATE_HEADER)
+        if magic != STATE_MAGIC:
+            raise Exception("Not a save state")
+        if version != STATE_VERSION:
+            raise Exception(f"Unsupported save state version {version}")
+        if rom_crc != self.cartridge.rom_crc:
+            raise Exception("Save state was made with another ROM")
+        self.cpu.load_state(reader)
+        self.memory.load_state(reader)
+        self.ppu.load_state(reader)
+        self.apu.load_state(reader)
+        self.cartridge.load_state(reader)
+        NES_STATE.load(reader, self)
+        CONTROLLER_STATE.load(reader, self.ctrl1)
+        CONTROLLER_STATE.load(reader, self.ctrl2)
+        handlers = self.get_event_handlers()
+        self.scheduler.clear()
+        for name_index, timestamp in reader.read_records(EVENT_RECORD):
+            name = EVENT_NAMES[name_index]
+            self.restore_event(name, timestamp, handlers[name])
+        self.telemetry.set_counters(self.cpu.compteur, self.cpu.total_cycles)
+
+    def restore_event(self, name, timestamp, callback):
+        '''Schedule callback(cycle) at timestamp, cycle being the first CPU cycle reaching it'''
+        cycle = -(-timestamp // MASTER_CLOCK_PER_CPU_CYCLE)
+        self.scheduler.schedule(name, timestamp, lambda _: callback(cycle))
+
+    def handle_events(self):
+        '''Process video sink events (keyboard, window closing)
+
+        Returns:
+            0 if the emulator has to quit, 1 otherwise
+        '''
+        return self.video.poll_events(self)
+
+    def display_frame(self, frame):
+        '''Send a frame given as a 240 x 256 array of palette indexes to the video sink
+
+        The APU synthesizes the samples of the frame at the same time, and they are queued for
+        playback. Emulation is paced by the audio sink, which waits for playback to catch up.
+        Nothing is sent while frames are emulated again, and samples are dropped in turbo mode.
+        '''
+        telemetry = self.telemetry
+        telemetry.enter(APU)
+        samples = self.apu.end_frame(self.cpu.total_cycles)
+        telemetry.leave()
+        if self.is_presenting:
+            telemetry.enter(VIDEO)
+            self.video.display_frame(frame)
+            telemetry.leave()
+            if not self.turbo:
+                telemetry.enter(AUDIO)
+                self.audio.push(samples)
+                telemetry.leave()
+
+    def enable_rewind(self, seconds):
+        '''Keep snapshots of the last seconds of play, to be able to rewind'''
+        self.rewinder = Rewind(self, seconds)
+        self.frame_listeners.append(self.rewinder.on_frame)
+
+    def record_movie(self, state = None):
+        '''Record the inputs of each frame from power on, or from the given save state
+
+        The movie is obtained with self.movie.stop()
+        '''
+        self.movie = MovieRecorder(self, state)
+        self.frame_listeners.append(self.movie.on_frame)
+
+    def play_movie(self, movie):
+        '''Replay the inputs of movie from power on, instead of live inputs, then stop'''
+        self.movie = MoviePlayer(self, movie)
+        self.frame_listeners.append(self.movie.on_frame)
+
+    def request_rewind(self):
+        '''Go back REWIND_STEP frames once the current event is completed'''
+        if self.rewinder:
+            self.rewind_request += REWIND_STEP
 
     def reset(self):
         '''Reset the emulator
@@ -136,83 +486,116 @@ class NesEmulator:
 
     def print_status(self):
         '''Display Emulator status'''
-        instances.cpu.print_status()
-        instances.ppu.print_status()
-        instances.memory.print_status()
-        instances.cartridge.print_status()
+        self.cpu.print_status()
+        self.ppu.print_status()
+        self.memory.print_status()
+        self.cartridge.print_status()
+
+    def set_turbo(self, turbo):
+        '''Run as fast as possible when turbo is set, paced by audio playback otherwise'''
+        self.turbo = turbo
+
+    def toggle_turbo(self):
+        '''Toggle turbo mode'''
+        self.set_turbo(not self.turbo)
 
     def toggle_pause(self):
         '''Toggle pause on the emulator execution'''
         self.pause = 1 - self.pause
 
     def raise_nmi(self):
-        '''Raises an NMI interrup'''
+        '''Raises an NMI interrup, serviced after the current instruction'''
         self.is_nmi = 1
+        self.schedule_event('nmi', self.get_cycle(), self.service_nmi)
+
+    def set_irq_line(self, level):
+        '''Set the level of the IRQ line
 
-    def raise_irq(self):
-        '''Raises an IRQ interrup'''
-        self.is_irq = 1
+        IRQs are level triggered: while the line is asserted, an IRQ is serviced after the current
+        instruction whenever IRQs are not masked, again after each RTI until the source is acknowledged.
+        '''
+        if level and not self.is_irq:
+            self.is_irq = 1
+            self.schedule_event('irq', self.get_cycle(), self.service_irq)
+        elif not level and self.is_irq:
+            self.is_irq = 0
+            self.cancel_event('irq')
+
+    def set_scheduler_mode(self, mode):
+        '''Select the scheduler mode: cycle, instruction or block'''
+        if mode not in ('cycle', 'instruction', 'block'):
+            raise Exception(f"Unknown scheduler mode {mode}")
+        self.scheduler_mode = mode
+
+    def set_idle_loop_skipping(self, enabled):
+        '''Enable or disable fast forwarding idle loops to the next event, in block mode'''
+        block_cache = self.cpu.block_cache
+        block_cache.is_skipping_idle_loops = enabled
+        block_cache.clear()
 
     def set_test_mode(self, file_name):
-        '''Activate test mode and set the execution reference file'''
+        '''Activate test mode and set the execution reference log'''
         self.test_mode = 1
-        instances.cpu.test_mode = 1
-        self.test_file = file_name
-
-
-    def check_test(self, cpu_status):
-        ''' Performs test execution against reference execution log to find descrepancies'''
-        reference = self.test_file.readline()
+        self.cpu.test_mode = 1
+        self.memory.enable_zero_page_checksum()
+        self.reference = ReferenceTrace(file_name)
+        self.test_index = 0
+        cpu = self.cpu
+        ppu = self.ppu
+        getters = {
+            'PC': lambda: cpu.program_counter,
+            'A': lambda: cpu.accumulator,
+            'X': lambda: cpu.x_register,
+            'Y': lambda: cpu.y_register,
+            'P': cpu.get_status_register,
+            'SP': lambda: cpu.stack_pointer,
+            'CYC': lambda: cpu.total_cycles,
+            'PPU_LINE': lambda: ppu.line,
+            'PPU_COL': lambda: ppu.col,
+            'ZERO_PAGE': self.memory.xor_zero_page,
+            'P_OAM': ppu.xor_primary_oam,
+            'S_OAM': ppu.xor_secondary_oam,
+        }
+        # Only the fields of the reference log are computed
+        self.test_getters = [getters[name] for name in self.reference.fields]
+
+    def check_test(self):
+        '''Compare the emulator status to the next reference log record
+
+        Both lines are printed and an exception is raised on the first divergence, nothing is
+        printed otherwise.
+        '''
+        index = self.test_index
+        reference = self.reference
+        self.test_index += 1
+        if index >= len(reference):
+            if index == len(reference):
+                print("Test file completed")
+            return
 
-        if reference == "":
-            print("Test file completed")
+        status = tuple(getter() for getter in self.test_getters)
+        if status == reference.expected[index]:
             return
-            #sys.exit()
 
-        opcode = instances.memory.read_rom(cpu_status["PC"])
+        print(self.format_test_status())
+        print(reference.get_line(index))
+        name, value, expected = reference.find_divergence(index, status)
+        raise Exception(f"{name} Error : {value} instead of {expected}, reference line {index + 1}")
+
+    def format_test_status(self):
+        '''Return the current instruction and emulator status, formatted as a reference log line'''
+        cpu_status = self.cpu.get_cpu_status()
+        opcode = self.memory.read_rom(cpu_status["PC"])
 
         opcode_arg_1 = '  '
         opcode_arg_2 = '  '
         if OPCODES[opcode][2] > 1:
-            opcode_arg_1 = f"{instances.memory.read_rom(cpu_status['PC']+1):02x}"
+            opcode_arg_1 = f"{self.memory.read_rom(cpu_status['PC']+1):02x}"
         if OPCODES[opcode][2] > 2:
-            opcode_arg_2 = f"{instances.memory.read_rom(cpu_status['PC']+2):02x}"
-
-
-        cpu_status['ZERO_PAGE'] = instances.memory.xor_zero_page()
-        cpu_status['P_OAM'] = instances.ppu.xor_primary_oam()
-        cpu_status['S_OAM'] = instances.ppu.xor_secondary_oam()
-
-        print(f"{cpu_status['PC']:x}  {opcode:02x} {opcode_arg_1} {opcode_arg_2}  {OPCODES[opcode][1]:30}  A:{cpu_status['A']:02x} X:{cpu_status['X']:02x} Y:{cpu_status['Y']:02x} P:{cpu_status['P']:02x} SP:{cpu_status['SP']:02x} PPU:{instances.ppu.line},{instances.ppu.col: 3} CYC:{cpu_status['CYC']}, ZeroPage:{cpu_status['ZERO_PAGE']:02x},P_OAM:{cpu_status['P_OAM']:02x},S_OAM:{cpu_status['S_OAM']:02x}".upper())
-
-        print(reference)
-        #utils.print_memory_page(instances.memory.internal_ram, 0x0)
-        #utils.print_memory_page(instances.memory.internal_ram, 0x6)
-        #instances.ppu.print_oam()
-
-        ref_status = dict()
-        ref_status['PC'] = int(reference[0:4], 16)
-
-        match = re.findall(r'A:(?P<A>[0-9A-Fa-f]{2}) X:(?P<X>[0-9A-Fa-f]{2}) Y:(?P<Y>[0-9A-Fa-f]{2}) P:(?P<P>[0-9A-Fa-f]{2}) SP:(?P<SP>[0-9A-Fa-f]{2})', reference)
-        ref_status['A']  = int(match[0][0], 16)
-        ref_status['X']  = int(match[0][1], 16)
-        ref_status['Y']  = int(match[0][2], 16)
-        ref_status['P']  = int(match[0][3], 16)
-        ref_status['SP'] = int(match[0][4], 16)
-        match = re.findall(r'CYC:(?P<A>[0-9A-Fa-f]+)', reference)
-        ref_status['CYC']  = int(match[0])
-        match = re.findall(r'PPU:[ ]*([0-9]+),[ ]*([0-9]+)', reference)
-        ref_status['PPU_LINE']  = int(match[0][0])
-        ref_status['PPU_COL']  = int(match[0][1])
-        match = re.findall(r'ZeroPage:(?P<ZP>[0-9A-Fa-f]{2})', reference)
-        ref_status['ZERO_PAGE'] = int(match[0], 16)
-        match = re.findall(r'P_OAM:(?P<POAM>[0-9A-Fa-f]{2}),S_OAM:(?P<SOAM>[0-9A-Fa-f]{2})', reference)
-        ref_status['P_OAM'] = int(match[0][0], 16)
-        ref_status['S_OAM'] = int(match[0][1], 16)
-
-
-
-        for i in ["PC", "A", "X", "Y", "P", "SP", "CYC", "PPU_LINE", "PPU_COL", "ZERO_PAGE", "P_OAM", "S_OAM"]: # On hold : CYC, PPU_LINE, PPU_COL
-            if ref_status[i] != cpu_status[i] :
-                raise Exception(f"{i} Error : {cpu_status[i]} instead of {ref_status[i]}")
-        print("")
+            opcode_arg_2 = f"{self.memory.read_rom(cpu_status['PC']+2):02x}"
+
+        cpu_status['ZERO_PAGE'] = self.memory.xor_zero_page()
+        cpu_status['P_OAM'] = self.ppu.xor_primary_oam()
+        cpu_status['S_OAM'] = self.ppu.xor_secondary_oam()
+
+        return f"{cpu_status['PC']:x}  {opcode:02x} {opcode_arg_1} {opcode_arg_2}  {OPCODES[opcode][1]:30}  A:{cpu_status['A']:02x} X:{cpu_status['X']:02x} Y:{cpu_status['Y']:02x} P:{cpu_status['P']:02x} SP:{cpu_status['SP']:02x} PPU:{self.ppu.line},{self.ppu.col: 3} CYC:{cpu_status['CYC']}, ZeroPage:{cpu_status['ZERO_PAGE']:02x},P_OAM:{cpu_status['P_OAM']:02x},S_OAM:{cpu_status['S_OAM']:02x}".upper()
@@ -1,9 +1,10 @@
 '''The emulator PPU module'''
 import sys
 import time
-import pygame
-import instances
+import struct
+import numpy
 import utils
+from state import StateFields
 
 # Preventing direct execution
 if __name__ == '__main__':
@@ -17,12 +18,33 @@ PALETTE = [
     (236, 238, 236),  	(168, 204, 236),  	(188, 188, 236),  	(212, 178, 236),  	(236, 174, 236),	(236, 174, 212),  	(236, 180, 176),  	(228, 196, 144),  	(204, 210, 120),  	(180, 222, 120),  	(168, 226, 144),  	(152, 226, 180),  	(160, 214, 228),  	(160, 162, 160),	(0,   0,   0),	(0,   0,   0),
 ]
 
+# PALETTE as an array, repeated so that any byte from palette ram can be used as an index
+PALETTE_LUT = numpy.array(PALETTE * 4, dtype=numpy.uint8)
+
+# Translation tables turning a row of color codes into (palette << 2) | color code, one per palette
+PALETTE_TRANSLATIONS = [bytes(((palette << 2) | code) & 0xff for code in range(256)) for palette in range(4)]
+
+# Registers and position saved in save states. Memories are saved as buffers
+PPU_STATE = StateFields(
+    ('register_v', 'H'), ('register_t', 'H'), ('register_x', 'B'), ('register_w', 'B'),
+    ('ppuctrl', 'B'), ('ppumask', 'B'), ('ppustatus', 'B'), ('oamaddr', 'B'), ('ppuscroll', 'H'), ('ppuaddr', 'I'), ('ppudata', 'B'),
+    ('col', 'H'), ('line', 'H'), ('frame_parity', 'B'), ('is_first_sprite_0', 'B'), ('secondary_oam_pointer', 'B'),
+)
+PIXEL_GENERATOR_STATE = StateFields(
+    ('bg_pattern_low_register', 'H'), ('bg_pattern_high_register', 'H'),
+    ('bg_attribute_low_register', 'H'), ('bg_attribute_high_register', 'H'),
+    ('next_nt_byte', 'B'), ('next_attribute', 'B'), ('next_low_bg_tile_byte', 'B'), ('next_high_bg_tile_byte', 'B'),
+)
+# Fetched sprite as (x, row of color codes, palette, priority)
+SPRITE_RECORD = struct.Struct('<B8sBB')
+# Scanline renderer raster write as (first pixel, ppuctrl, ppumask, v, fine x, palette)
+RASTER_WRITE_RECORD = struct.Struct('<HBBHB32s')
+
 class Ppu:
     '''PPU Component. Handles all PPU Operations'''
 
     def __init__(self):
         self.pixel_generator = self.PixelGenerator(self)
-        instances.debug = 0
 
         self.register_v = 0 #  Current VRAM address, 15 bits
         self.register_t = 0 #  Temporary VRAM address, 15 bits. Can be thought of as address of top left onscreen tile
@@ -31,9 +53,13 @@ class Ppu:
 
         self.primary_oam = bytearray(b'\0' * 0x100)
         self.secondary_oam = bytearray(b'\0' * 0x40)
-        self.sprite_count = 0
-        self.sprite_fetcher_count = 0
         self.secondary_oam_pointer = 0
+        # XOR of all the bytes of primary and secondary OAM, maintained on each write
+        self.primary_oam_checksum = 0
+        self.secondary_oam_checksum = 0
+        # Secondary OAM content of each line, rebuilt from primary OAM only when it has changed
+        self.sprite_index = [None] * 262
+        self.is_sprite_index_dirty = 1
 
         self.scale = 2
         self.col = 0
@@ -58,8 +84,30 @@ class Ppu:
         self.ppudata = 0
         self.vram = bytearray(b'\0' * 0x2000)
         self.palette_vram =  bytearray(b'\0' *  0x20)
+
+        # Frame being rendered, as palette indexes. frame_array is a 240 x 256 numpy view on it
+        self.frame_buffer = bytearray(b'\0' * 256 * 240)
+        self.frame_array = numpy.frombuffer(self.frame_buffer, dtype=numpy.uint8).reshape(240, 256)
+
+        # 'dot' renders one pixel per PPU dot, 'scanline' renders a whole line at dot 256
+        self.renderer = 'dot'
+        # Scanline renderer: render states recorded on mid-line register writes, as (first pixel, state)
+        self.raster_writes = []
+        # Scanline renderer: sprites to draw on next line, as (x, row color codes, palette, priority)
+        self.line_sprites = []
+        self.register_writers = [self.write_0x2000, self.write_0x2001, self.write_read_only, self.write_0x2003,
+                                 self.write_0x2004, self.write_0x2005, self.write_0x2006, self.write_0x2007]
         #self.set_ppudata(0)
 
+        # Peer components, set by connect
+        self.cartridge = None
+        self.nes = None
+
+    def connect(self, console):
+        '''Keep direct references to the peer components of console'''
+        self.cartridge = console.cartridge
+        self.nes = console.nes
+
     def read_ppu_memory(self, address):
         '''lecture des addresses PPU Memory map
 
@@ -70,7 +118,7 @@ class Ppu:
         0x3f20 to 0x3fff = Palette ram mirror
         '''
         if address < 0x2000:
-            return instances.cartridge.read_chr_rom(address) # CHR_ROM ADDRESS
+            return self.cartridge.read_chr_rom(address) # CHR_ROM ADDRESS
         if address < 0x3000: # VRAM
             return self.vram[address - 0x2000]
         if address < 0x3F00: # VRAM mirror
@@ -93,7 +141,7 @@ class Ppu:
         0x3f20 to 0x3fff = Palette ram mirror
         '''
         if address < 0x2000:
-            instances.cartridge.write_chr_rom(address, value) # CHR_ROM ADDRESS
+            self.cartridge.write_chr_rom(address, value) # CHR_ROM ADDRESS
         elif address < 0x3000: # VRAM
             self.vram[address - 0x2000] = value
         elif address < 0x3F00: # VRAM mirror
@@ -107,6 +155,33 @@ class Ppu:
         else:
             raise Exception("Out of PPU memory range")
 
+    def set_renderer(self, renderer):
+        '''Select the renderer: dot (default) or scanline'''
+        if renderer not in ('dot', 'scanline'):
+            raise Exception(f"Unknown renderer {renderer}")
+        self.renderer = renderer
+
+    def write_register(self, register, value):
+        '''Write one of the 8 PPU registers from the CPU bus
+
+        With the scanline renderer, writes happening while a visible line is being drawn are
+        recorded with the render state they produce, so that render_scanline can replay them.
+        '''
+        if self.renderer == 'scanline' and self.line < 240 and 1 < self.col <= 256 and register in (0, 1, 5, 6, 7):
+            if not self.raster_writes:
+                self.raster_writes.append((0, self.get_raster_state()))
+            self.register_writers[register](value)
+            self.raster_writes.append((self.col - 1, self.get_raster_state()))
+        else:
+            self.register_writers[register](value)
+
+    def write_read_only(self, value):
+        '''Writes to read only registers are ignored'''
+
+    def get_raster_state(self):
+        '''Return the registers used to render a line, as a tuple'''
+        return (self.ppuctrl, self.ppumask, self.register_v, self.register_x, bytes(self.palette_vram))
+
     def write_0x2000(self, value):
         '''Update PPU internal register when CPU write 0x2000 memory address'''
         self.ppuctrl = value
@@ -134,7 +209,9 @@ class Ppu:
 
     def write_0x2004(self, value):
         '''Update PPU internal register when CPU write 0x2004 memory address - read OAM at oamaddr'''
+        self.primary_oam_checksum ^= self.primary_oam[self.oamaddr] ^ value
         self.primary_oam[self.oamaddr] = value
+        self.is_sprite_index_dirty = 1
 
     def write_0x2005(self, value):
         '''Update PPU internal register when CPU write 0x2005 memory address'''
@@ -188,6 +265,8 @@ class Ppu:
     def write_oamdma(self, value):
         '''Write OAM with memory from main vram passed in value'''
         self.primary_oam[self.oamaddr:] = value
+        self.primary_oam_checksum = utils.xor_checksum(self.primary_oam)
+        self.is_sprite_index_dirty = 1
 
     def inc_hor_v(self):
         '''Increment Horizontal part of v register
@@ -244,22 +323,24 @@ class Ppu:
 
         #Pixel rendering
         if self.line < 240 or self.line == 261: # Normal line
-            if self.col > 0 and self.col < 257:
-                if self.line < 240 and self.is_bg_rendering_enabled():
-                    pixel_color = self.pixel_generator.compute_next_pixel()
-                    instances.nes.display.fill(pixel_color, (((self.col - 1) * self.scale, self.line * self.scale), (self.scale,self.scale)))
+            if self.renderer == 'scanline':
+                self.next_scanline_evaluation()
+            else:
+                if self.col > 0 and self.col < 257:
+                    if self.line < 240 and self.is_bg_rendering_enabled():
+                        self.frame_buffer[(self.line << 8) + self.col - 1] = self.pixel_generator.compute_next_pixel()
 
-            # Nothing happens during Vblank
-            self.next_background_evaluation()
-            self.next_sprite_evaluation()
+                # Nothing happens during Vblank
+                self.next_background_evaluation()
+                self.next_sprite_evaluation()
 
-        if (self.col, self.line) == (1, 241):
-            pygame.display.flip()
+        if self.col == 1 and self.line == 241:
+            self.nes.display_frame(self.frame_array)
             self.set_vblank()
             if (self.ppuctrl >> 7) & 1:
-                instances.nes.raise_nmi()
+                self.nes.raise_nmi()
 
-        if (self.col, self.line) == (1, 261):
+        if self.col == 1 and self.line == 261:
             self.clear_vblank()
             self.clear_sprite0_hit()
             self.is_first_sprite_0 = 0
@@ -274,7 +355,198 @@ class Ppu:
                     self.col = 1
                 self.frame_parity = 1 - self.frame_parity
 
-        return (self.col, self.line) == (0, 0)
+        return self.col == 0 and self.line == 0
+
+    def run_dots(self, count):
+        '''Run count PPU dots
+
+        With the scanline renderer, dots where nothing happens are skipped at once.
+
+        Returns:
+            1 if a frame has been completed, 0 otherwise
+        '''
+        is_frame = 0
+        if self.renderer != 'scanline':
+            for _ in range(count):
+                is_frame |= self.next()
+            return is_frame
+
+        while count > 0:
+            skip = min(self.next_event_col() - self.col, count)
+            self.col += skip
+            count -= skip
+            if count > 0:
+                is_frame |= self.next()
+                count -= 1
+        return is_frame
+
+    def next_event_col(self):
+        '''Return the next column, on current line, where the scanline renderer has something to do'''
+        col = self.col
+        if col <= 1 and (self.line == 241 or self.line == 261):
+            return 1
+        if self.line < 240 or self.line == 261:
+            if col <= 257:
+                return max(col, 256)
+            if self.line == 261 and col < 305:
+                return max(col, 280)
+        return 340 # End of line
+
+    def next_scanline_evaluation(self):
+        '''Scanline renderer counterpart of the per dot background and sprite evaluations'''
+        if self.col == 256:
+            if self.line < 240:
+                self.render_scanline()
+            self.evaluate_sprites()
+            self.fetch_line_sprites()
+            self.inc_vert_v()
+        elif self.col == 257:
+            self.copy_hor_t_to_hor_v()
+        elif self.is_rendering_enabled() and self.line == 261 and self.col > 279 and self.col < 305:
+            self.copy_vert_t_to_vert_v()
+
+    def render_scanline(self):
+        '''Render the 256 pixels of the current line at once
+
+        The line is split in segments, one per render state recorded on mid-line register writes.
+        Background x position of each pixel is (origin + pixel) in the 512 pixels wide space
+        made of the two horizontal nametables.
+        '''
+        segments = self.raster_writes or [(0, self.get_raster_state())]
+        self.raster_writes = []
+        line_offset = self.line << 8
+        sprite_pixels = self.compose_line_sprites()
+
+        origin = 0
+        previous_v = -1
+        previous_x = 0
+        for index, (start, (ppuctrl, ppumask, register_v, register_x, palette)) in enumerate(segments):
+            end = segments[index + 1][0] if index + 1 < len(segments) else 256
+            if register_v != previous_v: # Start of line, or $2006 written: tiles restart from v
+                origin = (((register_v >> 10) & 1) << 8) + ((register_v & 0x1f) << 3) + register_x - start
+            else: # Fine x change only
+                origin += register_x - previous_x
+            previous_v, previous_x = register_v, register_x
+            if start >= end or not (ppumask >> 3) & 1:
+                continue # Background rendering disabled, the frame is left untouched as in dot mode
+
+            bg_pixels = self.fetch_bg_pixels(start, end, origin, ppuctrl, register_v)
+            pixels = bytearray(end - start)
+            for i in range(start, end):
+                bg_pixel = bg_pixels[i - start]
+                sprite_pixel = sprite_pixels[i]
+                # Same decision table as PixelGenerator.multiplexer_decision
+                if sprite_pixel & 3 and (bg_pixel & 3 == 0 or sprite_pixel & 0x20 == 0):
+                    pixels[i - start] = palette[0x10 + (sprite_pixel & 0xf)]
+                elif bg_pixel & 3:
+                    pixels[i - start] = palette[bg_pixel]
+                else:
+                    pixels[i - start] = palette[0]
+            self.frame_buffer[line_offset + start:line_offset + end] = pixels
+
+    def fetch_bg_pixels(self, start, end, origin, ppuctrl, register_v):
+        '''Fetch background pixels start to end of the line, one tile at a time
+
+        Returns:
+            A bytearray of (palette << 2) | color code, one per pixel
+        '''
+        tile_cache = self.cartridge.tile_cache
+        first_tile = ((ppuctrl >> 4) & 1) << 8
+        fine_y = register_v >> 12
+        coarse_y = (register_v >> 5) & 0x1f
+        nametable_y = register_v & 0x800
+        pixels = bytearray(end - start)
+        pixel = start
+        while pixel < end:
+            position = (origin + pixel) & 0x1ff
+            coarse_x = (position >> 3) & 0x1f
+            nametable = 0x2000 | nametable_y | ((position >> 8) << 10)
+            tile = self.read_ppu_memory(nametable | (coarse_y << 5) | coarse_x)
+            attribute = self.read_ppu_memory(nametable | 0x3c0 | ((coarse_y >> 2) << 3) | (coarse_x >> 2))
+            palette = (attribute >> (((coarse_y & 2) << 1) | (coarse_x & 2))) & 0b11
+            row = tile_cache.get_tile(first_tile + tile)[fine_y]
+            first = position & 7
+            count = min(8 - first, end - pixel)
+            pixels[pixel - start:pixel - start + count] = row[first:first + count].translate(PALETTE_TRANSLATIONS[palette])
+            pixel += count
+        return pixels
+
+    def build_sprite_index(self):
+        '''Bucket the 64 OAM sprites by the lines they cross
+
+        Each line entry is None when no sprite crosses it, or a tuple of the secondary OAM content
+        for that line (the first 8 sprites in OAM order, padded with 0xff), the number of sprites
+        copied, the sprite overflow status and the content checksum. Padding is an even number of
+        0xff bytes, so the checksum is the XOR of the copied sprites checksums.
+        '''
+        primary_oam = self.primary_oam
+        sprite_checksums = [primary_oam[i] ^ primary_oam[i + 1] ^ primary_oam[i + 2] ^ primary_oam[i + 3] for i in range(0, 0x100, 4)]
+        buckets = [[] for _ in range(262)]
+        for sprite in range(64):
+            sprite_y_coordinate = self.primary_oam[4 * sprite]
+            for line in range(sprite_y_coordinate, min(sprite_y_coordinate + 8, 262)):
+                buckets[line].append(sprite)
+
+        for line, sprites in enumerate(buckets):
+            if not sprites:
+                self.sprite_index[line] = None
+                continue
+            content = b''.join(self.primary_oam[4 * sprite:4 * sprite + 4] for sprite in sprites[:8])
+            checksum = 0
+            for sprite in sprites[:8]:
+                checksum ^= sprite_checksums[sprite]
+            self.sprite_index[line] = (content.ljust(0x40, b'\xff'), min(len(sprites), 8), len(sprites) > 8, checksum)
+        self.is_sprite_index_dirty = 0
+
+    def evaluate_sprites(self):
+        '''Fill secondary OAM at once with the (up to 8) sprites crossing current line
+
+        Sprite overflow is set when more than 8 sprites cross the line.
+        '''
+        if self.is_sprite_index_dirty:
+            self.build_sprite_index()
+        entry = self.sprite_index[self.line]
+        if entry is None:
+            # Nothing to evaluate, secondary OAM only needs clearing if previous line used it
+            if self.secondary_oam_pointer:
+                self.secondary_oam[:] = b'\xff' * 0x40
+                self.secondary_oam_pointer = 0
+                self.secondary_oam_checksum = 0
+            return
+        content, self.secondary_oam_pointer, is_overflow, self.secondary_oam_checksum = entry
+        self.secondary_oam[:] = content
+        if is_overflow:
+            self.set_sprite_overflow()
+
+    def fetch_line_sprites(self):
+        '''Fetch the pattern rows of sprites in secondary OAM, for the renderers to draw them on next line'''
+        self.line_sprites = []
+        tile_cache = self.cartridge.tile_cache
+        first_tile = ((self.ppuctrl >> 3) & 1) << 8
+        for sprite in range(self.secondary_oam_pointer):
+            y_coordinate, tile_address, attribute, x_coordinate = self.secondary_oam[4 * sprite:4 * sprite + 4]
+            fine_y = self.line - y_coordinate
+            if (attribute >> 7) & 1: # Vertical flip
+                fine_y = 7 - fine_y
+            if (attribute >> 6) & 1: # Horizontal flip
+                row = tile_cache.get_flipped_tile(first_tile + tile_address)[fine_y]
+            else:
+                row = tile_cache.get_tile(first_tile + tile_address)[fine_y]
+            self.line_sprites.append((x_coordinate, row, attribute & 0b11, (attribute >> 5) & 1))
+
+    def compose_line_sprites(self):
+        '''Compose the sprites of the current line
+
+        Returns:
+            A 256 bytes bytearray of priority << 5 | palette << 2 | color code, 0 where there is no sprite
+        '''
+        pixels = bytearray(256)
+        # Reversed so that the first sprites in OAM win
+        for x_coordinate, row, palette, priority in reversed(self.line_sprites):
+            for i in range(min(8, 256 - x_coordinate)):
+                if row[i]:
+                    pixels[x_coordinate + i] = (priority << 5) | (palette << 2) | row[i]
+        return pixels
 
     def next_background_evaluation(self):
         '''Next pixel evaluation and '''
@@ -292,6 +564,7 @@ class Ppu:
     def load_tile_data(self):
         '''8 cycle operation to load next tile data'''
 
+        self.pixel_generator.shift_registers()
         match self.col % 8:
             case 1: #read NT Byte for N+2 tile
                 tile_address = 0x2000 | (self.register_v & 0xfff) # Is it NT or tile address ?
@@ -300,21 +573,23 @@ class Ppu:
             case 3: #read AT Byte for N+2 tile
                 attribute_address = 0x23c0 | (self.register_v & 0xC00) | ((self.register_v >> 4) & 0x38) | ((self.register_v >> 2) & 0x07)
                 at_byte = self.read_ppu_memory(attribute_address)
-                self.pixel_generator.set_at_byte(at_byte)
+                # Select the quadrant from bit 1 of coarse x and coarse y
+                shift = ((self.register_v >> 4) & 4) | (self.register_v & 2)
+                self.pixel_generator.set_at_byte((at_byte >> shift) & 0b11)
             case 5: #read low BG Tile Byte for N+2 tile
                 chr_bank = ((self.ppuctrl >> 4) & 1) * 0x1000
                 fine_y = self.register_v >> 12
-                tile_address = self.pixel_generator.bg_nt_table_register[-1]
+                tile_address = self.pixel_generator.next_nt_byte
                 low_bg_tile_byte = self.read_ppu_memory(chr_bank + 16 * tile_address + fine_y)
                 self.pixel_generator.set_low_bg_tile_byte(low_bg_tile_byte)
             case 7: #read high BG Tile Byte for N+2 tile
                 chr_bank = ((self.ppuctrl >> 4) & 1) * 0x1000
                 fine_y = self.register_v >> 12
-                tile_address = self.pixel_generator.bg_nt_table_register[-1]
+                tile_address = self.pixel_generator.next_nt_byte
                 high_bg_tile_byte = self.read_ppu_memory(chr_bank + 16 * tile_address + 8 + fine_y)
                 self.pixel_generator.set_high_bg_tile_byte(high_bg_tile_byte)
-            case 0: #increment tile number and shift pixel generator registers
-                self.pixel_generator.shift_registers()
+            case 0: #increment tile number and reload pixel generator registers
+                self.pixel_generator.reload_registers()
                 if self.col == 256:
                     self.inc_vert_v()
                 else:
@@ -322,71 +597,14 @@ class Ppu:
 
     def next_sprite_evaluation(self):
         '''Handle the sprite evaluation process'''
-        if self.col > 0 and self.col < 65:
-            '''During those cycles, Secondary OAM is clear on byte after another'''
-            self.secondary_oam[self.col - 1] = 0xff
-        if self.col == 64:
-            self.sprite_count = 0
-            self.secondary_oam_pointer = 0
-
-        if self.secondary_oam_pointer > 7:
-            self.set_sprite_overflow()
-            return # Maximum 8 sprites found per frame
-
-        if self.col > 64 and self.col < 256 and self.sprite_count < 64:
-            '''During those cycles, sprites are actually evaluated'''
-            #Fetch next sprite first byte (y coordinate)
-            sprite_y_coordinate = self.primary_oam[4 * self.sprite_count]
-            self.secondary_oam[self.secondary_oam_pointer * 4] = sprite_y_coordinate
-            if self.line in range(sprite_y_coordinate, sprite_y_coordinate + 8):
-                # Le sprite traverse la scanline, on le copy dans  le secondary oam
-                self.secondary_oam[self.secondary_oam_pointer * 4 + 1] = self.primary_oam[4 * self.sprite_count + 1]
-                self.secondary_oam[self.secondary_oam_pointer * 4 + 2] = self.primary_oam[4 * self.sprite_count + 2]
-                self.secondary_oam[self.secondary_oam_pointer * 4 + 3] = self.primary_oam[4 * self.sprite_count + 3]
-                self.secondary_oam_pointer += 1
-            self.sprite_count += 1
-
-        if self.col == 256:
-            self.sprite_fetcher_count = 0
-            self.pixel_generator.clear_sprite_registers()
-
-        if self.sprite_fetcher_count < self.secondary_oam_pointer and self.col > 256 and self.col < 321:
-            '''During those cycles sprites are actually fetched for rendering in the next line'''
-            match self.col % 8:
-                case 7: # Fetch sprite low and high byte at the same time on 7 instead of spreading over 8 cycles
-                    y_coordinate    = self.secondary_oam[self.sprite_fetcher_count * 4 + 0]
-                    tile_address    = self.secondary_oam[self.sprite_fetcher_count * 4 + 1]
-                    attribute       = self.secondary_oam[self.sprite_fetcher_count * 4 + 2]
-                    x_coordinate    = self.secondary_oam[self.sprite_fetcher_count * 4 + 3]
-
-                    fine_y = self.line - y_coordinate
-
-                    # Flipping
-                    flip_horizontally = (attribute >> 6) & 1
-                    flip_vertically = (attribute >> 7) & 1
-
-                    flipping_offset = 0
-                    if flip_vertically > 0:
-                        flipping_offset = 8
-                    if flip_horizontally > 0:
-                        fine_y = 7 - fine_y
-
-                    chr_bank = ((self.ppuctrl >> 3) & 1) * 0x1000
-                    low_sprite_tile_byte = self.read_ppu_memory(chr_bank + 16 * tile_address + fine_y + flipping_offset)
-
-                    self.pixel_generator.sprite_attribute_table_register.append(attribute)
-                    self.pixel_generator.sprite_x_coordinate_table_register.append(x_coordinate)
-                    self.pixel_generator.sprite_low_byte_table_register.append(low_sprite_tile_byte)
-
-                    flipping_offset = 8
-                    if flip_vertically > 0:
-                        flipping_offset = 0
-
-                    high_sprite_tile_byte = self.read_ppu_memory(chr_bank + 16 * tile_address + fine_y + flipping_offset)
-                    self.pixel_generator.sprite_high_byte_table_register.append(high_sprite_tile_byte)
-
-                    self.sprite_fetcher_count += 1
+        if self.col == 65:
+            '''Secondary OAM clear (cycles 1-64) and sprite evaluation (cycles 65-256) are done at once'''
+            self.evaluate_sprites()
 
+        if self.col == 257:
+            '''Sprites of the next line are fetched during cycles 257-320, done at once'''
+            self.fetch_line_sprites()
+            self.pixel_generator.set_sprites(self.line_sprites)
 
     # https://wiki.nesdev.org/w/index.php?title=PPU_registers
     # https://bugzmanov.github.io/nes_ebook/chapter_6_4.html
@@ -416,6 +634,38 @@ class Ppu:
         '''Clear sprite overflow bit in ppustatus register'''
         self.ppustatus &= 0b11011111
 
+    def save_state(self, writer):
+        '''Write registers, memories and rendering pipeline to a save state'''
+        PPU_STATE.save(writer, self)
+        PIXEL_GENERATOR_STATE.save(writer, self.pixel_generator)
+        writer.write_buffer(self.primary_oam)
+        writer.write_buffer(self.secondary_oam)
+        writer.write_buffer(self.vram)
+        writer.write_buffer(self.palette_vram)
+        writer.write_buffer(self.frame_buffer)
+        writer.write_records(SPRITE_RECORD, self.line_sprites)
+        writer.write_records(SPRITE_RECORD, self.pixel_generator.sprites)
+        writer.write_records(RASTER_WRITE_RECORD, [(start, *state) for start, state in self.raster_writes])
+
+    def load_state(self, reader):
+        '''Restore registers, memories and rendering pipeline from a save state
+
+        Buffers are updated in place, the frame array being a view on frame_buffer.
+        '''
+        PPU_STATE.load(reader, self)
+        PIXEL_GENERATOR_STATE.load(reader, self.pixel_generator)
+        reader.read_buffer(self.primary_oam)
+        reader.read_buffer(self.secondary_oam)
+        reader.read_buffer(self.vram)
+        reader.read_buffer(self.palette_vram)
+        reader.read_buffer(self.frame_buffer)
+        self.line_sprites = reader.read_records(SPRITE_RECORD)
+        self.pixel_generator.set_sprites(reader.read_records(SPRITE_RECORD))
+        self.raster_writes = [(start, tuple(state)) for start, *state in reader.read_records(RASTER_WRITE_RECORD)]
+        self.is_sprite_index_dirty = 1
+        self.primary_oam_checksum = utils.xor_checksum(self.primary_oam)
+        self.secondary_oam_checksum = utils.xor_checksum(self.secondary_oam)
+
     def print_status(self):
         """Print the PPU status"""
         print("PPU")
@@ -437,23 +687,37 @@ class Ppu:
         self.pixel_generator.print_status()
 
     class PixelGenerator:
-        '''This class implement the PPU pixel path, which generate the current pixel'''
+        '''This class implement the PPU pixel path, which generate the current pixel
+
+        Background data is held in the 16-bit shift registers of the real PPU: the high byte
+        holds the tile being drawn and the low byte the next tile. They are shifted by one bit
+        every dot and their low byte is reloaded from the fetch latches every 8 dots.
+        '''
+        __slots__ = ('ppu',
+                     'bg_pattern_low_register', 'bg_pattern_high_register',
+                     'bg_attribute_low_register', 'bg_attribute_high_register',
+                     'next_nt_byte', 'next_attribute', 'next_low_bg_tile_byte', 'next_high_bg_tile_byte',
+                     'sprites')
+
         def __init__(self, ppu):
             self.ppu = ppu
             # Start with two empty tiles
-            self.bg_palette_register = [0, 0]
-            self.bg_low_byte_table_register = [0, 0]
-            self.bg_high_byte_table_register = [0, 0]
-            self.bg_attribute_table_register = [0, 0]
-            self.bg_nt_table_register = [0, 0]
+            self.bg_pattern_low_register = 0
+            self.bg_pattern_high_register = 0
+            self.bg_attribute_low_register = 0
+            self.bg_attribute_high_register = 0
 
-            self.sprite_low_byte_table_register = []
-            self.sprite_high_byte_table_register = []
-            self.sprite_attribute_table_register = []
-            self.sprite_x_coordinate_table_register = []
+            # Latches filled by the fetches, loaded into the shift registers every 8 dots
+            self.next_nt_byte = 0
+            self.next_attribute = 0
+            self.next_low_bg_tile_byte = 0
+            self.next_high_bg_tile_byte = 0
+
+            # Sprites of the line as (x, row of color codes, palette, priority), in OAM order
+            self.sprites = []
 
         def compute_next_pixel(self):
-            '''Compute the pixel to be displayed in current coordinates'''
+            '''Compute the palette index of the pixel to be displayed in current coordinates'''
 
             bg_color_code, bg_color_palette = self.compute_bg_pixel()
             sprite_color_code, sprite_color_palette, priority = self.compute_sprite_pixel()
@@ -462,110 +726,92 @@ class Ppu:
 
         def compute_bg_pixel(self):
             '''Compute the elements for the bg pixel'''
-            fine_x = (instances.ppu.col - 1) % 8 + instances.ppu.register_x # Pixel 0 is outputed at col == 1
-            register_level = 0
-            if fine_x > 7:
-                register_level += 1
-                fine_x -= 8
-
-            bit1 = (self.bg_low_byte_table_register[register_level] >> (7-fine_x)) & 1
-            bit2 = (self.bg_high_byte_table_register[register_level] >> (7-fine_x)) & 1
-            bg_color_code = bit1 | (bit2 << 1)
-
-            attribute = self.bg_attribute_table_register[register_level]
-
-            #la position réelle x et y dépendent du coin en haut à gauche défini par register_t + fine x ou y  + la position réelle sur l'écran
-            shift_x = (instances.ppu.register_t & 0x1f) + (instances.ppu.col - 1) + instances.ppu.register_x
-            shift_y = ((instances.ppu.register_t & 0x3e0) >> 5) + instances.ppu.line + ((instances.ppu.register_t & 0x7000) >> 12)
-
-            # Compute which zone to select in the attribute byte
-            shift = ((1 if shift_x % 32 > 15 else 0) + (2 if shift_y % 32 > 15 else 0)) * 2
-            bg_color_palette = (attribute >> shift) & 0b11
+            shift = 15 - self.ppu.register_x # Fine x selects the bit, counted from the current tile MSB
+            bg_color_code = ((self.bg_pattern_low_register >> shift) & 1) | (((self.bg_pattern_high_register >> shift) & 1) << 1)
+            bg_color_palette = ((self.bg_attribute_low_register >> shift) & 1) | (((self.bg_attribute_high_register >> shift) & 1) << 1)
             return bg_color_code, bg_color_palette
 
         def compute_sprite_pixel(self):
             '''Compute the elements for the sprite pixel if there is one at that position'''
-            for i in range(len(self.sprite_x_coordinate_table_register)):
-                sprite_x = self.sprite_x_coordinate_table_register[i]
-                # TODO : instances.ppu.col must only wrok where no scrolling, use register_v instead ?
-                if instances.ppu.col >= sprite_x and instances.ppu.col < sprite_x + 8:
-                    x_offset = instances.ppu.col %8
-                    bit1 = (self.sprite_low_byte_table_register[i] >> (7-x_offset)) & 1
-                    bit2 = (self.sprite_high_byte_table_register[i] >> (7-x_offset)) & 1
-                    sprite_color_code = bit1 | (bit2 << 1)
-
-                    attribute = self.sprite_attribute_table_register[i]
-                    priority = (attribute >> 5) & 0x1
-                    sprite_color_palette = attribute & 0b11
-
-                    return sprite_color_code, sprite_color_palette, priority
+            x_position = self.ppu.col - 1 # Pixel 0 is outputed at col == 1
+            for sprite_x, row, sprite_color_palette, priority in self.sprites:
+                if sprite_x <= x_position < sprite_x + 8:
+                    sprite_color_code = row[x_position - sprite_x]
+                    if sprite_color_code: # First opaque sprite in OAM order wins
+                        return sprite_color_code, sprite_color_palette, priority
             return 0, 0, 1 # Means no sprite, transparente color
 
         def multiplexer_decision(self, bg_color_code, bg_color_palette, sprite_color_code, sprite_color_palette, priority):
-            '''Implement PPU Priority Multiplexer decision table'''
+            '''Implement PPU Priority Multiplexer decision table
+
+            Returns:
+                The palette index (from palette ram) of the pixel
+            '''
             bg_palette_address = bg_color_palette << 2
             sprite_palette_address = sprite_color_palette << 2
 
             if bg_color_code == 0 and sprite_color_code == 0:
-                return PALETTE[instances.ppu.palette_vram[0]] # Palette BG Color
+                return self.ppu.palette_vram[0] # Palette BG Color
             if bg_color_code == 0 and sprite_color_code > 0:
-                return PALETTE[instances.ppu.palette_vram[0x10 + sprite_palette_address + sprite_color_code]] # Sprite color > 0
+                return self.ppu.palette_vram[0x10 + sprite_palette_address + sprite_color_code] # Sprite color > 0
             if sprite_color_code == 0:
-                return PALETTE[instances.ppu.palette_vram[bg_palette_address + bg_color_code]] # bg color
+                return self.ppu.palette_vram[bg_palette_address + bg_color_code] # bg color
             if priority == 0:
-                return PALETTE[instances.ppu.palette_vram[0x10 + sprite_palette_address + sprite_color_code]]
-            return PALETTE[instances.ppu.palette_vram[bg_palette_address + bg_color_code]] # bg color
+                return self.ppu.palette_vram[0x10 + sprite_palette_address + sprite_color_code]
+            return self.ppu.palette_vram[bg_palette_address + bg_color_code] # bg color
 
         def shift_registers(self):
-            '''Shift registers every 8 cycles'''
-            #time.sleep(5)
-            #try:
-            #self.bg_palette_register.pop(0)
-            self.bg_low_byte_table_register.pop(0)
-            self.bg_high_byte_table_register.pop(0)
-            self.bg_attribute_table_register.pop(0)
-            self.bg_nt_table_register.pop(0)
-            #except:
-            #    pass
+            '''Shift background registers by one pixel, every cycle'''
+            self.bg_pattern_low_register = (self.bg_pattern_low_register << 1) & 0xffff
+            self.bg_pattern_high_register = (self.bg_pattern_high_register << 1) & 0xffff
+            self.bg_attribute_low_register = (self.bg_attribute_low_register << 1) & 0xffff
+            self.bg_attribute_high_register = (self.bg_attribute_high_register << 1) & 0xffff
+
+        def reload_registers(self):
+            '''Load the latched tile into the low byte of the background registers, every 8 cycles'''
+            self.bg_pattern_low_register |= self.next_low_bg_tile_byte
+            self.bg_pattern_high_register |= self.next_high_bg_tile_byte
+            # Attribute bits are constant over a tile, expand them to the whole byte
+            self.bg_attribute_low_register |= 0xff if self.next_attribute & 1 else 0
+            self.bg_attribute_high_register |= 0xff if self.next_attribute & 2 else 0
 
         def clear_sprite_registers(self):
             '''Reset the sprite registers'''
-            self.sprite_low_byte_table_register = []
-            self.sprite_high_byte_table_register = []
-            self.sprite_attribute_table_register = []
-            self.sprite_x_coordinate_table_register = []
+            self.sprites = []
+
+        def set_sprites(self, sprites):
+            '''Set the fetched sprites of the line into registers'''
+            self.sprites = sprites
 
         def set_nt_byte(self, nt_byte):
-            '''Set nt_byte into registers'''
-            self.bg_nt_table_register.append(nt_byte)
+            '''Set nt_byte into latch'''
+            self.next_nt_byte = nt_byte
 
-        def set_at_byte(self, at_byte):
-            '''Set at_byte into registers'''
-            self.bg_attribute_table_register.append(at_byte)
+        def set_at_byte(self, attribute):
+            '''Set the 2 palette bits selected from the attribute byte into latch'''
+            self.next_attribute = attribute
 
         def set_low_bg_tile_byte(self, low_bg_tile_byte):
-            '''Set low_bg_tile_byte into registers'''
-            self.bg_low_byte_table_register.append(low_bg_tile_byte)
+            '''Set low_bg_tile_byte into latch'''
+            self.next_low_bg_tile_byte = low_bg_tile_byte
 
         def set_high_bg_tile_byte(self, high_bg_tile_byte):
-            '''Set high_bg_tile_byte into registers'''
-            self.bg_high_byte_table_register.append(high_bg_tile_byte)
+            '''Set high_bg_tile_byte into latch'''
+            self.next_high_bg_tile_byte = high_bg_tile_byte
 
         def print_status(self):
             '''Print Pixel Generator current status'''
+            print("Pattern L        | Pattern H        | Attribute L      | Attribute H")
+            print(f"{self.bg_pattern_low_register:016b} | {self.bg_pattern_high_register:016b} | {self.bg_attribute_low_register:016b} | {self.bg_attribute_high_register:016b}")
 
 
     def xor_primary_oam(self):
-        xor = 0
-        for i in self.primary_oam:
-            xor ^= i
-        return xor
+        '''Return the XOR of all the bytes of primary OAM'''
+        return self.primary_oam_checksum
 
     def xor_secondary_oam(self):
-        xor = 0
-        for i in self.secondary_oam:
-            xor ^= i
-        return xor
+        '''Return the XOR of all the bytes of secondary OAM'''
+        return self.secondary_oam_checksum
 
     def print_oam(self):
         print("Primary OAM")
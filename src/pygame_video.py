@@ -0,0 +1,75 @@
+'''pygame window video sink'''
+import sys
+import pygame
+from ppu import PALETTE_LUT
+
+# Preventing direct execution
+if __name__ == '__main__':
+    print("This module cannot be executed. Please use main.py")
+    sys.exit()
+
+class PygameVideo:
+    '''Video sink displaying frames in a pygame window, and handling its keyboard events'''
+
+    def __init__(self):
+        pygame.init()
+        self.scale = 2
+
+        self.display = pygame.display.set_mode( (int(256 * self.scale), int(240 * self.scale)))
+        self.display.fill((0, 0, 0))
+        # Unscaled 256 x 240 surface receiving each frame before it is scaled on display
+        self.frame_surface = pygame.Surface((256, 240))
+
+        pygame.display.update()
+        pygame.display.flip()
+
+    def display_frame(self, frame):
+        '''Display a frame given as a 240 x 256 array of palette indexes
+
+        The frame is converted to RGB through PALETTE_LUT, blitted at once and scaled on display
+        '''
+        pygame.surfarray.blit_array(self.frame_surface, PALETTE_LUT[frame].swapaxes(0, 1))
+        pygame.transform.scale(self.frame_surface, self.display.get_size(), self.display)
+        pygame.display.flip()
+
+    def end_frame(self):
+        '''Nothing to do: pacing is left to the audio sink, frame rate to the emulator telemetry'''
+
+    def poll_events(self, nes):
+        '''Process pygame events
+
+        Returns:
+            0 if the emulator has to quit, 1 otherwise
+        '''
+        continuer = 1
+        # http://www.pygame.org/docs/ref/key.html
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                continuer = 0
+            elif event.type == pygame.KEYDOWN:
+                match event.key:
+                    case pygame.K_UP: 		nes.ctrl1.set_up()
+                    case pygame.K_DOWN: 	nes.ctrl1.set_down()
+                    case pygame.K_LEFT: 	nes.ctrl1.set_left()
+                    case pygame.K_RIGHT: 	nes.ctrl1.set_right()
+                    case pygame.K_RETURN:   nes.ctrl1.set_start()
+                    case pygame.K_ESCAPE:   nes.ctrl1.set_select()
+                    case pygame.K_LCTRL: 	nes.ctrl1.set_a()
+                    case pygame.K_LALT: 	nes.ctrl1.set_b()
+                    case pygame.K_q: 		continuer = 0
+                    case pygame.K_p: 		nes.toggle_pause()
+                    case pygame.K_TAB:      nes.toggle_turbo()
+                    case pygame.K_s:        nes.print_status()
+                    case pygame.K_BACKSPACE: nes.request_rewind()
+
+            elif event.type == pygame.KEYUP:
+                match event.key:
+                    case pygame.K_UP: 		nes.ctrl1.clear_up()
+                    case pygame.K_DOWN: 	nes.ctrl1.clear_down()
+                    case pygame.K_LEFT:	    nes.ctrl1.clear_left()
+                    case pygame.K_RIGHT: 	nes.ctrl1.clear_right()
+                    case pygame.K_RETURN:   nes.ctrl1.clear_start()
+                    case pygame.K_ESCAPE:   nes.ctrl1.clear_select()
+                    case pygame.K_LCTRL: 	nes.ctrl1.clear_a()
+                    case pygame.K_LALT: 	nes.ctrl1.clear_b()
+        return continuer
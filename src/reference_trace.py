@@ -0,0 +1,103 @@
+'''Reference execution logs, compiled to numpy record arrays for conformance checking'''
+import sys
+import os
+import re
+import hashlib
+import numpy
+
+# Preventing direct execution
+if __name__ == '__main__':
+    print("This module cannot be executed. Please use main.py")
+    sys.exit()
+
+# Fields of a reference log line, in record order. -1 when a line does not have the field
+TRACE_FIELDS = ('PC', 'A', 'X', 'Y', 'P', 'SP', 'CYC', 'PPU_LINE', 'PPU_COL', 'ZERO_PAGE', 'P_OAM', 'S_OAM')
+TRACE_DTYPE = numpy.dtype([
+    ('PC', numpy.int32), ('A', numpy.int16), ('X', numpy.int16), ('Y', numpy.int16), ('P', numpy.int16), ('SP', numpy.int16),
+    ('CYC', numpy.int64), ('PPU_LINE', numpy.int16), ('PPU_COL', numpy.int16),
+    ('ZERO_PAGE', numpy.int16), ('P_OAM', numpy.int16), ('S_OAM', numpy.int16)])
+# Same information as the regular expressions nestest logs used to be parsed with, in one pass
+LINE_PATTERN = re.compile(
+    r'(?P<PC>[0-9A-Fa-f]{4})'
+    r'.*?A:(?P<A>[0-9A-Fa-f]{2}) X:(?P<X>[0-9A-Fa-f]{2}) Y:(?P<Y>[0-9A-Fa-f]{2}) P:(?P<P>[0-9A-Fa-f]{2}) SP:(?P<SP>[0-9A-Fa-f]{2})'
+    r'(?:.*?PPU:[ ]*(?P<PPU_LINE>[0-9]+),[ ]*(?P<PPU_COL>[0-9]+))?'
+    r'(?:.*?CYC:(?P<CYC>[0-9]+))?'
+    r'(?:.*?ZeroPage:(?P<ZERO_PAGE>[0-9A-Fa-f]{2}))?'
+    r'(?:.*?P_OAM:(?P<P_OAM>[0-9A-Fa-f]{2}),S_OAM:(?P<S_OAM>[0-9A-Fa-f]{2}))?', re.IGNORECASE)
+DECIMAL_FIELDS = ('CYC', 'PPU_LINE', 'PPU_COL')
+# Directory compiled logs are cached in, under the user cache directory
+CACHE_DIRECTORY_NAME = 'nes_emu_py'
+
+def parse_line(line):
+    '''Return the TRACE_FIELDS values of a log line, -1 for missing fields'''
+    match = LINE_PATTERN.match(line)
+    if match is None:
+        raise Exception(f"Invalid reference log line: {line}")
+    values = match.groupdict()
+    return tuple(-1 if values[name] is None else int(values[name], 10 if name in DECIMAL_FIELDS else 16) for name in TRACE_FIELDS)
+
+def compile_log(data):
+    '''Return the records of the lines of a reference log, given as text'''
+    return numpy.array([parse_line(line) for line in data.splitlines() if line.strip()], dtype=TRACE_DTYPE)
+
+def get_cache_directory():
+    '''Return the directory compiled logs are cached in: $XDG_CACHE_HOME/nes_emu_py, ~/.cache/nes_emu_py by default'''
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, CACHE_DIRECTORY_NAME)
+
+def load_trace(file_name):
+    '''Return the records of a reference log
+
+    Logs are compiled once: records are cached in the user cache directory, in a .npy file named
+    after the log and its content hash, so that an edited log is compiled again.
+    '''
+    with open(file_name, 'rb') as stream:
+        data = stream.read()
+    cache_directory = get_cache_directory()
+    cache_file_name = os.path.join(cache_directory, f"{os.path.basename(file_name)}.{hashlib.sha1(data).hexdigest()[:16]}.npy")
+    try:
+        records = numpy.load(cache_file_name)
+        if records.dtype == TRACE_DTYPE:
+            return records
+    except (OSError, ValueError):
+        pass
+    records = compile_log(data.decode('ascii', errors='replace'))
+    try:
+        os.makedirs(cache_directory, exist_ok=True)
+        numpy.save(cache_file_name, records)
+    except OSError:
+        # Cache directory not writable, the log is compiled on each run
+        pass
+    return records
+
+
+class ReferenceTrace:
+    '''Reference log of an execution, one record per instruction
+
+    Only fields every line has are compared. Expected values are kept as tuples of those fields,
+    to be compared at once to the emulator status.
+
+    Args:
+        file_name -- the reference log
+    '''
+    def __init__(self, file_name):
+        self.file_name = file_name
+        records = load_trace(file_name)
+        self.fields = [name for name in TRACE_FIELDS if len(records) and (records[name] >= 0).all()]
+        self.expected = records[self.fields].tolist() if self.fields else []
+
+    def __len__(self):
+        return len(self.expected)
+
+    def get_line(self, index):
+        '''Return the text of the log line at index, to report a divergence'''
+        with open(self.file_name, 'r') as stream:
+            lines = [line for line in stream if line.strip()]
+        return lines[index].rstrip('\n')
+
+    def find_divergence(self, index, status):
+        '''Return the (field, value, expected value) of the first field of status differing from record index'''
+        for name, value, expected in zip(self.fields, status, self.expected[index]):
+            if value != expected:
+                return name, value, expected
+        return None
@@ -0,0 +1,201 @@
+'''Rewind buffer of delta compressed snapshots'''
+import sys
+import zlib
+import threading
+import collections
+import concurrent.futures
+import numpy
+
+# Preventing direct execution
+if __name__ == '__main__':
+    print("This module cannot be executed. Please use main.py")
+    sys.exit()
+
+FRAMES_PER_SECOND = 60
+# Frames between two snapshots
+DEFAULT_SNAPSHOT_INTERVAL = 10
+# Every KEYFRAME_INTERVAL snapshots, the snapshot is stored whole instead of as a delta
+KEYFRAME_INTERVAL = 30
+DEFAULT_SECONDS = 60
+DEFAULT_BUDGET = 32 * 1024 * 1024 # Compressed snapshots size limit, in bytes
+
+def xor_delta(state, reference):
+    '''Return state XOR reference as a uint8 array, reference being truncated or zero padded to the length of state
+
+    The same operation turns a delta back into the state, given the same reference.
+    '''
+    delta = numpy.frombuffer(state, dtype=numpy.uint8).copy()
+    length = min(len(delta), len(reference))
+    delta[:length] ^= numpy.frombuffer(reference, dtype=numpy.uint8, count=length)
+    return delta
+
+
+class Rewind:
+    '''Keeps the last seconds of play as save state snapshots, to go back in time
+
+    A snapshot is taken every interval frames. It is XORed with the previous one, most of the
+    machine state being unchanged between snapshots, and the delta is zlib compressed on a
+    background thread. Every KEYFRAME_INTERVAL snapshots, a keyframe is stored without delta so
+    that decoding never goes back further. When the buffer exceeds its duration or memory budget,
+    the oldest keyframe and its deltas are evicted.
+
+    Controller inputs are recorded for every frame, so that frames between the restored
+    snapshot and the rewind target are emulated again as they were played.
+
+    Args:
+        nes -- the emulator
+        seconds -- how far back the emulation can be rewound
+        interval -- frames between two snapshots
+        budget -- maximum size of the compressed snapshots, in bytes
+    '''
+    def __init__(self, nes, seconds = DEFAULT_SECONDS, interval = DEFAULT_SNAPSHOT_INTERVAL, budget = DEFAULT_BUDGET):
+        self.nes = nes
+        self.max_frames = seconds * FRAMES_PER_SECOND
+        self.interval = interval
+        self.budget = budget
+
+        # Snapshots as (frame, is keyframe, compressed data), oldest first. Shared with the compression thread
+        self.snapshots = collections.deque()
+        self.size = 0
+        self.lock = threading.Lock()
+        # Compression thread side: last snapshot state and snapshots since last keyframe
+        self.reference = b''
+        self.delta_count = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.future = None
+
+        # Controllers status of each frame since first_input_frame, two bytes per frame
+        self.inputs = bytearray()
+        self.first_input_frame = 0
+        self.is_replaying = 0
+
+    def on_frame(self):
+        '''Frame listener: record inputs and take a snapshot at the start of every interval frames
+
+        While replaying, recorded inputs are applied instead.
+        '''
+        nes = self.nes
+        if not self.inputs:
+            self.first_input_frame = nes.frame_count
+        offset = 2 * (nes.frame_count - self.first_input_frame)
+        if self.is_replaying:
+            nes.ctrl1.status, nes.ctrl2.status = self.inputs[offset:offset + 2]
+            return
+        del self.inputs[offset:]
+        self.inputs += bytes((nes.ctrl1.status, nes.ctrl2.status))
+        if nes.frame_count % self.interval == 0:
+            self.future = self.executor.submit(self.store, nes.frame_count, nes.save_state())
+            self.trim_inputs()
+
+    def trim_inputs(self):
+        '''Drop the inputs of frames older than the oldest snapshot'''
+        with self.lock:
+            if not self.snapshots:
+                return
+            first_input_frame = self.snapshots[0][0]
+        del self.inputs[:2 * (first_input_frame - self.first_input_frame)]
+        self.first_input_frame = first_input_frame
+
+    def store(self, frame, state):
+        '''Compression thread: delta encode and compress a snapshot, then evict old ones'''
+        is_keyframe = self.delta_count == 0
+        data = zlib.compress(state if is_keyframe else xor_delta(state, self.reference))
+        self.reference = state
+        self.delta_count = (self.delta_count + 1) % KEYFRAME_INTERVAL
+        with self.lock:
+            self.snapshots.append((frame, is_keyframe, data))
+            self.size += len(data)
+            while self.size > self.budget or frame - self.snapshots[0][0] > self.max_frames:
+                if not self.evict_oldest():
+                    break
+
+    def evict_oldest(self):
+        '''Drop the oldest keyframe and its deltas. Never drops the newest keyframe
+
+        Returns:
+            True if snapshots were dropped
+        '''
+        snapshots = self.snapshots
+        end = 1
+        while end < len(snapshots) and not snapshots[end][1]:
+            end += 1
+        if end == len(snapshots):
+            return False
+        for _ in range(end):
+            self.size -= len(snapshots.popleft()[2])
+        return True
+
+    def wait(self):
+        '''Wait until every snapshot taken has been stored'''
+        if self.future is not None:
+            self.future.result()
+            self.future = None
+
+    def get_keyframe_index(self, index):
+        '''Return the index of the keyframe the snapshot at index is decoded from'''
+        while not self.snapshots[index][1]:
+            index -= 1
+        return index
+
+    def decode(self, index):
+        '''Return the save state of the snapshot at index, from its keyframe and the deltas up to it'''
+        start = self.get_keyframe_index(index)
+        state = zlib.decompress(self.snapshots[start][2])
+        for snapshot in range(start + 1, index + 1):
+            state = xor_delta(zlib.decompress(self.snapshots[snapshot][2]), state).tobytes()
+        return state
+
+    def get_available_frames(self):
+        '''Return how many frames the emulation can currently be rewound'''
+        self.wait()
+        if not self.snapshots:
+            return 0
+        return self.nes.frame_count - self.snapshots[0][0]
+
+    def rewind(self, frames):
+        '''Go back the given number of frames, or as far as possible
+
+        The nearest snapshot at or before the target frame is restored, then the frames up to
+        the target are emulated again with their recorded inputs, without being presented.
+        Snapshots and inputs after the target are dropped.
+
+        Returns:
+            The number of frames actually rewound
+        '''
+        self.wait()
+        nes = self.nes
+        if not self.snapshots:
+            return 0
+        current_frame = nes.frame_count
+        target = max(current_frame - frames, self.snapshots[0][0])
+        index = len(self.snapshots) - 1
+        while self.snapshots[index][0] > target:
+            index -= 1
+        state = self.decode(index)
+
+        with self.lock:
+            while len(self.snapshots) > index + 1:
+                self.size -= len(self.snapshots.pop()[2])
+        # Next snapshot is a delta against the restored one
+        self.reference = state
+        self.delta_count = (index - self.get_keyframe_index(index) + 1) % KEYFRAME_INTERVAL
+
+        # Inputs held now apply from the target frame on
+        live_inputs = (nes.ctrl1.status, nes.ctrl2.status)
+        nes.load_state(state)
+        self.is_replaying = 1
+        nes.is_presenting = 0
+        try:
+            while nes.frame_count < target:
+                nes.run_frame()
+        finally:
+            self.is_replaying = 0
+            nes.is_presenting = 1
+        nes.ctrl1.status, nes.ctrl2.status = live_inputs
+        offset = 2 * (target - self.first_input_frame)
+        self.inputs[offset:] = bytes(live_inputs)
+        return current_frame - target
+
+    def close(self):
+        '''Stop the compression thread'''
+        self.executor.shutdown()
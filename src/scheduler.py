@@ -0,0 +1,80 @@
+'''Timed events scheduler'''
+import sys
+import heapq
+import math
+
+# Preventing direct execution
+if __name__ == '__main__':
+    print("This module cannot be executed. Please use main.py")
+    sys.exit()
+
+# NTSC master clock ticks per CPU cycle and per PPU dot
+MASTER_CLOCK_PER_CPU_CYCLE = 12
+MASTER_CLOCK_PER_PPU_DOT = 4
+
+class Scheduler:
+    '''Priority queue of named events, keyed on master clock timestamps
+
+    Scheduling an event under a name already pending replaces it, so that components can move
+    their deadlines freely. Replaced and cancelled entries are left in the heap and skipped when
+    they reach its top.
+    '''
+    def __init__(self):
+        self.queue = []  # Heap of (timestamp, sequence, name)
+        self.events = {} # Pending events by name, as (timestamp, sequence, callback)
+        self.sequence = 0
+        # Timestamp of the earliest pending event, and the CPU cycle it is reached at
+        self.deadline = math.inf
+        self.cpu_deadline = math.inf
+
+    def schedule(self, name, timestamp, callback):
+        '''Schedule callback(timestamp) at timestamp, replacing any pending event with the same name'''
+        self.sequence += 1
+        self.events[name] = (timestamp, self.sequence, callback)
+        heapq.heappush(self.queue, (timestamp, self.sequence, name))
+        if timestamp < self.deadline:
+            self.set_deadline(timestamp)
+
+    def cancel(self, name):
+        '''Cancel the pending event with the given name, if any'''
+        self.events.pop(name, None)
+
+    def is_pending(self, name):
+        '''Return True if an event with the given name is pending'''
+        return name in self.events
+
+    def get_pending(self):
+        '''Return the pending events as (name, timestamp), in timestamp order'''
+        return [(name, timestamp) for name, (timestamp, _, _) in sorted(self.events.items(), key=lambda item: item[1][:2])]
+
+    def set_deadline(self, timestamp):
+        '''Update the deadline attributes'''
+        self.deadline = timestamp
+        self.cpu_deadline = -(-timestamp // MASTER_CLOCK_PER_CPU_CYCLE) if timestamp != math.inf else math.inf
+
+    def update_deadline(self):
+        '''Drop stale entries from the top of the heap and update the deadline'''
+        queue = self.queue
+        while queue:
+            timestamp, sequence, name = queue[0]
+            event = self.events.get(name)
+            if event is not None and event[1] == sequence:
+                self.set_deadline(timestamp)
+                return
+            heapq.heappop(queue)
+        self.set_deadline(math.inf)
+
+    def run_due(self, timestamp):
+        '''Run, in timestamp order, every event due at timestamp, including those scheduled meanwhile'''
+        self.update_deadline()
+        while self.deadline <= timestamp:
+            event_timestamp, _, name = heapq.heappop(self.queue)
+            _, _, callback = self.events.pop(name)
+            callback(event_timestamp)
+            self.update_deadline()
+
+    def clear(self):
+        '''Drop every pending event'''
+        self.queue = []
+        self.events = {}
+        self.set_deadline(math.inf)
@@ -0,0 +1,94 @@
+'''Binary save states helpers'''
+import sys
+import struct
+import operator
+
+# Preventing direct execution
+if __name__ == '__main__':
+    print("This module cannot be executed. Please use main.py")
+    sys.exit()
+
+STATE_MAGIC = b'YNES'
+# To be bumped whenever the layout of a component state changes
+STATE_VERSION = 1
+STATE_HEADER = struct.Struct('<4sHI') # Magic, version, ROM CRC32
+
+BUFFER_LENGTH = struct.Struct('<I')
+RECORD_COUNT = struct.Struct('<H')
+
+class StateFields:
+    '''Layout of the scalar attributes of a component in a save state
+
+    Args:
+        fields -- (attribute name, struct format character) pairs, in state order
+    '''
+    def __init__(self, *fields):
+        self.names = tuple(name for name, _ in fields)
+        self.struct = struct.Struct('<' + ''.join(code for _, code in fields))
+        getter = operator.attrgetter(*self.names)
+        # attrgetter returns a tuple only when given several names
+        self.getter = getter if len(self.names) > 1 else lambda component: (getter(component),)
+
+    def save(self, writer, component):
+        '''Write the attributes of component'''
+        writer.write(self.struct.pack(*self.getter(component)))
+
+    def load(self, reader, component):
+        '''Set the attributes of component from the state'''
+        for name, value in zip(self.names, reader.unpack(self.struct)):
+            setattr(component, name, value)
+
+
+class StateWriter:
+    '''Builds a save state as a list of chunks, joined once at the end
+
+    Buffers are appended as memoryviews, so they are only copied by that final join.
+    '''
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        '''Append raw bytes'''
+        self.chunks.append(data)
+
+    def write_buffer(self, buffer):
+        '''Append a length prefixed buffer, without copying it'''
+        self.chunks.append(BUFFER_LENGTH.pack(len(buffer)))
+        self.chunks.append(memoryview(buffer))
+
+    def write_records(self, record_struct, records):
+        '''Append a count prefixed list of tuples packed with record_struct'''
+        self.chunks.append(RECORD_COUNT.pack(len(records)))
+        self.chunks.extend(record_struct.pack(*record) for record in records)
+
+    def get_bytes(self):
+        '''Return the state as a single bytes object'''
+        return b''.join(self.chunks)
+
+
+class StateReader:
+    '''Reads a save state sequentially, through a memoryview on its data'''
+    def __init__(self, data):
+        self.view = memoryview(data)
+        self.offset = 0
+
+    def unpack(self, state_struct):
+        '''Read the values packed with state_struct'''
+        values = state_struct.unpack_from(self.view, self.offset)
+        self.offset += state_struct.size
+        return values
+
+    def read_buffer(self, buffer):
+        '''Copy a length prefixed buffer into buffer, which must have the same length'''
+        (length,) = self.unpack(BUFFER_LENGTH)
+        if length != len(buffer):
+            raise Exception(f"State buffer length mismatch: {length} instead of {len(buffer)}")
+        buffer[:] = self.view[self.offset:self.offset + length]
+        self.offset += length
+
+    def read_records(self, record_struct):
+        '''Read a count prefixed list of tuples packed with record_struct'''
+        (count,) = self.unpack(RECORD_COUNT)
+        records = list(record_struct.iter_unpack(self.view[self.offset:self.offset + count * record_struct.size]))
+        self.offset += count * record_struct.size
+        return records
@@ -0,0 +1,129 @@
+'''Per frame performance telemetry'''
+import sys
+import csv
+import json
+import time
+import numpy
+
+# Preventing direct execution
+if __name__ == '__main__':
+    print("This module cannot be executed. Please use main.py")
+    sys.exit()
+
+# Subsystems host time is split between. 'cpu' is the emulation core, charged with any time not
+# spent in another subsystem. In cycle mode, PPU dots run in lockstep with the CPU are charged to it
+SUBSYSTEMS = ('cpu', 'ppu', 'apu', 'video', 'audio', 'state')
+CPU, PPU, APU, VIDEO, AUDIO, STATE = range(len(SUBSYSTEMS))
+
+RECORD_DTYPE = numpy.dtype(
+    [('frame', numpy.int64), ('frame_time', numpy.float64), ('instructions_per_second', numpy.float64),
+     ('dots_per_second', numpy.float64), ('run_ahead_time', numpy.float64)] +
+    [(f'{name}_share', numpy.float32) for name in SUBSYSTEMS])
+DEFAULT_SIZE = 600 # Frames kept, 10 seconds
+
+class Telemetry:
+    '''Fixed size ring of per frame measurements
+
+    Each record holds the host time taken by the frame, the emulated CPU instructions and PPU
+    dots per second of host time over it, the host time spent emulating frames ahead of it with
+    run-ahead, and the share of the frame time spent in each of SUBSYSTEMS. Time is charged to
+    one subsystem at a time: enter() switches to a subsystem and leave() goes back to the
+    previous one, so nested subsystems are not counted twice.
+
+    Args:
+        size -- number of frames kept
+    '''
+    def __init__(self, size = DEFAULT_SIZE):
+        self.records = numpy.zeros(size, dtype=RECORD_DTYPE)
+        self.count = 0 # Records written since creation
+        self.times = [0.0] * len(SUBSYSTEMS)
+        self.subsystem = CPU
+        self.stack = []
+        self.mark = time.perf_counter()
+        self.frame_start = self.mark
+        self.instructions = 0
+        self.cycles = 0
+        self.run_ahead_time = 0.0
+
+    def set_counters(self, instructions, cycles):
+        '''Set the CPU instructions and cycles counters the next frame is measured from'''
+        self.instructions = instructions
+        self.cycles = cycles
+
+    def add_run_ahead_time(self, run_ahead_time):
+        '''Add host time spent emulating frames ahead to the next record
+
+        Frames run ahead write no record of their own, their subsystems time being charged to the
+        next frame. run_ahead_time tells that overhead apart.
+        '''
+        self.run_ahead_time += run_ahead_time
+
+    def enter(self, subsystem):
+        '''Charge time to subsystem from now on, until leave() is called'''
+        now = time.perf_counter()
+        self.times[self.subsystem] += now - self.mark
+        self.stack.append(self.subsystem)
+        self.subsystem = subsystem
+        self.mark = now
+
+    def leave(self):
+        '''Charge time to the subsystem active before the last enter() again'''
+        now = time.perf_counter()
+        self.times[self.subsystem] += now - self.mark
+        self.subsystem = self.stack.pop()
+        self.mark = now
+
+    def end_frame(self, frame, instructions, cycles):
+        '''Write the record of the frame completed, given the CPU counters at its end'''
+        now = time.perf_counter()
+        times = self.times
+        times[self.subsystem] += now - self.mark
+        frame_time = now - self.frame_start
+        if frame_time > 0:
+            record = self.records[self.count % len(self.records)]
+            record['frame'] = frame
+            record['frame_time'] = frame_time
+            record['instructions_per_second'] = (instructions - self.instructions) / frame_time
+            record['dots_per_second'] = 3 * (cycles - self.cycles) / frame_time
+            record['run_ahead_time'] = self.run_ahead_time
+            for name, subsystem_time in zip(SUBSYSTEMS, times):
+                record[f'{name}_share'] = subsystem_time / frame_time
+            self.count += 1
+        self.times = [0.0] * len(SUBSYSTEMS)
+        self.run_ahead_time = 0.0
+        self.mark = now
+        self.frame_start = now
+        self.set_counters(instructions, cycles)
+
+    def get_records(self):
+        '''Return the records kept, oldest first, as a copy of the ring'''
+        size = len(self.records)
+        if self.count <= size:
+            return self.records[:self.count].copy()
+        return numpy.roll(self.records, -(self.count % size))
+
+    def get_fps(self):
+        '''Return the average frame rate over the records kept'''
+        records = self.get_records()
+        return len(records) / records['frame_time'].sum() if len(records) else 0.0
+
+    def dump_json(self, file_name):
+        '''Write the records kept as a JSON list of objects'''
+        records = self.get_records()
+        with open(file_name, 'w') as stream:
+            json.dump([dict(zip(RECORD_DTYPE.names, record.tolist())) for record in records], stream, indent=1)
+
+    def dump_csv(self, file_name):
+        '''Write the records kept as CSV, with a header line'''
+        records = self.get_records()
+        with open(file_name, 'w', newline='') as stream:
+            writer = csv.writer(stream)
+            writer.writerow(RECORD_DTYPE.names)
+            writer.writerows(record.tolist() for record in records)
+
+    def dump(self, file_name):
+        '''Write the records kept as CSV if file_name ends with .csv, as JSON otherwise'''
+        if file_name.lower().endswith('.csv'):
+            self.dump_csv(file_name)
+        else:
+            self.dump_json(file_name)
@@ -0,0 +1,63 @@
+'''Pre-decoded CHR tiles cache'''
+import sys
+
+# Preventing direct execution
+if __name__ == '__main__':
+    print("This module cannot be executed. Please use main.py")
+    sys.exit()
+
+# Number of 16 bytes tiles in the two pattern tables (0x0000 - 0x1fff)
+TILE_COUNT = 0x200
+
+class TileCache:
+    '''Cache of CHR tiles decoded to 2 bits color codes
+
+    Tiles are identified by their index in the PPU pattern tables and read through the cartridge
+    mapper, so the cache always reflects the CHR banks currently mapped. A decoded tile is a tuple
+    of 8 rows, each row being 8 bytes of color codes (0 to 3), leftmost pixel first. The
+    horizontally flipped rows are decoded at the same time. Tiles are decoded on first use
+    after having been invalidated.
+    '''
+    def __init__(self, cartridge):
+        self.cartridge = cartridge
+        self.tiles = [None] * TILE_COUNT
+        self.flipped_tiles = [None] * TILE_COUNT
+
+    def get_tile(self, tile):
+        '''Return the 8 decoded rows of tile'''
+        rows = self.tiles[tile]
+        if rows is None:
+            rows = self.decode(tile)
+        return rows
+
+    def get_flipped_tile(self, tile):
+        '''Return the 8 decoded rows of tile, flipped horizontally'''
+        rows = self.flipped_tiles[tile]
+        if rows is None:
+            self.decode(tile)
+            rows = self.flipped_tiles[tile]
+        return rows
+
+    def decode(self, tile):
+        '''Decode the two bit planes of tile into rows of color codes'''
+        read_chr_rom = self.cartridge.read_chr_rom
+        address = tile << 4
+        rows = []
+        for fine_y in range(8):
+            low = read_chr_rom(address + fine_y)
+            high = read_chr_rom(address + 8 + fine_y)
+            rows.append(bytes(((low >> (7 - i)) & 1) | (((high >> (7 - i)) & 1) << 1) for i in range(8)))
+        self.tiles[tile] = tuple(rows)
+        self.flipped_tiles[tile] = tuple(row[::-1] for row in rows)
+        return self.tiles[tile]
+
+    def invalidate(self, address):
+        '''Drop the tile containing the pattern table address, after a CHR write'''
+        tile = (address >> 4) & (TILE_COUNT - 1)
+        self.tiles[tile] = None
+        self.flipped_tiles[tile] = None
+
+    def clear(self):
+        '''Drop every tile, after a CHR bank switch'''
+        self.tiles = [None] * TILE_COUNT
+        self.flipped_tiles = [None] * TILE_COUNT
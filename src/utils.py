@@ -1,4 +1,6 @@
 '''Some utility functions'''
+import functools
+import operator
 
 # Preventing direct execution
 if __name__ == '__main__':
@@ -17,6 +19,10 @@ def format_hex_data(val):
     """
     return ' '.join(a+b for a,b in zip(f'{val:x}'[::2], f'{val:x}'[1::2]))
 
+def xor_checksum(data):
+    '''Return the XOR of all the bytes of data'''
+    return functools.reduce(operator.xor, data, 0)
+
 def print_memory_page(page, high = 0, offset=0) :
     '''Function to pretty print a memory page'''
     for i in range(0, min(256, len(page)), 32):
@@ -0,0 +1,286 @@
+'''Vectorized environment API for reinforcement learning, over several headless consoles'''
+import sys
+import os
+import multiprocessing
+import multiprocessing.shared_memory
+import numpy
+from console import Console
+from ppu import PALETTE
+
+# Preventing direct execution
+if __name__ == '__main__':
+    print("This module cannot be executed. Please use main.py")
+    sys.exit()
+
+FRAME_HEIGHT = 240
+FRAME_WIDTH = 256
+# Luma of each palette index, for grayscale observations. Repeated as PALETTE_LUT
+GRAYSCALE_LUT = numpy.array([(299 * r + 587 * g + 114 * b) // 1000 for r, g, b in PALETTE] * 4, dtype=numpy.uint8)
+
+class RamScore:
+    '''Score read from the internal RAM, which step rewards are the increase of
+
+    Args:
+        address -- address of the first byte of the score in internal RAM
+        length -- number of bytes of the score
+        encoding -- 'little' for a little endian integer, 'digits' for one decimal digit per
+        byte, most significant first, or 'bcd' for two decimal digits per byte, most significant first
+    '''
+    def __init__(self, address, length = 1, encoding = 'little'):
+        if encoding not in ('little', 'digits', 'bcd'):
+            raise Exception(f"Unknown score encoding: {encoding}")
+        self.address = address
+        self.length = length
+        self.encoding = encoding
+
+    def __call__(self, ram):
+        '''Return the score held by ram'''
+        data = ram[self.address:self.address + self.length]
+        match self.encoding:
+            case 'little':
+                return int.from_bytes(bytes(data), 'little')
+            case 'digits':
+                return int(''.join(str(digit) for digit in data))
+            case 'bcd':
+                return int(bytes(data).hex())
+
+
+class ObservationSink:
+    '''Video sink writing each presented frame as an observation into a shared array slot
+
+    Args:
+        observation -- slot of the shared observations array, of the observation shape
+        grayscale -- convert palette indexes to luma
+        downsample -- keep one pixel out of downsample in both directions, averaged when grayscale
+    '''
+    def __init__(self, observation, grayscale, downsample):
+        self.observation = observation
+        self.grayscale = grayscale
+        self.downsample = downsample
+
+    def display_frame(self, frame):
+        '''Write the observation of frame, a 240 x 256 array of palette indexes'''
+        step = self.downsample
+        if not self.grayscale:
+            self.observation[:] = frame[::step, ::step]
+        elif step == 1:
+            numpy.take(GRAYSCALE_LUT, frame, out=self.observation)
+        else:
+            luma = GRAYSCALE_LUT[frame].reshape(FRAME_HEIGHT // step, step, FRAME_WIDTH // step, step)
+            self.observation[:] = luma.mean(axis=(1, 3), dtype=numpy.uint16)
+
+    def end_frame(self):
+        '''No pacing, environments run as fast as possible'''
+
+    def poll_events(self, nes):
+        '''No events to process'''
+        return 1
+
+
+class Environment:
+    '''One console of a worker, with its slots in the shared arrays
+
+    The state after power on and a first frame is kept, episodes are reset by loading it back.
+    '''
+    def __init__(self, index, shared, settings):
+        self.index = index
+        self.shared = shared
+        self.settings = settings
+        self.console = Console(1)
+        self.console.load_rom(settings['rom'])
+        nes = self.console.nes
+        nes.set_scheduler_mode(settings['scheduler'])
+        self.console.ppu.set_renderer(settings['renderer'])
+        nes.video = ObservationSink(shared['observations'][index], settings['grayscale'], settings['downsample'])
+        self.ram = numpy.frombuffer(self.console.memory.internal_ram, dtype=numpy.uint8)
+
+        nes.power_on()
+        nes.run_frame()
+        self.initial_state = nes.save_state()
+        self.initial_observation = shared['observations'][index].copy()
+        self.score = 0
+        self.steps = 0
+
+    def get_score(self):
+        '''Return the current score, 0 when no score is read from RAM'''
+        score = self.settings['score']
+        return score(self.ram) if score else 0
+
+    def reset(self):
+        '''Start a new episode: restore the initial state and observation'''
+        self.console.nes.load_state(self.initial_state)
+        self.shared['observations'][self.index] = self.initial_observation
+        self.score = self.get_score()
+        self.steps = 0
+
+    def step(self):
+        '''Run frame_skip frames with the controllers status of the shared actions
+
+        Only the last frame is presented, so only its observation is computed. The episode is
+        reset once done, the observation then being the first of the next episode.
+        '''
+        nes = self.console.nes
+        settings = self.settings
+        index = self.index
+        nes.ctrl1.status, nes.ctrl2.status = self.shared['actions'][index]
+        nes.is_presenting = 0
+        for _ in range(settings['frame_skip'] - 1):
+            nes.run_frame()
+        nes.is_presenting = 1
+        nes.run_frame()
+
+        score = self.get_score()
+        self.shared['rewards'][index] = score - self.score
+        self.score = score
+        self.steps += 1
+        done = self.steps == settings['max_steps'] or (settings['done'] is not None and settings['done'](self.ram))
+        self.shared['dones'][index] = done
+        if done:
+            self.reset()
+
+
+def worker(connection, first, count, shared, settings):
+    '''Worker process: run the commands received on connection over environments first to first + count
+
+    Commands are 'reset', 'step' and 'close'. Each is acknowledged with ('ok', None), or
+    ('error', message) if an exception was raised.
+    '''
+    try:
+        environments = [Environment(index, shared, settings) for index in range(first, first + count)]
+        connection.send(('ok', None))
+        while True:
+            command = connection.recv()
+            match command:
+                case 'reset':
+                    for environment in environments:
+                        environment.reset()
+                case 'step':
+                    for environment in environments:
+                        environment.step()
+                case 'close':
+                    break
+            connection.send(('ok', None))
+    # Disabling broad-except pylint control, any error is reported to the parent process
+    # pylint: disable=W0703
+    except Exception as exception:
+        connection.send(('error', f"{type(exception).__name__}: {exception}"))
+    finally:
+        connection.close()
+
+
+class VecEnv:
+    '''N environments on the same ROM, stepped together by worker processes
+
+    Observations, actions, rewards and dones live in shared memory: workers write
+    observations straight into it and read the controllers status from it, so only a short
+    command string goes through a pipe to each worker on each step.
+
+    Args:
+        rom -- ROM file name
+        count -- number of environments
+        workers -- number of worker processes, the number of CPUs by default. Environments are
+        split evenly between them
+        frame_skip -- frames run per step, with the same inputs. Only the last one is observed
+        grayscale -- observations are luma instead of palette indexes
+        downsample -- observations are downsample times smaller in both directions. Has to divide 240 and 256
+        score -- callable returning the score from the internal RAM, as a uint8 array. Rewards
+        are its increase over each step. See RamScore
+        done -- callable returning whether an episode is over from the internal RAM
+        max_steps -- steps after which an episode is over, 0 for no limit
+        scheduler, renderer -- emulation settings
+    '''
+    def __init__(self, rom, count, workers = None, frame_skip = 4, grayscale = 0, downsample = 1, score = None,
+                 done = None, max_steps = 0, scheduler = 'block', renderer = 'scanline'):
+        if FRAME_HEIGHT % downsample or FRAME_WIDTH % downsample:
+            raise Exception(f"Downsampling factor {downsample} does not divide the frame size")
+        if frame_skip < 1:
+            raise Exception("At least one frame has to be run per step")
+        self.count = count
+        self.observation_shape = (FRAME_HEIGHT // downsample, FRAME_WIDTH // downsample)
+        settings = {'rom': rom, 'frame_skip': frame_skip, 'grayscale': grayscale, 'downsample': downsample,
+                    'score': score, 'done': done, 'max_steps': max_steps, 'scheduler': scheduler, 'renderer': renderer}
+
+        self.memories = []
+        self.shared = {
+            'observations': self.create_shared_array((count, *self.observation_shape)),
+            'actions': self.create_shared_array((count, 2)),
+            'rewards': self.create_shared_array((count,), numpy.float32),
+            'dones': self.create_shared_array((count,), numpy.bool_),
+        }
+
+        # Workers are forked where possible, so that main.py is not executed again in each of them
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else multiprocessing
+        workers = min(workers or os.cpu_count(), count)
+        self.connections = []
+        self.processes = []
+        for rank in range(workers):
+            first = rank * count // workers
+            parent_connection, child_connection = context.Pipe()
+            process = context.Process(target=worker, args=(child_connection, first, (rank + 1) * count // workers - first, self.shared, settings), daemon=True)
+            process.start()
+            child_connection.close()
+            self.connections.append(parent_connection)
+            self.processes.append(process)
+        self.wait()
+
+    def create_shared_array(self, shape, dtype = numpy.uint8):
+        '''Return a zeroed numpy array of the given shape, in a new shared memory block'''
+        size = int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+        memory = multiprocessing.shared_memory.SharedMemory(create=True, size=size)
+        self.memories.append(memory)
+        array = numpy.ndarray(shape, dtype=dtype, buffer=memory.buf)
+        array[:] = 0
+        return array
+
+    def send(self, command):
+        '''Send a command to every worker and wait for them to complete it'''
+        for connection in self.connections:
+            connection.send(command)
+        self.wait()
+
+    def wait(self):
+        '''Wait for every worker acknowledgement. Raise an exception if one of them failed'''
+        errors = [message for status, message in (connection.recv() for connection in self.connections) if status == 'error']
+        if errors:
+            raise Exception(f"VecEnv worker failed: {errors[0]}")
+
+    def reset(self):
+        '''Restart every environment from its initial state
+
+        Returns:
+            The observations array, of shape (count, *observation_shape)
+        '''
+        self.send('reset')
+        return self.shared['observations']
+
+    def step(self, actions):
+        '''Run a step of every environment
+
+        Args:
+            actions -- controller 1 status of each environment, or (controller 1, controller 2)
+            status pairs. Status bits are A, B, Select, Start, Up, Down, Left, Right from bit 0
+
+        Returns:
+            (observations, rewards, dones) arrays. They are views on the shared memory, updated
+            in place by the next step: copy them to keep them. Environments done are reset, their
+            observation being the first of the next episode
+        '''
+        actions = numpy.asarray(actions, dtype=numpy.uint8)
+        if actions.ndim == 1:
+            self.shared['actions'][:, 0] = actions
+        else:
+            self.shared['actions'][:] = actions
+        self.send('step')
+        return self.shared['observations'], self.shared['rewards'], self.shared['dones']
+
+    def close(self):
+        '''Stop the workers and free the shared memory'''
+        for connection in self.connections:
+            connection.send('close')
+        for process in self.processes:
+            process.join()
+        self.shared = {}
+        for memory in self.memories:
+            memory.close()
+            memory.unlink()
+        self.memories = []
@@ -0,0 +1,40 @@
+'''Video output sinks'''
+import sys
+
+# Preventing direct execution
+if __name__ == '__main__':
+    print("This module cannot be executed. Please use main.py")
+    sys.exit()
+
+class NullVideo:
+    '''Headless video sink. Frames are only kept in memory, no window is opened
+
+    Does not depend on pygame, so that the emulator can run on machines without display.
+    '''
+    def __init__(self):
+        # Last presented frame, as a 240 x 256 array of palette indexes. It is copied, since the
+        # PPU frame buffer is rendered over and restored by save states loading (run-ahead)
+        self.frame = None
+        self.frame_count = 0
+
+    def display_frame(self, frame):
+        '''Keep a copy of the completed frame'''
+        self.frame = frame.copy()
+        self.frame_count += 1
+
+    def end_frame(self):
+        '''No pacing, headless runs as fast as possible'''
+
+    def poll_events(self, nes):
+        '''No events to process. Returns 1 as the emulator never has to quit'''
+        return 1
+
+
+def create_video_sink(headless):
+    '''Return the video sink to use. pygame is only imported when a window is requested'''
+    if headless:
+        return NullVideo()
+    # Disabling import-outside-toplevel pylint control, pygame must only be imported when needed
+    # pylint: disable=C0415
+    from pygame_video import PygameVideo
+    return PygameVideo()
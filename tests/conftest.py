@@ -0,0 +1,43 @@
+'''Shared fixtures: headless consoles running small NROM programs built by the tests'''
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+# Disabling wrong-import-position and import-error pylint controls, emulator modules are found
+# through the path set above
+# pylint: disable=C0413,E0401
+from console import Console
+
+# Preventing direct execution
+if __name__ == '__main__':
+    print("This module cannot be executed. Please use pytest")
+    sys.exit()
+
+PRG_ROM_START = 0x8000
+PRG_ROM_SIZE = 0x8000
+RTI = 0x40
+INTERRUPT_HANDLER = 0xfff0 # NMI and IRQ return at once
+
+def build_nrom(program):
+    '''Return a 32 kB NROM image running program from $8000, interrupts returning at once'''
+    prg_rom = bytearray(PRG_ROM_SIZE)
+    prg_rom[:len(program)] = program
+    prg_rom[INTERRUPT_HANDLER - PRG_ROM_START] = RTI
+    vectors = (INTERRUPT_HANDLER, PRG_ROM_START, INTERRUPT_HANDLER) # NMI, reset, IRQ
+    prg_rom[0x7ffa:] = b''.join(vector.to_bytes(2, 'little') for vector in vectors)
+    header = b'NES\x1a' + bytes((2, 1, 0, 0)) + bytes(8)
+    return header + prg_rom + bytes(0x2000)
+
+@pytest.fixture
+def make_console(tmp_path):
+    '''Return a function powering on a console running the given program in the given scheduler mode'''
+    def make(program, mode = 'instruction'):
+        rom_file = tmp_path / 'program.nes'
+        rom_file.write_bytes(build_nrom(program))
+        console = Console(1)
+        console.load_rom(str(rom_file))
+        console.nes.set_scheduler_mode(mode)
+        console.nes.power_on()
+        return console
+    return make
@@ -0,0 +1,65 @@
+'''Block mode against instruction mode on PPUSTATUS polling loops'''
+import sys
+import pytest
+
+# Preventing direct execution
+if __name__ == '__main__':
+    print("This module cannot be executed. Please use pytest")
+    sys.exit()
+
+POLL_ADDRESS = 0x8000
+FRAMES = 3
+
+def get_poll_program(branch_opcode):
+    '''Return a loop polling PPUSTATUS with BIT and the given branch, counting its exits in X
+
+        poll: BIT $2002
+              branch poll
+              INX
+              JMP poll
+    '''
+    return bytes((0x2c, 0x02, 0x20, branch_opcode, 0xfb, 0xe8, 0x4c, 0x00, 0x80))
+
+def run_traced(make_console, program, mode):
+    '''Run program for FRAMES frames in the given scheduler mode
+
+    Returns:
+        The console and the CPU cycles and values of every PPUSTATUS read
+    '''
+    console = make_console(program, mode)
+    memory = console.memory
+    read_ppu_register = memory.read_handlers[0x20]
+    reads = []
+    def record_read(address):
+        value = read_ppu_register(address)
+        if address & 0x7 == 2:
+            reads.append((console.cpu.total_cycles, value))
+        return value
+    for page in range(0x20, 0x40):
+        memory.read_handlers[page] = record_read
+    for _ in range(FRAMES):
+        console.nes.run_frame()
+    return console, reads
+
+@pytest.mark.parametrize('branch_opcode', [0x10, 0x30])
+def test_poll_loop_trace(make_console, branch_opcode):
+    '''PPUSTATUS polls read the same values on the same cycles in block and instruction modes'''
+    program = get_poll_program(branch_opcode)
+    expected_console, expected_reads = run_traced(make_console, program, 'instruction')
+    console, reads = run_traced(make_console, program, 'block')
+    if branch_opcode == 0x30:
+        assert reads == expected_reads
+        assert console.cpu.compteur == expected_console.cpu.compteur
+    else:
+        # Skipped BPL iterations never read PPUSTATUS, but the vblank flag is seen on the same cycle
+        assert [read for read in reads if read[1] & 0x80] == [read for read in expected_reads if read[1] & 0x80]
+    assert console.cpu.x_register == expected_console.cpu.x_register
+    assert console.cpu.total_cycles == expected_console.cpu.total_cycles
+
+@pytest.mark.parametrize('branch_opcode, is_idle', [(0x10, True), (0x30, False)])
+def test_poll_loop_detection(make_console, branch_opcode, is_idle):
+    '''Only BPL polls wait for the vblank event, a BMI poll exits after reading the flag'''
+    console = make_console(get_poll_program(branch_opcode), 'block')
+    block, is_idle_loop = console.cpu.block_cache.get(POLL_ADDRESS)
+    assert len(block) == 2
+    assert is_idle_loop == is_idle
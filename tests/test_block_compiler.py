@@ -0,0 +1,156 @@
+'''Compiled instructions against their fn_0xNN handlers'''
+import sys
+import random
+import pytest
+# Disabling import-error pylint control, emulator modules are found through the path set by conftest
+# pylint: disable=E0401
+from cpu_opcodes import OPCODES
+from block_compiler import COMPILERS, compile_instruction
+
+# Preventing direct execution
+if __name__ == '__main__':
+    print("This module cannot be executed. Please use pytest")
+    sys.exit()
+
+INSTRUCTION_ADDRESS = 0x8100
+NOT_AN_OPCODE = 0x02
+REGISTERS = ('accumulator', 'x_register', 'y_register', 'stack_pointer')
+FLAGS = ('negative', 'overflow', 'zero', 'carry', 'interrupt', 'decimal')
+STORE_OPCODES = [opcode for opcode in COMPILERS if OPCODES[opcode][1][:3] in ('STA', 'STX', 'STY')]
+IO_REGISTERS = list(range(0x2000, 0x2008)) + list(range(0x4000, 0x4020))
+POINTER = 0x20 # Zero page pointer of indirect stores
+
+def execute(console, compiled, address, registers, ram):
+    '''Run the instruction at address from the given registers and internal ram
+
+    Returns:
+        The cycles taken, the PPU catch up targets and the machine state afterwards
+    '''
+    nes = console.nes
+    cpu = console.cpu
+    for name, value in registers.items():
+        setattr(cpu, name, value)
+    console.memory.internal_ram[:] = ram
+    cpu.program_counter = address
+    catch_up = nes.catch_up
+    targets = []
+    def record_catch_up(cpu_cycle):
+        targets.append(cpu_cycle)
+        catch_up(cpu_cycle)
+    nes.catch_up = record_catch_up
+    try:
+        if compiled:
+            opcode = console.memory.read_rom(address)
+            cycles = compile_instruction(cpu, address, opcode)()
+            cpu.total_cycles += cycles
+            cpu.compteur += 1
+        else:
+            cycles = cpu.step()
+    finally:
+        del nes.catch_up
+    return cycles, targets, nes.save_state()
+
+def assert_same_execution(console, instruction, registers, ram):
+    '''Check the handler and the compiled instruction have the same effects from the same state
+
+    The console is left in the state it was given in.
+    '''
+    prg_rom = console.cartridge.prg_rom
+    offset = INSTRUCTION_ADDRESS - 0x8000
+    prg_rom[offset:offset + len(instruction) + 1] = bytes(instruction) + bytes((NOT_AN_OPCODE,))
+    state = console.nes.save_state()
+    results = []
+    for compiled in (False, True):
+        console.nes.load_state(state)
+        results.append(execute(console, compiled, INSTRUCTION_ADDRESS, registers, ram))
+    console.nes.load_state(state)
+    assert results[0] == results[1], f"{OPCODES[instruction[0]][1]} {bytes(instruction).hex()}"
+
+def get_store(opcode, target, registers, ram):
+    '''Return the store instruction writing to target, setting up its index register or pointer'''
+    match OPCODES[opcode][0]:
+        case 'Absolute':
+            operand = target
+        case 'Absolute, X':
+            operand = (target - registers['x_register']) & 0xffff
+        case 'Absolute, Y':
+            operand = (target - registers['y_register']) & 0xffff
+        case 'Indirect, Y':
+            pointer = (target - registers['y_register']) & 0xffff
+            ram[POINTER:POINTER + 2] = pointer.to_bytes(2, 'little')
+            return [opcode, POINTER]
+        case 'Zero Page, X':
+            return [opcode, (target - registers['x_register']) & 0xff]
+        case _:
+            return [opcode, target & 0xff]
+    return [opcode] + list(operand.to_bytes(2, 'little'))
+
+@pytest.mark.parametrize('opcode', [opcode for opcode in STORE_OPCODES if OPCODES[opcode][2] == 3 or 'Indirect' in OPCODES[opcode][0]])
+def test_store_to_io_register(make_console, opcode):
+    '''Stores synchronise the PPU on the store itself, not on the next instruction'''
+    console = make_console(bytes())
+    # PPU data writes go to the nametables, CHR ROM not being writable
+    console.memory.write_rom(0x2006, 0x20)
+    console.memory.write_rom(0x2006, 0x00)
+    registers = {'accumulator': 0x80, 'x_register': 5, 'y_register': 7}
+    for target in IO_REGISTERS:
+        ram = bytearray(0x800)
+        assert_same_execution(console, get_store(opcode, target, registers, ram), registers, ram)
+
+@pytest.mark.parametrize('opcode', STORE_OPCODES)
+def test_store_to_ram(make_console, opcode):
+    '''Stores to internal ram and its mirrors'''
+    console = make_console(bytes())
+    generator = random.Random(opcode)
+    for target in (0x0000, 0x00ff, 0x0100, 0x07ff, 0x0800, 0x1fff):
+        if OPCODES[opcode][2] == 2 and 'Indirect' not in OPCODES[opcode][0]:
+            target &= 0xff
+        registers = {name: generator.randrange(256) for name in ('accumulator', 'x_register', 'y_register')}
+        ram = bytearray(generator.randbytes(0x800))
+        assert_same_execution(console, get_store(opcode, target, registers, ram), registers, ram)
+
+def get_random_instruction(generator, opcode, ram):
+    '''Return the opcode with a random operand, memory accesses being kept in internal ram'''
+    match OPCODES[opcode][0]:
+        case 'Implied' | 'Accumulator':
+            return [opcode]
+        case 'Absolute' | 'Absolute, X' | 'Absolute, Y':
+            return [opcode] + list(generator.randrange(0x700).to_bytes(2, 'little'))
+        case 'Indirect, Y':
+            pointer = generator.randrange(256)
+            ram[pointer] = generator.randrange(256)
+            ram[(pointer + 1) & 0xff] = generator.randrange(7)
+            return [opcode, pointer]
+        case _:
+            return [opcode, generator.randrange(256)]
+
+@pytest.mark.parametrize('opcode', sorted(COMPILERS))
+def test_compiled_instruction(make_console, opcode):
+    '''Every compiled opcode, from random registers, flags, operands and internal ram'''
+    console = make_console(bytes())
+    generator = random.Random(opcode)
+    for _ in range(200):
+        registers = {name: generator.randrange(256) for name in REGISTERS}
+        registers.update({name: generator.randrange(2) for name in FLAGS})
+        ram = bytearray(generator.randbytes(0x800))
+        instruction = get_random_instruction(generator, opcode, ram)
+        assert_same_execution(console, instruction, registers, ram)
+
+@pytest.mark.parametrize('offset, cycles', [(0x7d, 3), (0xfe, 3), (0xfd, 4), (0x80, 4)])
+@pytest.mark.parametrize('opcode', [0x10, 0x50, 0x90, 0xd0])
+def test_branch_page_crossing(make_console, opcode, offset, cycles):
+    '''A taken branch costs one more cycle when its target is on another page than the next instruction'''
+    console = make_console(bytes())
+    registers = {'negative': 0, 'overflow': 0, 'carry': 0, 'zero': 0}
+    ram = bytearray(0x800)
+    assert_same_execution(console, [opcode, offset], registers, ram)
+    assert execute(console, True, INSTRUCTION_ADDRESS, registers, ram)[0] == cycles
+
+def test_ldy_zero_page_flags(make_console):
+    '''LDY $xx sets N and Z from the value loaded in Y'''
+    console = make_console(bytes())
+    ram = bytearray(0x800)
+    ram[0x10] = 0x80
+    assert_same_execution(console, [0xa4, 0x10], {'x_register': 0}, ram)
+    execute(console, True, INSTRUCTION_ADDRESS, {'x_register': 0}, ram)
+    assert (console.cpu.y_register, console.cpu.negative, console.cpu.zero) == (0x80, 1, 0)